@@ -0,0 +1,40 @@
+"""Backfill the `report_hour` field of the `meta` collection
+
+`widt.reporting.check_and_make_report` only queries the users whose `report_hour`
+(the UTC hour in which their day ends) is the current or the previous hour.
+Documents written before this field was introduced need to be updated once with
+this script.
+
+Requirements:
+- Valid Google Cloud service account credentials (keyfile.json)
+
+Example usage: `uv run python -m utility_scripts.backfill_report_hour`
+"""
+
+from widt.db import DB
+from widt.meta import get_report_hour
+
+# Firestore allows at most 500 operations in a write batch
+BATCH_SIZE = 500
+
+batch = DB.batch()
+pending, updated, skipped = 0, 0, 0
+for doc in DB.collection("meta").stream():
+    data = doc.to_dict()
+    if "timezone" not in data or "end_of_day" not in data:
+        skipped += 1
+        continue
+    report_hour = get_report_hour(data["timezone"], data["end_of_day"])
+    if data.get("report_hour") == report_hour:
+        continue
+    batch.set(doc.reference, {"report_hour": report_hour}, merge=True)
+    pending += 1
+    updated += 1
+    if pending == BATCH_SIZE:
+        batch.commit()
+        batch = DB.batch()
+        pending = 0
+if pending:
+    batch.commit()
+
+print(f"Updated {updated} documents ({skipped} without a complete config).")
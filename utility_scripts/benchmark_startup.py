@@ -0,0 +1,66 @@
+"""Benchmark the startup of the bot
+
+Measures, in fresh interpreters (so nothing is cached in `sys.modules`), the time to
+import `widt.bot` and to build the dispatcher with all the handlers registered (without
+connecting to Telegram or Firestore). Exits with an error when the median exceeds the
+budget, or when a module that should be loaded lazily is imported at startup.
+
+Example usage: `uv run python -m utility_scripts.benchmark_startup --runs 10 --budget 1.5`
+"""
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+import typer
+
+# Loaded on first use (see widt.db, widt.emails, widt.export and widt.mailgun)
+LAZY_MODULES = ("google.cloud.firestore", "jinja2", "markdown2", "requests")
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+import widt.bot
+imported = time.perf_counter()
+from queue import Queue
+from telegram import Bot
+from telegram.ext import Dispatcher
+widt.bot.add_handlers(Dispatcher(Bot("123:abc"), Queue()))
+print(json.dumps({
+    "import": imported - start,
+    "startup": time.perf_counter() - start,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+
+def probe() -> dict:
+    env = dict(os.environ, STORAGE_BACKEND="memory", STATE_PATH="")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(
+    runs: int = typer.Option(5, help="The number of cold starts to measure."),
+    budget: float = typer.Option(1.5, help="The maximum median startup time in seconds."),
+):
+    results = [probe() for _ in range(runs)]
+    import_time = statistics.median(result["import"] for result in results)
+    startup_time = statistics.median(result["startup"] for result in results)
+    print(f"Median import time: {import_time * 1000:.0f} ms")
+    print(f"Median startup time: {startup_time * 1000:.0f} ms")
+    loaded = sorted({name for result in results for name in result["loaded"]})
+    if loaded:
+        print(f"Loaded at startup (should be lazy): {', '.join(loaded)}")
+        raise typer.Exit(code=1)
+    if startup_time > budget:
+        print(f"Over the budget of {budget * 1000:.0f} ms")
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,15 +1,16 @@
-"""Convert the Firebase export files into a CSV file."""
+"""Convert the Firebase export files into a CSV file.
+
+The rows are those of the bot's `/export <from> <to> csv` (see `widt/export_formats.py`).
+"""
 
-import re
 import json
 from pathlib import Path
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta
 
 import typer
-import polars as pl
 
-PREV_MATCHING_PATTERN = re.compile(r"(?:[\s(（]+|^)prev[\s)）]+", re.IGNORECASE)
+from widt.storage import key_timestamp
+from widt.export_formats import export_row, write_csv
 
 
 def main(
@@ -22,32 +23,21 @@ def main(
 ):
     timezone_obj = ZoneInfo(timezone)
 
-    rows = []
+    entries = []
     for file_path in export_path.glob("*.json"):
         with file_path.open() as f:
             data = json.load(f)
         for field, value in data.items():
             if field == "month" or not isinstance(value, dict):
                 continue
-            for timestamp, content in value.items():
-                dt = datetime.fromtimestamp(int(timestamp), timezone_obj)
-                if PREV_MATCHING_PATTERN.match(content):
-                    date = dt.date() + timedelta(days=-1)
-                else:
-                    date = dt.date()
-                rows.append(
-                    {
-                        "date": date,
-                        "create_time": dt.isoformat(),
-                        "update_time": dt.isoformat(),
-                        "content": PREV_MATCHING_PATTERN.sub(r"", content).strip(),
-                        # "content": content,
-                    }
-                )
-    df = pl.DataFrame(rows)
-    df = df.with_columns(pl.lit(user_id, dtype=pl.Utf8).alias("user_id")).sort("date")
-    df.write_csv(f"{user_id}.csv")
-    print(f"Wrote {df.shape[0]} rows into {output_path}/{user_id}.csv")
+            entries.extend(value.items())
+    # Keys are Unix timestamps, optionally followed by "-<microseconds>"
+    entries.sort(key=lambda entry: (key_timestamp(entry[0]), entry[0]))
+    rows = [export_row(key, content, timezone_obj, user_id) for key, content in entries]
+    rows.sort(key=lambda row: row["date"])
+    with (output_path / f"{user_id}.csv").open("wb") as fout:
+        write_csv(rows, fout)
+    print(f"Wrote {len(rows)} rows into {output_path}/{user_id}.csv")
 
 
 if __name__ == "__main__":
@@ -2,7 +2,8 @@
 
 This module exports all documents from a Google Cloud Firestore database to local JSON files.
 Each collection in the database is exported to its own subdirectory, with each document
-saved as a separate JSON file named after the document ID.
+saved as a separate JSON file named after the document ID. Subcollections (e.g., the live
+entries in `live/{chat_id}/entries`) are exported to `{collection}/{document ID}/{subcollection}`.
 
 Requirements:
 - Valid Google Cloud service account credentials (keyfile.json)
@@ -33,5 +34,13 @@ for collection in db.collections():
         file_path = os.path.join(collection_path, f"{doc.id}.json")
         with open(file_path, "w") as f:
             json.dump(doc.to_dict(), f, indent=4)
+    # Documents holding only subcollections (e.g., `live/{chat_id}`) aren't streamed
+    for doc_ref in collection.list_documents():
+        for subcollection in doc_ref.collections():
+            subcollection_path = os.path.join(collection_path, doc_ref.id, subcollection.id)
+            os.makedirs(subcollection_path, exist_ok=True)
+            for subdoc in subcollection.stream():
+                with open(os.path.join(subcollection_path, f"{subdoc.id}.json"), "w") as f:
+                    json.dump(subdoc.to_dict(), f, indent=4)
 
 print("Export complete.")
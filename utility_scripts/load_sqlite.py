@@ -0,0 +1,33 @@
+"""Load a Firestore export into a SQLite database
+
+Loads the files written by `utility_scripts/export_db.py` (the `meta`, `live` and
+archive collections) into the database of the SQLite storage backend
+(`STORAGE_BACKEND=sqlite`, see `widt/sqlite_storage.py`). Loading is idempotent, so
+it can be rerun on a newer export.
+
+Example usage: `uv run python -m utility_scripts.load_sqlite db_export widt.sqlite`
+"""
+
+from pathlib import Path
+
+import typer
+
+from widt.export_cache import EXPORT_CACHE
+from widt.sqlite_storage import SqliteStorage, load_export
+
+
+def main(
+    export_path: Path = typer.Argument(Path("db_export"), help="The folder written by export_db.py."),
+    database_path: Path = typer.Argument(Path("widt.sqlite"), help="The SQLite database to load into."),
+):
+    counts = load_export(str(export_path), SqliteStorage(str(database_path)))
+    # Exports cached before the load may be stale
+    EXPORT_CACHE.clear()
+    print(
+        f"Loaded {counts['meta']} configs, {counts['live']} live entries "
+        f"and {counts['archive']} archived entries into {database_path}"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,23 @@
+"""Move the legacy archive into the monthly layout
+
+Days archived before the monthly layout live in one `archive/{chat_id}` document
+per chat (`month IS NULL` rows in the SQLite backend), which every `/export` has to
+read in full. This script moves them into the `{chat_id}/{YYYYMM}` month documents
+once; it is idempotent, so it can be rerun if it fails halfway. Afterwards set
+LEGACY_ARCHIVE=0 so the exports stop looking for the legacy documents.
+
+Uses the backend selected by STORAGE_BACKEND (see `widt/storage.py`).
+
+Requirements:
+- Valid Google Cloud service account credentials (keyfile.json) for Firestore
+
+Example usage: `uv run python -m utility_scripts.migrate_legacy_archive`
+"""
+
+from widt.storage import STORAGE
+from widt.export_cache import EXPORT_CACHE
+
+moved = STORAGE.migrate_legacy_archive()
+# The cached exports were made from the legacy documents
+EXPORT_CACHE.clear()
+print(f"Moved {sum(moved.values())} days of {len(moved)} chats into the monthly layout.")
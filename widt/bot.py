@@ -2,20 +2,25 @@ import os
 import re
 import sys
 import logging
-from datetime import datetime, timedelta
 
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, Filters,
     ConversationHandler
 )
-from google.cloud import firestore
+from telegram.utils.request import Request
 
-from .db import DB
 from .meta import check_config_exists
 from .config import add_config_handler
-from .export import add_export_handlers
+from .export import EXPORT_STATS_INTERVAL, add_export_handlers, log_export_stats
+from .export_jobs import EXPORTS
 from .journal import add_journal_handlers
+from .importer import add_import_handlers
+from .live import LIVE
+from .outbox import OUTBOX
+from .outbound import OUTBOUND_WORKERS, QueuedBot
+from .persistence import STATE_FLUSH_INTERVAL, create as create_persistence
 from .reporting import check_and_make_report
+from . import scheduler
 from .email_verification import send_code, resend_code, verify_code
 
 LOGGER = logging.getLogger(__name__)
@@ -32,6 +37,9 @@ HELP_TEXT = (
     "Other commands:\n"
     "+ /current — show entries collected so far today.\n"
     "+ /edit — edit or delete entries today.\n"
+    "+ /import — import entries from a .txt, .csv or .jsonl file.\n"
+    "+ /export — export your archive of a date range (send it without arguments for details).\n"
+    "+ /cancel_export — cancel your export in progress.\n"
     "\nNote: currently we archive your daily achievement automatically. "
     "In the future we'll provide you a way to view your archive and "
     "also let you decide to keep an archive or not."
@@ -57,32 +65,16 @@ def help_(update, context):
 def error(update, context):
     """Log Errors caused by Updates."""
     LOGGER.exception('Update "%s" caused error "%s"', update, context.error)
-    update.message.reply_text(
-        "Oops... Something went wrong..."
-    )
-
-
-def _get_nearest_start(minute=10):
-    now = datetime.now()
-    if now.minute < minute:
-        return now.replace(minute=minute, second=0)
-    return (now.replace(minute=minute, second=0) +
-            timedelta(hours=1))
-
-
-def main():
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    if BOT_TOKEN == "":
-        raise ValueError("BOT_TOKEN environment variable is not set.")
-    updater = Updater(BOT_TOKEN, use_context=True)
-    job_queue = updater.job_queue
+    # Callback queries have no update.message (and job errors have no update)
+    message = update.effective_message if update is not None else None
+    if message is not None:
+        message.reply_text(
+            "Oops... Something went wrong..."
+        )
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
 
+def add_handlers(dp):
+    """Register the handlers on the dispatcher."""
     # on different commands - answer in Telegram
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler('help', help_))
@@ -94,6 +86,8 @@ def main():
     dp.add_handler(CommandHandler(
         "resend", resend_code))
 
+    add_import_handlers(dp)
+
     add_journal_handlers(dp)
 
     add_export_handlers(dp)
@@ -101,6 +95,34 @@ def main():
     # log all errors
     dp.add_error_handler(error)
 
+
+def main():
+    """Start the bot."""
+    # Create the Updater and pass it your bot's token.
+    # Make sure to set use_context=True to use the new context based callbacks
+    # Post version 12 this will no longer be necessary
+    if BOT_TOKEN == "":
+        raise ValueError("BOT_TOKEN environment variable is not set.")
+    # Outgoing messages are rate limited to stay within Telegram's flood limits
+    # (the connection pool serves the dispatcher and the outbound workers)
+    bot = QueuedBot(BOT_TOKEN, request=Request(con_pool_size=8 + OUTBOUND_WORKERS))
+    # Conversations and user/chat data survive restarts (see widt.persistence)
+    persistence = create_persistence()
+    updater = Updater(bot=bot, use_context=True, persistence=persistence)
+    job_queue = updater.job_queue
+    if persistence is not None:
+        job_queue.run_repeating(
+            persistence.flush_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+
+    add_handlers(updater.dispatcher)
+    job_queue.run_repeating(
+        log_export_stats, interval=EXPORT_STATS_INTERVAL, first=EXPORT_STATS_INTERVAL)
+
+    # Deliver queued emails in the background
+    OUTBOX.start()
+    # Flush write-behind journal entries in the background (if enabled)
+    LIVE.start()
+
     # Start the Bot
     updater.start_polling()
 
@@ -118,14 +140,16 @@ def main():
             func, interval=300, first=5,
         )
     else:
-        job_queue.run_repeating(
-            check_and_make_report, interval=3600, first=_get_nearest_start()
-        )
+        # Wake up exactly when the next user's day ends
+        scheduler.start(job_queue)
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    EXPORTS.stop()
+    LIVE.stop()
+    OUTBOX.stop()
 
 
 if __name__ == '__main__':
@@ -1,10 +1,13 @@
 import re
+import time
+from zoneinfo import ZoneInfoNotFoundError
 
 from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, Filters
 
-from .db import DB
+from .meta_cache import META_CACHE
 from .email_verification import send_code
-from .meta import check_config_exists, _get_user_meta
+from .scheduler import reschedule
+from .meta import check_config_exists, _get_user_meta, get_report_hour, get_tzinfo
 
 TIMEZONE, END_OF_DAY, EMAIL = range(3)
 
@@ -22,7 +25,8 @@ def config(update, context):
     )
     update.message.reply_text(
         current +
-        "Specify the timezone you're in (e.g., -8, +1, +8).\n"
+        "Specify the timezone you're in (e.g., America/Los_Angeles, Asia/Kolkata), "
+        "or an offset from UTC (e.g., -8, +1, +8). A timezone name also follows daylight saving time.\n"
         "Type \'cancel\' to stop the process in any step."
     )
     return TIMEZONE
@@ -34,15 +38,21 @@ def set_timezone(update, context):
             "Alright. We can do this later."
         )
         return ConversationHandler.END
+    text = update.message.text.strip()
     try:
-        timezone = int(update.message.text)
+        timezone = int(text)
         if timezone < -12 or timezone > 14:
             raise ValueError()
     except ValueError:
-        update.message.reply_text(
-            "Timezone should be in the range of [-12, +14]."
-        )
-        return TIMEZONE
+        try:
+            get_tzinfo(text)
+            timezone = text
+        except (ValueError, ZoneInfoNotFoundError):
+            update.message.reply_text(
+                "Timezone should be a timezone name (e.g., America/New_York) "
+                "or an offset in the range of [-12, +14]."
+            )
+            return TIMEZONE
     context.user_data['timezone_new'] = timezone
     update.message.reply_text(
         "Great! Now specify at which hour your day ends (0-23):\n"
@@ -107,21 +117,27 @@ def set_email(update, context):
 def done(update, context):
     user_data = context.user_data
     metadata = context.user_data['metadata']
+    new_email = metadata.get("email", "") != user_data["email_new"]
     metadata["end_of_day"] = user_data["end_of_day_new"]
     metadata["timezone"] = user_data["timezone_new"]
-    if metadata.get("email", "") != user_data["email_new"]:
-        # Got an new email address
-        metadata["email"] = user_data["email_new"]
-        if metadata["email"]:
-            send_code(update, user_data)
+    metadata["report_hour"] = get_report_hour(
+        metadata["timezone"], metadata["end_of_day"])
+    metadata["email"] = user_data["email_new"]
     for field in ("end_of_day_new", "timezone_new", "email_new"):
         if field in user_data:
             del user_data[field]
-    DB.collection("meta").document(str(update.message.chat_id)).set({
+    META_CACHE.update(update.message.chat_id, {
         "end_of_day": metadata["end_of_day"],
         "timezone": metadata["timezone"],
-        "email": metadata.get("email", "")
-    }, merge=True)
+        "report_hour": metadata["report_hour"],
+        "email": metadata["email"],
+        # Tells the scheduler whether the last report instant came before the config
+        "config_time": int(time.time())
+    })
+    if new_email and metadata["email"]:
+        # Got an new email address
+        send_code(update, user_data)
+    reschedule(update.message.chat_id, metadata)
     update.message.reply_text(
         f'All set! Timezone: {metadata["timezone"]} End of day: {metadata["end_of_day"]}'
         + (
@@ -138,10 +154,9 @@ def set_reminder(update, context):
         assert code.lower() in ("yes", "no")
     except (IndexError, ValueError, AssertionError):
         update.message.reply_text('Usage: /reminder [yes|no]')
-    DB.collection("meta").document(str(update.message.chat_id)).set({
-        "reminder": code == "yes"
-    }, merge=True)
-    context.user_data["reminder"] = (code == "yes")
+        return
+    code = code.lower()
+    META_CACHE.update(update.message.chat_id, {"reminder": code == "yes"})
     if code == "yes":
         update.message.reply_text(
             'Okay! We will send you reminders from now.'
@@ -166,7 +181,9 @@ def add_config_handler(dp):
                 MessageHandler(Filters.text, set_email)
             ],
         },
-        fallbacks=[]
+        fallbacks=[],
+        name="config",
+        persistent=dp.persistence is not None
     ))
     dp.add_handler(CommandHandler(
         "reminder", set_reminder, pass_args=True))
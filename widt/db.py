@@ -1,10 +1,34 @@
+"""The Firestore client
+
+The client (and the google-cloud-firestore package, which is slow to import)
+is only loaded when DB is first used, so importing `widt` modules, running
+the tests and using the other storage backends don't pay for it.
+"""
 import os
+import threading
+
+
+class _LazyClient:
+    """Stands in for `firestore.Client()` until the first attribute access."""
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google.cloud import firestore
+                    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "keyfile.json"
+                    self._client = firestore.Client()
+        return self._client
 
-from google.cloud import firestore
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "keyfile.json"
 
 if os.environ.get("TEST_MODE"):
     DB = None
 else:
-    DB = firestore.Client()
+    DB = _LazyClient()
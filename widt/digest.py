@@ -0,0 +1,99 @@
+"""Incrementally rendered daily digests
+
+The lines of a user's report (the Telegram text and the email HTML) are
+rendered when an entry is confirmed or edited, so the end-of-day report only
+joins pre-built lines. The live document stays the source of truth: at report
+time every cached line is checked against the archived entry, and lines that
+are missing or stale (e.g., after a restart or a timezone change) are rendered
+on the spot.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from .emails import render_entries
+from .meta import Timezone, timestamp_to_user_time
+
+# Digests kept in memory (least recently used are dropped)
+MAX_DIGESTS = int(os.environ.get("MAX_DIGESTS", "10000"))
+LOGGER = logging.getLogger(__name__)
+
+# An entry's (item, text line, HTML line)
+Line = Tuple[str, str, str]
+
+
+def render_line(key: str, item: str, timezone: Timezone) -> Line:
+    user_time = timestamp_to_user_time(key, timezone)
+    return (
+        item,
+        "* {} — {}".format(user_time.strftime('%H:%M:%S'), item),
+        render_entries([(user_time.strftime('%H:%M'), item)])
+    )
+
+
+class Digests:
+    def __init__(self, max_digests: int = MAX_DIGESTS):
+        self.max_digests = max_digests
+        self._lock = threading.Lock()
+        # chat_id -> (timezone, {entry key: line})
+        self._digests: Dict[str, Tuple[Timezone, Dict[str, Line]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lines(self, chat_id, timezone: Timezone) -> Dict[str, Line]:
+        # Caller must hold self._lock
+        key = str(chat_id)
+        digest = self._digests.get(key)
+        if digest is None or digest[0] != timezone:
+            digest = (timezone, {})
+            self._digests[key] = digest
+            if len(self._digests) > self.max_digests:
+                self._digests.popitem(last=False)
+        else:
+            self._digests.move_to_end(key)
+        return digest[1]
+
+    def set(self, chat_id, key: str, item: str, timezone: Timezone):
+        """Render a new or edited entry."""
+        line = render_line(key, item, timezone)
+        with self._lock:
+            self._lines(chat_id, timezone)[key] = line
+
+    def remove(self, chat_id, key: str):
+        with self._lock:
+            digest = self._digests.get(str(chat_id))
+            if digest is not None:
+                digest[1].pop(key, None)
+
+    def discard(self, chat_id):
+        with self._lock:
+            self._digests.pop(str(chat_id), None)
+
+    def build(self, chat_id, entries: List[Tuple[str, str]], timezone: Timezone) -> Tuple[str, str]:
+        """Join the lines of the (sorted) entries into the text and HTML digests."""
+        with self._lock:
+            digest = self._digests.get(str(chat_id))
+            cached = dict(digest[1]) if digest is not None and digest[0] == timezone else {}
+        lines, misses = [], 0
+        for key, item in entries:
+            line = cached.get(key)
+            if line is None or line[0] != item:
+                misses += 1
+                line = render_line(key, item, timezone)
+            lines.append(line)
+        with self._lock:
+            self.hits += len(lines) - misses
+            self.misses += misses
+        return (
+            "\n".join(line[1] for line in lines),
+            "".join(line[2] for line in lines)
+        )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"digests": len(self._digests), "hits": self.hits, "misses": self.misses}
+
+
+DIGESTS = Digests()
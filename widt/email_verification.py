@@ -1,36 +1,24 @@
-import os
 import random
 import logging
 from datetime import datetime, timedelta
 
-import requests
-
-from .db import DB
+from .mailgun import send_message
 from .meta import check_config_exists, _get_user_meta
+from .meta_cache import META_CACHE
 
-MAILGUN_DOMAIN = os.environ.get("MG_DOMAIN", "")
-MAILGUN_API_KEY = os.environ.get("MG_KEY", "")
 LOGGER = logging.getLogger(__name__)
 EXPIRES = timedelta(hours=2)
 MIN_RESEND_GAP = timedelta(minutes=5)
 
 
 def _send_email(email, code) -> bool:
-    if MAILGUN_DOMAIN == "" or MAILGUN_API_KEY == "":
-        LOGGER.warning(
-            "MAILGUN_DOMAIN and/or MAILGUN_API_KEY environment "
-            "variable is not set! Skipping emailing...")
+    res = send_message({
+        "to": [email],
+        "subject": "Verification Code for What I Did Today Bot",
+        "text": f"Please send \"/verify {code}\" (text inside the quote) to the bot to verify your email."
+    })
+    if res is None:
         return False
-    res = requests.post(
-        f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-        auth=("api", MAILGUN_API_KEY),
-        data={
-            "from": f"What I Did Today <bot@{MAILGUN_DOMAIN}>",
-            "to": [email],
-            "subject": "Verification Code for What I Did Today Bot",
-            "text": f"Please send \"/verify {code}\" (text inside the quote) to the bot to verify your email."
-        }
-    )
     LOGGER.info("Verification email: %s %d" % (code, res.status_code))
     if res.status_code != 200:
         LOGGER.error(res.text)
@@ -54,21 +42,19 @@ def send_code(update, user_data):
         return
     code = "%06d" % (random.random() * 1000000)
     assert _send_email(data["email"], code)
-    DB.collection("meta").document(str(update.message.chat_id)).set({
+    META_CACHE.update(update.message.chat_id, {
         "email_verification_code": code,
         "email_verified": False,
         "email_verification_timestamp": int(datetime.now().timestamp())
-    }, merge=True)
+    })
     user_data["metadata"]["email_verified"] = False
     update.message.reply_text(
         "Verification email sent! Please check your inbox.")
 
 
 def verify_code(update, context):
-    if not check_config_exists(
-        update, update.message.chat_id, context.user_data,
-        update_cache=True
-    ):
+    # The cache is written through by send_code, so no reread is needed
+    if not check_config_exists(update, update.message.chat_id, context.user_data):
         update.message.reply_text(
             'Please run /config first to set your email.')
         return
@@ -84,10 +70,10 @@ def verify_code(update, context):
         return
     # LOGGER.info("%s, %s", data["email_verification_code"], code)
     if data["email_verification_code"] == code:
-        DB.collection("meta").document(str(update.message.chat_id)).set({
+        META_CACHE.update(update.message.chat_id, {
             "email_verification_code": "",
             "email_verified": True
-        }, merge=True)
+        })
         context.user_data["metadata"]["email_verified"] = True
         update.message.reply_text("We've successfully verified your email!")
     else:
@@ -0,0 +1,99 @@
+"""Report email rendering and Mailgun batch sending
+
+A report email is described by a template name ("normal" or "skip"), a
+recipient, and a few per-recipient variables. Each template is rendered once
+into a shell with Mailgun `%recipient.<name>%` placeholders. Many recipients
+can then share one batch API call (up to MAX_BATCH_RECIPIENTS) with their
+values passed as `recipient-variables`. Emails that can't be batched get the
+same placeholders filled in locally and are sent on their own.
+"""
+import re
+import json
+from pathlib import Path
+from functools import lru_cache
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+# Mailgun accepts at most 1000 recipients per batch call
+MAX_BATCH_RECIPIENTS = 1000
+PLACEHOLDER = re.compile(r"%recipient\.(\w+)%")
+SUBJECTS = {
+    "normal": "%recipient.day% — Congratulation on Another Awesome Day!",
+    "skip": "%recipient.day% — Remember that You Are Awesome!"
+}
+
+
+@lru_cache(maxsize=None)
+def get_template_env():
+    # jinja2 is imported on the first render, not at startup
+    from jinja2 import FileSystemLoader, Environment
+    return Environment(loader=FileSystemLoader(
+        searchpath=str(Path(__file__).parent / "templates")
+    ))
+
+
+def render_entries(entries: List[Tuple[str, str]]) -> str:
+    return get_template_env().get_template("entries.jinja").render(entries=entries)
+
+
+@lru_cache(maxsize=None)
+def get_shell(template: str) -> Dict[str, str]:
+    """Render a template once with placeholders for the per-recipient values."""
+    return {
+        "subject": SUBJECTS[template],
+        "text": "%recipient.text%",
+        "html": get_template_env().get_template(f"{template}.jinja").render(
+            formatted_date="%recipient.date%",
+            entries_html="%recipient.entries%"
+        )
+    }
+
+
+def make_payload(recipient: str, user_time: datetime, entries_html: str, message: str) -> Dict:
+    """Describe a report email (to be stored in the outbox).
+
+    `entries_html` is the rendered list of entries (see `render_entries`).
+    """
+    return {
+        "template": "normal" if entries_html else "skip",
+        "to": recipient,
+        "variables": {
+            "date": user_time.strftime("%Y-%m-%d"),
+            "day": user_time.strftime("%Y%m%d"),
+            "entries": entries_html,
+            "text": message
+        }
+    }
+
+
+def substitute(text: str, variables: Dict[str, str]) -> str:
+    # One pass, so values containing placeholders are left alone
+    return PLACEHOLDER.sub(lambda m: variables.get(m.group(1), m.group(0)), text)
+
+
+def build_single(payload: Dict) -> Dict:
+    """Build the Mailgun form data for one report email."""
+    shell = get_shell(payload["template"])
+    data = {
+        field: substitute(value, payload["variables"])
+        for field, value in shell.items()
+    }
+    data["to"] = [payload["to"]]
+    return data
+
+
+def build_batch(template: str, payloads: List[Dict]) -> Dict:
+    """Build the Mailgun form data for a batch of report emails."""
+    data = dict(get_shell(template))
+    data["to"] = [payload["to"] for payload in payloads]
+    data["recipient-variables"] = json.dumps({
+        payload["to"]: payload["variables"] for payload in payloads
+    })
+    return data
+
+
+def is_batchable(payload: Dict) -> bool:
+    # Mailgun substitutes values as is; be safe with values that look like placeholders
+    return not any(
+        PLACEHOLDER.search(value) for value in payload["variables"].values()
+    )
@@ -1,73 +1,116 @@
-import io
+import os
+import heapq
 import logging
-from typing import Tuple
+import tempfile
+from functools import partial
 from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 
-import markdown2
 from telegram.ext import CommandHandler
 
-from .db import DB
-from .meta import check_config_exists
-
-
-def remove_month_field(x):
-    if "month" in x:
-        del x["month"]
-    return x
-
-
-def _get_archive(update, context, date_range: Tuple[datetime, datetime]):
-    new_query = DB.collection(
-        str(update.message.chat_id)
-    ).where(
-        "month", ">=", int(date_range[0].strftime("%Y%m"))
-    ).where(
-        "month", "<=", int(date_range[1].strftime("%Y%m"))
-    ).stream()
-    legacy_doc = DB.collection("archive").document(
-        str(update.message.chat_id)
-    ).get()
-    new_docs = [x for x in new_query if x is not None]
-    offset = timedelta(hours=context.user_data["metadata"]["timezone"])
-    all_docs = [
-        remove_month_field(doc.to_dict())
-        for doc in filter(
-            lambda x: x.to_dict() is not None,
-            chain([legacy_doc], new_docs)
-        )
-    ]
-    entries = sorted(
-        [
-            (
-                datetime.utcfromtimestamp(
-                    int(key)
-                ) + offset,
-                item
-            )
-            for doc in all_docs
-            for row in doc.values()
-            for key, item in row.items()
-        ],
-        key=lambda x: x[0]
+from .meta import Timezone, check_config_exists, get_tzinfo, timestamp_to_user_time
+from .export_jobs import EXPORTS, ExportJob, ExportRejected
+from .export_cache import EXPORT_CACHE
+from .export_formats import (
+    COMPRESSIONS, FORMATS, ExportEntry, compressed, export_filename, is_available, write_export
+)
+from .storage import STORAGE, key_timestamp
+
+# An archived day is named after the date its report was made (in the
+# user's time); timezone changes can move it a little before its entries
+DAY_MARGIN = timedelta(days=2)
+# The last month of an export whose range isn't over yet: any later report can add to it
+OPEN_MONTH = 999912
+# Exports larger than this (bytes) are spooled to disk
+EXPORT_SPOOL_SIZE = int(os.environ.get("EXPORT_SPOOL_SIZE", str(1024 * 1024)))
+# Seconds between the log lines of the export stats
+EXPORT_STATS_INTERVAL = int(os.environ.get("EXPORT_STATS_INTERVAL", "3600"))
+LOGGER = logging.getLogger(__name__)
+
+
+def _entry_order(entry: Tuple[str, str]) -> Tuple[int, str]:
+    return key_timestamp(entry[0]), entry[0]
+
+
+def _month_entries(days: Iterable[Tuple[Optional[int], str, dict]]) -> Iterator[Tuple[str, str]]:
+    # The days arrive month by month, so only one month is sorted at a time.
+    # Before `ArchivedDay.leftovers`, an entry whose live copy failed to be
+    # deleted was archived again by the next report, possibly in the next
+    # month; the keys of the previous month skip those repeats.
+    month: Optional[int] = None
+    batch: Dict[str, str] = {}
+    previous: Dict[str, str] = {}
+    for day_month, _, entries in days:
+        if day_month != month:
+            yield from sorted(batch.items(), key=_entry_order)
+            month, batch, previous = day_month, {}, batch
+        batch.update((key, text) for key, text in entries.items() if key not in previous)
+    yield from sorted(batch.items(), key=_entry_order)
+
+
+def archive_months(date_range: Tuple[datetime, datetime]) -> Tuple[int, int]:
+    """The months (YYYYMM) of the archive reported in a date range (give or take DAY_MARGIN)."""
+    return (
+        int((date_range[0] - DAY_MARGIN).strftime("%Y%m")),
+        int((date_range[1] + DAY_MARGIN).strftime("%Y%m"))
     )
-    entries = list(filter(
-        lambda x: x[0] >= date_range[0] and x[0] <= date_range[1],
-        entries
-    ))
-    return entries
 
 
-def prepare_file(entries):
-    buffer = []
-    current_date = None
-    for row in entries:
-        if current_date is None or row[0].date() != current_date:
-            current_date = row[0].date()
-            buffer.append(f"\n## {current_date.strftime('%Y-%m-%d')}\n\n")
-        buffer.append(f"+ {row[0].strftime('%H:%M')}: {row[1].strip()}\n")
-    html_str = markdown2.markdown("".join(buffer))
-    return io.BytesIO(str(html_str).encode("utf8"))
+def _archive_days(chat_id, timezone: Timezone, date_range: Tuple[datetime, datetime],
+                  months: Optional[List[int]]) -> Iterator[Tuple[Optional[int], str, dict]]:
+    # A report collects every live entry older than it, so a day reported
+    # before the range can't hold entries of the range, but one reported long
+    # after it can (after an outage, or for a chat that wasn't reported for a
+    # while). So the months after the range are read until one has a day
+    # starting after the range: every entry of the range was collected by then.
+    first_month, last_month = archive_months(date_range)
+    now_month = int((datetime.utcnow() + DAY_MARGIN).strftime("%Y%m"))
+    first_key = (date_range[0] - DAY_MARGIN).strftime("%Y%m%d")
+    stop_month: Optional[int] = None
+    for month, day, entries in STORAGE.query_archive(chat_id, first_month, max(last_month, now_month)):
+        if month is not None and stop_month is not None and month > stop_month:
+            break
+        # Skip the days before the range by their keys, before touching the entries
+        if day[:8].isdigit() and day[:8] < first_key:
+            continue
+        if month is not None and stop_month is None and entries and timestamp_to_user_time(
+                min(entries, key=key_timestamp), timezone) > date_range[1]:
+            # Imports archive the entries of the range up to last_month
+            stop_month = max(month, last_month)
+        yield month, day, entries
+    if months is not None:
+        months.extend((first_month, OPEN_MONTH if stop_month is None else stop_month))
+
+
+def iter_archive(chat_id, timezone: Timezone, date_range: Tuple[datetime, datetime],
+                 months: Optional[List[int]] = None) -> Iterator[ExportEntry]:
+    """The archived entries in a range, in order.
+
+    Holds one month of entries (and the legacy archive) in memory. Once all
+    the entries are read, the first and last months (YYYYMM) of the archive
+    they depend on are appended to `months` (if given).
+    """
+    days = _archive_days(chat_id, timezone, date_range, months)
+    # The legacy days come first
+    legacy: List[Tuple[str, str]] = []
+    for day in days:
+        if day[0] is not None:
+            days = chain([day], days)
+            break
+        legacy.extend(day[2].items())
+    legacy.sort(key=_entry_order)
+    for key, item in heapq.merge(legacy, _month_entries(days), key=_entry_order):
+        user_time = timestamp_to_user_time(key, timezone)
+        if date_range[0] <= user_time <= date_range[1]:
+            yield ExportEntry(key, user_time, item)
+
+
+USAGE = (
+    "Format: /export <from_date:YYYYMMDD> <to_date:YYYYMMDD> [format] [compression]\n"
+    f"Formats: {', '.join(FORMATS)} (html by default)\n"
+    f"Compression: {', '.join(COMPRESSIONS)} (none by default)\n"
+)
 
 
 def list_archive(update, context) -> None:
@@ -84,21 +127,96 @@ def list_archive(update, context) -> None:
     except Exception as e:
         print(e)
         update.message.reply_text(
-            "Failed to parse dates. Please try again\n"
-            "Format: /export <from_date:YYYYMMDD> <to_date:YYYYMMDD> \n"
+            "Failed to parse dates. Please try again\n" + USAGE
         )
         return
-    entries = _get_archive(update, context, date_range)
-    logging.info("Collected %d entries", len(entries))
-    update.effective_chat.send_document(
-        prepare_file(entries),
-        filename=f"export-{context.args[0]}-{context.args[1]}.html"
-    )
-    update.message.reply_text(
-        "There you go!"
-    )
+    options = [arg.lower() for arg in context.args[2:]]
+    formats = [arg for arg in options if arg not in COMPRESSIONS]
+    compressions = [arg for arg in options if arg in COMPRESSIONS]
+    if len(formats) > 1 or len(compressions) > 1 or any(arg not in FORMATS for arg in formats):
+        update.message.reply_text(
+            "Failed to parse the options (give at most one format and one compression). "
+            "Please try again\n" + USAGE
+        )
+        return
+    export_format = formats[0] if formats else "html"
+    compression = compressions[0] if compressions else None
+    if not is_available(export_format):
+        update.message.reply_text(
+            f"Sorry, the {export_format} format isn't available right now."
+        )
+        return
+    timezone = context.user_data["metadata"]["timezone"]
+    job = ExportJob(update.message.chat_id, update.effective_user.id)
+
+    def announce(job: ExportJob, queued: int):
+        job.message = update.message.reply_text(
+            f"Export {job.id}: queued{f' behind {queued} other exports' if queued else ''}. "
+            f"Send /cancel_export {job.id} to cancel it."
+        )
+    try:
+        EXPORTS.submit(job, partial(
+            _run_export, chat=update.effective_chat, date_range=date_range, timezone=timezone,
+            export_format=export_format, compression=compression,
+            name=f"export-{context.args[0]}-{context.args[1]}"
+        ), announce)
+    except ExportRejected as e:
+        update.message.reply_text(str(e))
     return
 
 
+def _run_export(job: ExportJob, chat, date_range: Tuple[datetime, datetime], timezone: Timezone,
+                export_format: str, compression: Optional[str], name: str):
+    filename = export_filename(name, export_format, compression)
+    # Everything the file depends on, besides the archive
+    request = f"{filename}/{timezone}/{job.user_id}"
+    cached = EXPORT_CACHE.get(job.chat_id, request)
+    if cached is not None:
+        job.count = cached.entries
+        with cached.file:
+            job.start_upload()
+            job.progress(f"uploading {job.count} entries...", force=True)
+            # Queued (see widt.outbound): wait for the upload before closing the file
+            chat.send_document(cached.file, filename=filename).result()
+        job.progress(f"done ({job.count} entries). There you go!", force=True)
+        return
+    version = EXPORT_CACHE.version()
+    months: List[int] = []
+    entries = job.track(iter_archive(job.chat_id, timezone, date_range, months))
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as fout:
+        with compressed(fout, compression, f"{name}.{export_format}") as stream:
+            write_export(export_format, entries, stream, get_tzinfo(timezone), job.user_id)
+        LOGGER.info("Exported %d entries as %s (%d bytes)", job.count, export_format, fout.tell())
+        fout.seek(0)
+        EXPORT_CACHE.put(job.chat_id, request, *months, version, job.count, fout)
+        job.start_upload()
+        job.progress(f"uploading {job.count} entries...", force=True)
+        fout.seek(0)
+        chat.send_document(fout, filename=filename).result()
+    job.progress(f"done ({job.count} entries). There you go!", force=True)
+
+
+def cancel_export(update, context) -> None:
+    job_id = context.args[0] if context.args else None
+    jobs = EXPORTS.cancel(update.effective_user.id, job_id)
+    if not jobs:
+        update.message.reply_text(
+            f"Export {job_id} isn't in progress." if job_id else "You don't have an export in progress."
+        )
+        return
+    for job in jobs:
+        update.message.reply_text(
+            f"Export {job.id} is already being uploaded and can't be canceled."
+            if job.uploading else f"Canceling export {job.id}..."
+        )
+
+
+def log_export_stats(context) -> None:
+    """A periodic job: log the stats of the export queue and the export cache."""
+    LOGGER.info("Exports: %s", EXPORTS.stats())
+    LOGGER.info("Export cache: %s", EXPORT_CACHE.stats())
+
+
 def add_export_handlers(dp):
     dp.add_handler(CommandHandler('export', list_archive))
+    dp.add_handler(CommandHandler('cancel_export', cancel_export))
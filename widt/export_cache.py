@@ -0,0 +1,216 @@
+"""An on-disk cache of finished export files
+
+An export is identified by its request (chat, date range, format,
+compression, timezone and user) and depends on the archive months it reads
+(up to the last one that can hold its entries; see `widt.export.iter_archive`).
+Every write to the archive of a chat bumps the versions of the months it
+touches (`bump`; see `widt.reporting` and `widt.importer`), and a cached file
+is only served while none of its months has been bumped since it was made.
+The daily reports only write the current month, so exports of closed months
+stay cached and repeat requests don't read the storage at all.
+
+The files live in EXPORT_CACHE_DIR, indexed by a SQLite database there. The
+least recently used files are evicted to keep the total under
+EXPORT_CACHE_SIZE bytes. An empty EXPORT_CACHE_DIR (the default in
+TEST_MODE) or a zero size disables the cache.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import IO, Dict, Iterable, NamedTuple, Optional, Tuple
+
+EXPORT_CACHE_DIR = os.environ.get(
+    "EXPORT_CACHE_DIR", "" if os.environ.get("TEST_MODE") else "export_cache")
+EXPORT_CACHE_SIZE = int(os.environ.get("EXPORT_CACHE_SIZE", str(200 * 1024 * 1024)))
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = (
+    # The version of a month is the value of the counter when it was last written
+    """
+    CREATE TABLE IF NOT EXISTS months (
+        chat_id TEXT NOT NULL,
+        month INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, month)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS counter (value INTEGER NOT NULL)",
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        first_month INTEGER NOT NULL,
+        last_month INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        entries INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)",
+)
+
+
+class CachedExport(NamedTuple):
+    file: IO[bytes]
+    entries: int
+
+
+class ExportCache:
+    def __init__(self, path: str = EXPORT_CACHE_DIR, max_size: int = EXPORT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.max_size > 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller must hold self._lock
+        if self._conn is None:
+            os.makedirs(self.path, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            if conn.execute("SELECT COUNT(*) FROM counter").fetchone()[0] == 0:
+                conn.execute("INSERT INTO counter (value) VALUES (0)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _name(chat_id: str, request: str) -> str:
+        return hashlib.sha1(f"{chat_id}/{request}".encode("utf8")).hexdigest()
+
+    def version(self) -> int:
+        """The current version; take it before reading the archive for `put`."""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            return self._connection().execute("SELECT value FROM counter").fetchone()[0]
+
+    def bump(self, chat_months: Iterable[Tuple[str, int]]):
+        """Mark months (YYYYMM) of chats as changed."""
+        chat_months = {(str(chat_id), int(month)) for chat_id, month in chat_months}
+        if not self.enabled or not chat_months:
+            return
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE counter SET value = value + 1")
+                version = conn.execute("SELECT value FROM counter").fetchone()[0]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO months (chat_id, month, version) VALUES (?, ?, ?)",
+                    [(chat_id, month, version) for chat_id, month in chat_months]
+                )
+
+    def get(self, chat_id, request: str) -> Optional[CachedExport]:
+        """The cached file of a request, if none of its months changed since."""
+        if not self.enabled:
+            return None
+        chat_id, name = str(chat_id), self._name(str(chat_id), request)
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT version, entries, first_month, last_month FROM files WHERE name = ?", (name,)
+            ).fetchone()
+            changed = row is not None and conn.execute(
+                "SELECT COUNT(*) FROM months WHERE chat_id = ? AND month BETWEEN ? AND ? AND version > ?",
+                (chat_id, row[2], row[3], row[0])
+            ).fetchone()[0] > 0
+            cached = None
+            if row is not None and not changed:
+                try:
+                    # Still readable if it's evicted while being sent
+                    cached = CachedExport(open(os.path.join(self.path, name), "rb"), row[1])
+                except FileNotFoundError:
+                    pass
+            if cached is None:
+                if row is not None:
+                    self._remove(conn, name)
+                    conn.commit()
+                self._misses += 1
+                return None
+            conn.execute("UPDATE files SET last_used = ? WHERE name = ?", (time.time(), name))
+            conn.commit()
+            self._hits += 1
+        return cached
+
+    def put(self, chat_id, request: str, first_month: int, last_month: int,
+            version: int, entries: int, fin: IO[bytes]):
+        """Cache the file of a request (`fin` is read from its position)."""
+        if not self.enabled:
+            return
+        chat_id, name = str(chat_id), self._name(str(chat_id), request)
+        path = os.path.join(self.path, name)
+        # Copied outside the lock; the name is unique to this thread
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        os.makedirs(self.path, exist_ok=True)
+        with open(temp_path, "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+            size = fout.tell()
+        if size > self.max_size:
+            os.remove(temp_path)
+            return
+        with self._lock:
+            conn = self._connection()
+            os.replace(temp_path, path)
+            conn.execute(
+                "INSERT OR REPLACE INTO files "
+                "(name, chat_id, first_month, last_month, version, entries, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, chat_id, first_month, last_month, version, entries, size, time.time())
+            )
+            self._evict(conn)
+            conn.commit()
+
+    def _remove(self, conn: sqlite3.Connection, name: str):
+        # Caller must hold self._lock
+        conn.execute("DELETE FROM files WHERE name = ?", (name,))
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, conn: sqlite3.Connection):
+        # Caller must hold self._lock
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total <= self.max_size:
+            return
+        for name, size in conn.execute("SELECT name, size FROM files ORDER BY last_used").fetchall():
+            self._remove(conn, name)
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        """Drop all the cached files (after the archive changed behind our back)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            conn = self._connection()
+            for (name,) in conn.execute("SELECT name FROM files").fetchall():
+                self._remove(conn, name)
+            conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            files, size = (0, 0) if not self.enabled else self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            requests = self._hits + self._misses
+            return {
+                "files": files, "bytes": size, "hits": self._hits, "misses": self._misses,
+                "hit_rate": round(self._hits / requests, 3) if requests else None,
+            }
+
+
+EXPORT_CACHE = ExportCache()
@@ -0,0 +1,189 @@
+"""The file formats of the archive exports
+
+Every writer streams the entries (or their rows) into a binary file object a
+chunk at a time:
+
++ `html` — the day-by-day list, rendered from Markdown one day at a time
++ `md` — the same list as plain Markdown
++ `csv`, `jsonl`, `parquet` — one row per entry, with the COLUMNS of
+  `utility_scripts/convert_export_files_to_csv.py` (which uses `export_row`)
+
+Parquet needs polars (imported when used); being columnar, it is the one
+format that holds all the rows in memory. `compressed` wraps the output in a
+gzip stream or a zip archive.
+"""
+import io
+import re
+import csv
+import gzip
+import json
+import zipfile
+import importlib.util
+from contextlib import contextmanager
+from datetime import datetime, timedelta, tzinfo
+from typing import IO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+from .storage import key_timestamp
+
+COLUMNS = ("date", "create_time", "update_time", "content", "user_id")
+# Entries starting with "prev" belong to the day before
+PREV_MATCHING_PATTERN = re.compile(r"(?:[\s(（]+|^)prev[\s)）]+", re.IGNORECASE)
+COMPRESSIONS = ("gz", "zip")
+# Text is encoded and written in chunks of about this size (characters)
+CHUNK_SIZE = 64 * 1024
+
+
+class ExportEntry(NamedTuple):
+    key: str
+    user_time: datetime
+    content: str
+
+
+def export_row(key: str, content: str, timezone: tzinfo, user_id) -> Dict:
+    """The row of an entry (see COLUMNS)."""
+    created = datetime.fromtimestamp(key_timestamp(key), timezone)
+    date = created.date()
+    if PREV_MATCHING_PATTERN.match(content):
+        date -= timedelta(days=1)
+    return {
+        "date": date,
+        "create_time": created.isoformat(),
+        # The archive doesn't keep edit times
+        "update_time": created.isoformat(),
+        "content": PREV_MATCHING_PATTERN.sub("", content).strip(),
+        "user_id": str(user_id),
+    }
+
+
+def _write_text(chunks: Iterable[str], fout: IO[bytes]):
+    buffer, size = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            fout.write("".join(buffer).encode("utf8"))
+            buffer, size = [], 0
+    fout.write("".join(buffer).encode("utf8"))
+
+
+def _markdown_days(entries: Iterable[ExportEntry]) -> Iterator[str]:
+    # One Markdown string per day
+    buffer: List[str] = []
+    current_date = None
+    for entry in entries:
+        if current_date is None or entry.user_time.date() != current_date:
+            if buffer:
+                yield "".join(buffer)
+            current_date = entry.user_time.date()
+            buffer = [f"\n## {current_date.strftime('%Y-%m-%d')}\n\n"]
+        buffer.append(f"+ {entry.user_time.strftime('%H:%M')}: {entry.content.strip()}\n")
+    if buffer:
+        yield "".join(buffer)
+
+
+def write_markdown(entries: Iterable[ExportEntry], fout: IO[bytes]):
+    _write_text(_markdown_days(entries), fout)
+
+
+def write_html(entries: Iterable[ExportEntry], fout: IO[bytes]):
+    import markdown2
+    _write_text((str(markdown2.markdown(day)) for day in _markdown_days(entries)), fout)
+
+
+def write_csv(rows: Iterable[Dict], fout: IO[bytes]):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            fout.write(buffer.getvalue().encode("utf8"))
+            buffer.seek(0)
+            buffer.truncate()
+    fout.write(buffer.getvalue().encode("utf8"))
+
+
+def write_jsonl(rows: Iterable[Dict], fout: IO[bytes]):
+    _write_text((
+        json.dumps(dict(row, date=row["date"].isoformat()), ensure_ascii=False) + "\n"
+        for row in rows
+    ), fout)
+
+
+def write_parquet(rows: Iterable[Dict], fout: IO[bytes]):
+    import polars as pl
+    columns: Dict[str, list] = {column: [] for column in COLUMNS}
+    for row in rows:
+        for column in COLUMNS:
+            columns[column].append(row[column])
+    schema = {column: pl.Utf8 for column in COLUMNS}
+    schema["date"] = pl.Date
+    pl.DataFrame(columns, schema=schema).write_parquet(fout)
+
+
+class ExportFormat(NamedTuple):
+    writer: Callable[[Iterable, IO[bytes]], None]
+    # Whether the writer takes rows (see export_row) instead of entries
+    rows: bool
+    # The optional module the writer needs
+    module: Optional[str] = None
+
+
+FORMATS = {
+    "html": ExportFormat(write_html, rows=False, module="markdown2"),
+    "md": ExportFormat(write_markdown, rows=False),
+    "csv": ExportFormat(write_csv, rows=True),
+    "jsonl": ExportFormat(write_jsonl, rows=True),
+    "parquet": ExportFormat(write_parquet, rows=True, module="polars"),
+}
+
+
+def is_available(export_format: str) -> bool:
+    """Whether the format is known and the module it needs is installed."""
+    if export_format not in FORMATS:
+        return False
+    module = FORMATS[export_format].module
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def write_export(export_format: str, entries: Iterable[ExportEntry], fout: IO[bytes],
+                 timezone: tzinfo, user_id) -> int:
+    """Write the entries in a format. Returns the number of entries."""
+    count = 0
+
+    def counted():
+        nonlocal count
+        for entry in entries:
+            count += 1
+            yield entry
+    spec = FORMATS[export_format]
+    if spec.rows:
+        spec.writer((export_row(entry.key, entry.content, timezone, user_id) for entry in counted()), fout)
+    else:
+        spec.writer(counted(), fout)
+    return count
+
+
+def export_filename(name: str, export_format: str, compression: Optional[str]) -> str:
+    """The name of the file sent for an export."""
+    if compression == "zip":
+        return f"{name}.zip"
+    if compression == "gz":
+        return f"{name}.{export_format}.gz"
+    return f"{name}.{export_format}"
+
+
+@contextmanager
+def compressed(fout: IO[bytes], compression: Optional[str], filename: str):
+    """A file object writing `filename` into `fout`, compressed or not."""
+    if compression is None:
+        yield fout
+    elif compression == "gz":
+        with gzip.GzipFile(filename=filename, mode="wb", fileobj=fout) as stream:
+            yield stream
+    elif compression == "zip":
+        with zipfile.ZipFile(fout, "w", zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(filename, "w") as stream:
+                yield stream
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
@@ -0,0 +1,213 @@
+"""Background export jobs
+
+`/export` only validates the request and queues a job; a small dedicated
+thread pool reads the archive, writes the file and uploads it, so a large
+export doesn't hold a dispatcher worker. Each job has an id and a progress
+message that is edited in place (at most every PROGRESS_INTERVAL seconds).
+
+Jobs are bounded twice: a user can have EXPORT_USER_LIMIT jobs queued or
+running, and at most EXPORT_MAX_QUEUED jobs wait for a worker. A job is
+canceled with `/cancel_export [job id]`: a queued job is dropped, a running
+one stops at its next entry, but an upload (see `ExportJob.start_upload`)
+can't be stopped.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from telegram.error import TelegramError
+
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "2"))
+EXPORT_MAX_QUEUED = int(os.environ.get("EXPORT_MAX_QUEUED", "20"))
+EXPORT_USER_LIMIT = int(os.environ.get("EXPORT_USER_LIMIT", "1"))
+PROGRESS_INTERVAL = 5
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ExportCanceled(Exception):
+    pass
+
+
+class ExportRejected(Exception):
+    """The job can't be queued (the message is for the user)."""
+
+
+class ExportJob:
+    def __init__(self, chat_id, user_id, message=None):
+        self.id = uuid.uuid4().hex[:6]
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # The progress message (a telegram.Message)
+        self.message = message
+        self.count = 0
+        self.future: Optional[Future] = None
+        self.uploading = False
+        self._canceled = threading.Event()
+        self._state_lock = threading.Lock()
+        self._last_progress = 0.0
+
+    @property
+    def canceled(self) -> bool:
+        return self._canceled.is_set()
+
+    def cancel(self) -> bool:
+        """Returns False if the job is already uploading its file."""
+        with self._state_lock:
+            if self.uploading:
+                return False
+            self._canceled.set()
+            return True
+
+    def start_upload(self):
+        """Mark the point after which the job can't be canceled.
+
+        Raises ExportCanceled if it was canceled before.
+        """
+        with self._state_lock:
+            if self.canceled:
+                raise ExportCanceled()
+            self.uploading = True
+
+    def progress(self, text: str, force: bool = False):
+        """Edit the progress message, unless it was edited just now."""
+        now = time.monotonic()
+        if self.message is None or (not force and now - self._last_progress < PROGRESS_INTERVAL):
+            return
+        self._last_progress = now
+        try:
+            self.message.edit_text(f"Export {self.id}: {text}")
+        except TelegramError:
+            LOGGER.warning("Failed to update the progress of export %s", self.id, exc_info=True)
+
+    def track(self, entries: Iterable[T]) -> Iterator[T]:
+        """Count the entries as they stream by, stopping if canceled."""
+        for entry in entries:
+            if self.canceled:
+                raise ExportCanceled()
+            self.count += 1
+            self.progress(f"collected {self.count} entries...")
+            yield entry
+
+
+class ExportJobs:
+    def __init__(self, workers: int = EXPORT_WORKERS, max_queued: int = EXPORT_MAX_QUEUED,
+                 user_limit: int = EXPORT_USER_LIMIT):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.user_limit = user_limit
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Queued or running
+        self._jobs: Dict[str, ExportJob] = {}
+        self._queued = 0
+        self._counts = {"completed": 0, "failed": 0, "canceled": 0, "rejected": 0}
+
+    def submit(self, job: ExportJob, run: Callable[[ExportJob], None],
+               announce: Optional[Callable[[ExportJob, int], None]] = None):
+        """Queue a job, raising ExportRejected if the user or the queue is at its limit.
+
+        `announce(job, queued ahead)` is called once the job is accepted and
+        before it can start (e.g., to post its progress message).
+        """
+        with self._lock:
+            if sum(other.user_id == job.user_id for other in self._jobs.values()) >= self.user_limit:
+                self._counts["rejected"] += 1
+                raise ExportRejected(
+                    "You already have an export in progress. "
+                    "Please wait for it to finish or /cancel_export it.")
+            if self._queued >= self.max_queued:
+                self._counts["rejected"] += 1
+                raise ExportRejected("Too many exports are in progress. Please try again later.")
+            ahead = self._queued
+            self._jobs[job.id] = job
+            self._queued += 1
+        try:
+            if announce is not None:
+                announce(job, ahead)
+        except BaseException:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+                self._queued -= 1
+            raise
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="export")
+            job.future = self._executor.submit(self._run, job, run)
+
+    def _finish(self, job: ExportJob, outcome: str):
+        # Caller must hold self._lock
+        self._jobs.pop(job.id, None)
+        self._counts[outcome] += 1
+
+    def _run(self, job: ExportJob, run: Callable[[ExportJob], None]):
+        with self._lock:
+            self._queued -= 1
+        started = time.monotonic()
+        outcome = "completed"
+        try:
+            if job.canceled:
+                raise ExportCanceled()
+            job.progress("collecting entries...", force=True)
+            run(job)
+        except ExportCanceled:
+            outcome = "canceled"
+            job.progress("canceled.", force=True)
+        except Exception:
+            outcome = "failed"
+            LOGGER.exception("Export %s of %s failed", job.id, job.chat_id)
+            job.progress("failed. Please try again later.", force=True)
+        with self._lock:
+            self._finish(job, outcome)
+        LOGGER.info(
+            "Export %s of %s %s (%d entries) in %.1fs",
+            job.id, job.chat_id, outcome, job.count, time.monotonic() - started)
+
+    def cancel(self, user_id, job_id: Optional[str] = None) -> List[ExportJob]:
+        """Cancel the jobs of a user (all of them or one).
+
+        Returns the jobs found; those already uploading (`job.uploading`) go on.
+        """
+        with self._lock:
+            jobs = [
+                job for job in self._jobs.values()
+                if job.user_id == user_id and job_id in (None, job.id)
+            ]
+            for job in jobs:
+                if job.cancel() and job.future is not None and job.future.cancel():
+                    # It never started
+                    self._queued -= 1
+                    self._finish(job, "canceled")
+        for job in jobs:
+            if job.future is not None and job.future.cancelled():
+                job.progress("canceled.", force=True)
+        return jobs
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(
+                self._counts, queued=self._queued, running=len(self._jobs) - self._queued)
+
+    def join(self):
+        """Wait for the queued and running jobs to finish."""
+        with self._lock:
+            futures = [job.future for job in self._jobs.values() if job.future is not None]
+        wait(futures)
+
+    def stop(self):
+        """Cancel all the jobs and shut the workers down."""
+        with self._lock:
+            user_ids = {job.user_id for job in self._jobs.values()}
+            executor, self._executor = self._executor, None
+        for user_id in user_ids:
+            self.cancel(user_id)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+EXPORTS = ExportJobs()
@@ -0,0 +1,282 @@
+"""Bulk import of journal entries from an uploaded file
+
+Supported formats (times are in the user's timezone unless they carry an
+offset, e.g., "2020-01-02T10:00:00+08:00"):
+
++ .txt — one entry per line: "YYYY-MM-DD HH:MM[:SS] content"
++ .csv — a header with a `time` (or `create_time`) column and a `content`
+  column (the output of utility_scripts/convert_export_files_to_csv.py works)
++ .jsonl — one object per line with `time` (or `create_time`) and `content`
+
+The file is parsed as a stream. Entries made since the user's last report go
+to the live entries; older ones go straight into the monthly archive
+documents. Writes are committed in batches of IMPORT_CHUNK entries, and the
+progress message is updated after each batch.
+"""
+import io
+import os
+import csv
+import json
+import re
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta
+from tempfile import TemporaryFile
+from typing import Dict, Iterator, List, Tuple, Union
+
+from telegram.ext import CommandHandler, MessageHandler, Filters, ConversationHandler
+
+from .live import LIVE
+from .export_cache import EXPORT_CACHE
+from .meta import check_config_exists, get_tzinfo, previous_report_time, timestamp_to_user_time
+from .storage import STORAGE
+
+UPLOAD = 0
+# Telegram bots can download files of up to 20 MB
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+IMPORT_MAX_ENTRIES = int(os.environ.get("IMPORT_MAX_ENTRIES", "20000"))
+IMPORT_CHUNK = 500
+# The length limit of a Telegram message
+MAX_ENTRY_LENGTH = 4096
+MAX_REPORTED_ERRORS = 5
+PROGRESS_INTERVAL = 2
+LINE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(?::\d{2})?)\s+(.+)$")
+LOGGER = logging.getLogger(__name__)
+
+# (line number, time, content)
+Record = Tuple[int, str, str]
+
+
+class RecordError(ValueError):
+    pass
+
+
+def _read_text(stream) -> Iterator[Union[Record, RecordError]]:
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        match = LINE_PATTERN.match(line.strip())
+        if match is None:
+            yield RecordError(f"line {line_no}: expected \"YYYY-MM-DD HH:MM content\"")
+            continue
+        yield line_no, match.group(1), match.group(2)
+
+
+def _get_fields(row: Dict, line_no: int) -> Union[Record, RecordError]:
+    timestamp = row.get("time") or row.get("create_time")
+    if not timestamp or not row.get("content"):
+        return RecordError(f"line {line_no}: missing time or content")
+    return line_no, str(timestamp), str(row["content"])
+
+
+def _read_csv(stream) -> Iterator[Union[Record, RecordError]]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield _get_fields(row, reader.line_num)
+
+
+def _read_jsonl(stream) -> Iterator[Union[Record, RecordError]]:
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield RecordError(f"line {line_no}: invalid JSON")
+            continue
+        if not isinstance(row, dict):
+            yield RecordError(f"line {line_no}: expected an object")
+            continue
+        yield _get_fields(row, line_no)
+
+
+READERS = {
+    ".txt": _read_text,
+    ".csv": _read_csv,
+    ".jsonl": _read_jsonl,
+    ".ndjson": _read_jsonl,
+}
+
+
+def parse_records(stream, reader, timezone) -> Iterator[Union[Tuple[int, str], RecordError]]:
+    """Yield a validated (Unix time, content) pair or a RecordError for each record."""
+    tzinfo = get_tzinfo(timezone)
+    now = time.time()
+    for record in reader(stream):
+        if isinstance(record, RecordError):
+            yield record
+            continue
+        line_no, timestamp, content = record
+        content = content.strip()
+        try:
+            user_time = datetime.fromisoformat(timestamp.strip().replace("Z", "+00:00"))
+        except ValueError:
+            yield RecordError(f"line {line_no}: invalid time \"{timestamp}\"")
+            continue
+        if user_time.tzinfo is None:
+            user_time = user_time.replace(tzinfo=tzinfo)
+        seconds = int(user_time.timestamp())
+        if seconds > now:
+            yield RecordError(f"line {line_no}: the time is in the future")
+        elif not content or len(content) > MAX_ENTRY_LENGTH:
+            yield RecordError(f"line {line_no}: the content is empty or too long")
+        else:
+            yield seconds, content
+
+
+def _report_day(seconds: int, metadata: Dict) -> datetime:
+    """The local end of the day whose report covers the entry."""
+    user_time = timestamp_to_user_time(seconds, metadata["timezone"])
+    day = user_time.replace(hour=metadata["end_of_day"], minute=0, second=0, microsecond=0)
+    if user_time.hour >= metadata["end_of_day"]:
+        day += timedelta(days=1)
+    return day
+
+
+class Importer:
+    def __init__(self, chat_id, metadata: Dict):
+        self.chat_id = str(chat_id)
+        self.metadata = metadata
+        # Entries after this go to the live entries
+        previous = previous_report_time(metadata, datetime.utcnow())
+        self.live_after = int((previous - datetime(1970, 1, 1)).total_seconds())
+        # Keeps the keys of this import apart from those of earlier imports
+        self.id = uuid.uuid4().hex[:8]
+        self._seq: Dict[int, int] = {}
+        self.live = 0
+        self.archived = 0
+        self.months = set()
+
+    def _key(self, seconds: int) -> str:
+        # Unique across imports thanks to the import id. The "i" keeps the
+        # keys apart from those of widt.live.new_key ("{seconds}-{microseconds}"),
+        # which they would otherwise overwrite; key_timestamp reads both.
+        seq = self._seq.get(seconds, 0)
+        self._seq[seconds] = seq + 1
+        return f"{seconds}-i{self.id}{seq:06d}"
+
+    def write(self, chunk: List[Tuple[int, str]]):
+        """Write a chunk of entries (counted once they are written)."""
+        live: Dict[str, str] = {}
+        archive: Dict[str, Dict[str, str]] = {}
+        for seconds, content in chunk:
+            key = self._key(seconds)
+            if seconds > self.live_after:
+                live[key] = content
+                continue
+            day = _report_day(seconds, self.metadata)
+            archive.setdefault(day.strftime("%Y%m%d-%H"), {})[key] = content
+        if archive:
+            try:
+                STORAGE.append_archive(self.chat_id, archive)
+            finally:
+                # Even a failed write may have changed some months
+                EXPORT_CACHE.bump((self.chat_id, int(day[:6])) for day in archive)
+            self.archived += sum(len(entries) for entries in archive.values())
+            self.months.update(day[:6] for day in archive)
+        if live:
+            LIVE.write(self.chat_id, live)
+            self.live += len(live)
+
+    def summary(self) -> str:
+        return (
+            f"Imported {self.live + self.archived} entries "
+            f"({self.live} for today, {self.archived} into the archive of {len(self.months)} months)."
+        )
+
+
+def import_start(update, context):
+    if not check_config_exists(update, update.message.chat_id, context.user_data):
+        return ConversationHandler.END
+    update.message.reply_text(
+        "Upload a .txt, .csv or .jsonl file of your entries:\n"
+        "+ .txt — one entry per line: YYYY-MM-DD HH:MM content\n"
+        "+ .csv — columns `time` and `content`\n"
+        "+ .jsonl — objects with `time` and `content`\n"
+        "Times are in your timezone. Use /cancel to stop."
+    )
+    return UPLOAD
+
+
+def import_file(update, context):
+    document = update.message.document
+    extension = os.path.splitext(document.file_name or "")[1].lower()
+    if extension not in READERS:
+        update.message.reply_text("Please upload a .txt, .csv or .jsonl file (or /cancel).")
+        return UPLOAD
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        update.message.reply_text(
+            f"The file is too large (the limit is {IMPORT_MAX_BYTES // 1024 // 1024} MB).")
+        return ConversationHandler.END
+    metadata = context.user_data["metadata"]
+    importer = Importer(update.message.chat_id, metadata)
+    progress = update.message.reply_text("Importing...")
+    try:
+        _import(context, document, extension, metadata, importer, progress)
+    except Exception:
+        LOGGER.exception("Import of %s failed", importer.chat_id)
+        written = importer.live + importer.archived
+        progress.edit_text(
+            f"Sorry, the import failed after {written} entries were written. "
+            "Please try again later.")
+    return ConversationHandler.END
+
+
+def _import(context, document, extension: str, metadata: Dict, importer: Importer, progress):
+    """Read the file into the importer and report the outcome."""
+    errors: List[str] = []
+    n_errors = 0
+    truncated = False
+    last_progress = time.monotonic()
+    with TemporaryFile() as buffer:
+        context.bot.get_file(document.file_id).download(out=buffer)
+        buffer.seek(0)
+        stream = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+        chunk: List[Tuple[int, str]] = []
+        try:
+            for record in parse_records(stream, READERS[extension], metadata["timezone"]):
+                if isinstance(record, RecordError):
+                    n_errors += 1
+                    if len(errors) < MAX_REPORTED_ERRORS:
+                        errors.append(str(record))
+                    continue
+                if importer.live + importer.archived + len(chunk) >= IMPORT_MAX_ENTRIES:
+                    truncated = True
+                    break
+                chunk.append(record)
+                if len(chunk) == IMPORT_CHUNK:
+                    importer.write(chunk)
+                    chunk = []
+                    if time.monotonic() - last_progress > PROGRESS_INTERVAL:
+                        progress.edit_text(f"Importing... {importer.live + importer.archived} entries so far")
+                        last_progress = time.monotonic()
+            if chunk:
+                importer.write(chunk)
+        except (UnicodeDecodeError, csv.Error) as e:
+            n_errors += 1
+            errors.append(f"Stopped reading the file: {e}")
+    LOGGER.info("Import of %s: %s (%d errors)", importer.chat_id, importer.summary(), n_errors)
+    message = importer.summary()
+    if truncated:
+        message += f"\nStopped at the limit of {IMPORT_MAX_ENTRIES} entries."
+    if n_errors:
+        message += f"\nSkipped {n_errors} invalid records:\n" + "\n".join(errors)
+    progress.edit_text(message)
+
+
+def import_cancel(update, context):
+    update.message.reply_text("Roger. Import canceled.")
+    return ConversationHandler.END
+
+
+def add_import_handlers(dp):
+    dp.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("import", import_start)],
+        states={
+            UPLOAD: [MessageHandler(Filters.document, import_file)]
+        },
+        fallbacks=[CommandHandler("cancel", import_cancel)],
+        name="import",
+        persistent=dp.persistence is not None
+    ))
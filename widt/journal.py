@@ -1,75 +1,80 @@
-from datetime import datetime, timedelta
+from typing import List, Optional
 
 from telegram.ext import (
-    Updater, CommandHandler, MessageHandler, Filters,
+    Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters,
     ConversationHandler
 )
-from telegram import ReplyKeyboardMarkup
-from google.cloud import firestore
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from .db import DB
-from .meta import check_config_exists
+from .digest import DIGESTS
+from .live import LIVE, new_key
+from .meta import check_config_exists, timestamp_to_user_time
 
 CONFIRM, SELECT, EDIT = range(3)
-YESNO_MARKUP = ReplyKeyboardMarkup(
-    [["y", "n"]], one_time_keyboard=True, resize_keyboard=True)
-YESNOABORT_MARKUP = ReplyKeyboardMarkup(
-    [["y", "n", "Abort"]], one_time_keyboard=True, resize_keyboard=True)
+# Telegram allows at most 100 buttons in an inline keyboard
+MAX_BUTTONS = 100
+BUTTONS_PER_ROW = 5
+# An /edit menu left alone this long (seconds) ends its conversation
+EDIT_TIMEOUT = 10 * 60
+CANCEL_BUTTON = InlineKeyboardButton("Cancel", callback_data="edit:cancel")
+
+
+def _update_digest(chat_id, context, key: str, item: Optional[str]):
+    """Keep the pre-rendered report lines in sync with the live document."""
+    timezone = context.user_data.get("metadata", {}).get("timezone")
+    if item is None or timezone is None:
+        DIGESTS.remove(chat_id, key)
+    else:
+        DIGESTS.set(chat_id, key, item, timezone)
 
 
 def journal(update, context):
     if not check_config_exists(update, update.message.chat_id, context.user_data):
         return
-    context.chat_data['pending'] = update.message.text
+    # The entry is the quoted message; the buttons identify it by message id
+    message_id = update.message.message_id
     update.message.reply_text(
-        "Please confirm this entry (y/n):\n" + update.message.text,
-        reply_markup=YESNO_MARKUP
+        "Save this entry?",
+        quote=True,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("Save", callback_data=f"journal:save:{message_id}"),
+            InlineKeyboardButton("Discard", callback_data=f"journal:discard:{message_id}")
+        ]])
     )
-    return CONFIRM
 
 
 def journal_confirm(update, context):
-    response = update.message.text.lower()
-    if response not in ("y", "n"):
-        update.message.reply_text(
-            "Please answer **y** or **n**.",
-            reply_markup=YESNO_MARKUP
-        )
-        return CONFIRM
-    if response == "y":
-        DB.collection("live").document(
-            str(update.message.chat_id)
-        ).set(
-            {
-                f"{int(datetime.now().timestamp())}": context.chat_data['pending']
-            },
-            merge=True
-        )
-        update.message.reply_text("Done!")
+    query = update.callback_query
+    _, action, message_id = query.data.split(":")
+    entry = query.message.reply_to_message
+    query.answer()
+    if entry is None or str(entry.message_id) != message_id or not entry.text:
+        query.edit_message_text("Cannot find the entry!")
+        return
+    if action == "save":
+        key = new_key()
+        LIVE.write(query.message.chat_id, {key: entry.text})
+        _update_digest(query.message.chat_id, context, key, entry.text)
+        query.edit_message_text("Saved!")
     else:
-        update.message.reply_text("Canceled!")
-    del context.chat_data["pending"]
-    return ConversationHandler.END
+        query.edit_message_text("Discarded.")
 
 
 def get_live_list(update, context):
-    doc = DB.collection("live").document(str(update.message.chat_id)).get()
-    if doc.exists is False or len(doc.to_dict()) == 0:
+    # Sorted by key (i.e., by time)
+    live = LIVE.entries(update.message.chat_id)
+    if len(live) == 0:
         update.message.reply_text("No entries has yet been logged today!")
         return None, None
-    offset = timedelta(hours=context.user_data["metadata"]["timezone"])
-    entries = sorted(
-        [
-            (
-                datetime.utcfromtimestamp(
-                    int(key)
-                ) + offset,
-                key,
-                item
-            )
-            for key, item in doc.to_dict().items()],
-        key=lambda x: x[0]
-    )
+    timezone = context.user_data["metadata"]["timezone"]
+    entries = [
+        (
+            timestamp_to_user_time(key, timezone),
+            key,
+            item
+        )
+        for key, item in live
+    ]
     formatted = [
         f"{i + 1}. {timestamp.strftime('%H:%M:%S')} — {item[:30]}"
         for i, (timestamp, _, item) in enumerate(entries)
@@ -87,15 +92,31 @@ def list_current(update, context) -> None:
         )
 
 
+def _find_entry(chat_id, key: str) -> Optional[str]:
+    return dict(LIVE.entries(chat_id)).get(key)
+
+
+def _pick_markup(entries: List) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(str(i + 1), callback_data=f"edit:pick:{key}")
+        for i, (_, key, _) in enumerate(entries[:MAX_BUTTONS - 1])
+    ]
+    rows = [
+        buttons[i:i + BUTTONS_PER_ROW]
+        for i in range(0, len(buttons), BUTTONS_PER_ROW)
+    ]
+    return InlineKeyboardMarkup(rows + [[CANCEL_BUTTON]])
+
+
 def edit_list(update, context):
     if not check_config_exists(update, update.message.chat_id, context.user_data):
         return
     entries, formatted = get_live_list(update, context)
     if entries:
-        context.chat_data["entries"] = entries
         update.message.reply_text(
             "(Truncated) Entries so far:\n" + "\n".join(formatted) +
-            f"\n pick one you'd like to edit (1 - {len(entries)})"
+            "\nPick one you'd like to edit",
+            reply_markup=_pick_markup(entries)
         )
         return SELECT
     else:
@@ -103,122 +124,140 @@ def edit_list(update, context):
 
 
 def edit_select(update, context):
-    try:
-        idx = int(update.message.text)
-    except ValueError:
-        update.message.reply_text(
-            "Please input an index (number)!"
-        )
-        return ConversationHandler.END
-    entries = context.chat_data["entries"]
-    if len(entries) < idx or idx < 1:
-        update.message.reply_text(
-            "Cannot find the entry!"
-        )
+    query = update.callback_query
+    key = query.data.split(":", 2)[2]
+    query.answer()
+    item = _find_entry(query.message.chat_id, key)
+    if item is None:
+        query.edit_message_text("Cannot find the entry!")
         return ConversationHandler.END
-    context.chat_data["picked"] = idx - 1
-    update.message.reply_text(
-        "Editing this entry:\n" +
-        entries[idx-1][2] +
-        "\nWrite the new content of this entry, or use /delete to delete the entry"
+    # The only state kept: the entry a new message will replace
+    context.chat_data["editing"] = key
+    query.edit_message_text(
+        "Editing this entry:\n" + item +
+        "\nWrite the new content of this entry, or delete the entry",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("Delete", callback_data=f"edit:delete:{key}"),
+            CANCEL_BUTTON
+        ]])
     )
     return EDIT
 
 
 def edit_op(update, context):
-    context.chat_data["edit"] = update.message.text
-    entries = context.chat_data["entries"]
+    key = context.chat_data["editing"]
+    item = _find_entry(update.message.chat_id, key)
+    if item is None:
+        update.message.reply_text("Cannot find the entry!")
+        del context.chat_data["editing"]
+        return ConversationHandler.END
+    # The new content is the quoted message
     update.message.reply_text(
-        "Replacing this entry (truncated):\n" +
-        entries[context.chat_data["picked"]][2][:30] +
-        "\nwith:\n" +
-        update.message.text +
-        "\nPlease confirm (y/n/Abort)",
-        reply_markup=YESNOABORT_MARKUP
+        "Replacing this entry (truncated):\n" + item[:30] +
+        "\nwith this message?",
+        quote=True,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("Save", callback_data=f"edit:save:{key}"),
+            CANCEL_BUTTON
+        ]])
     )
     return CONFIRM
 
 
 def edit_rm(update, context):
-    context.chat_data["edit"] = firestore.DELETE_FIELD
-    entries = context.chat_data["entries"]
-    update.message.reply_text(
-        "Deleting this entry (truncated):\n" +
-        entries[context.chat_data["picked"]][2][:30] +
-        "\nPlease confirm (y/n/Abort)",
-        reply_markup=YESNOABORT_MARKUP
+    query = update.callback_query
+    key = query.data.split(":", 2)[2]
+    query.answer()
+    item = _find_entry(query.message.chat_id, key)
+    if item is None:
+        query.edit_message_text("Cannot find the entry!")
+        context.chat_data.pop("editing", None)
+        return ConversationHandler.END
+    query.edit_message_text(
+        "Deleting this entry (truncated):\n" + item[:30],
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("Delete", callback_data=f"edit:remove:{key}"),
+            CANCEL_BUTTON
+        ]])
     )
     return CONFIRM
 
 
 def edit_confirm(update, context):
-    response = update.message.text.lower()
-    if response not in ("y", "n", "abort"):
-        update.message.reply_markdown(
-            "Please answer *y*, *n*, or *abort*.",
-            reply_markup=YESNOABORT_MARKUP
-        )
-        return CONFIRM
-    if response == "y":
-        DB.collection("live").document(
-            str(update.message.chat_id)
-        ).update({
-            context.chat_data["entries"][
-                context.chat_data["picked"]
-            ][1]: context.chat_data["edit"]
-        })
-        update.message.reply_text("Done!")
-    elif response == "abort":
-        update.message.reply_text("Roger. Aborted.")
+    query = update.callback_query
+    _, action, key = query.data.split(":", 2)
+    query.answer()
+    if action == "save":
+        entry = query.message.reply_to_message
+        if entry is None or not entry.text:
+            query.edit_message_text("Cannot find the new content!")
+            context.chat_data.pop("editing", None)
+            return ConversationHandler.END
+        value = entry.text
     else:
-        update.message.reply_text(
-            "Write the new content of this entry, or use /delete to delete the entry"
-        )
-        return EDIT
-    del context.chat_data["edit"]
-    del context.chat_data["picked"]
-    del context.chat_data["entries"]
+        value = None
+    LIVE.write(query.message.chat_id, {key: value})
+    _update_digest(query.message.chat_id, context, key, value)
+    query.edit_message_text("Done!")
+    context.chat_data.pop("editing", None)
     return ConversationHandler.END
 
 
+def edit_cancel(update, context):
+    query = update.callback_query
+    query.answer()
+    query.edit_message_text("Roger. Aborted.")
+    context.chat_data.pop("editing", None)
+    return ConversationHandler.END
+
+
+def expired(update, context):
+    """Buttons of a finished (or forgotten, after a restart) conversation."""
+    query = update.callback_query
+    query.answer("This menu has expired.")
+    query.edit_message_reply_markup(reply_markup=None)
+
+
 def add_journal_handlers(dp):
     dp.add_handler(CommandHandler('current', list_current))
 
+    # Tracked per chat rather than per message (PTB warns about the
+    # CallbackQueryHandlers): one /edit menu per chat is what this needs.
+    # /edit restarts an abandoned menu; the timeout can't survive a restart.
     dp.add_handler(ConversationHandler(
         entry_points=[CommandHandler(
             "edit", edit_list, pass_chat_data=True)],
         states={
             SELECT: [
-                MessageHandler(
-                    Filters.text, edit_select,
+                CallbackQueryHandler(
+                    edit_select, pattern="^edit:pick:",
                     pass_chat_data=True)
             ],
             EDIT: [
-                CommandHandler(
-                    "delete", edit_rm,
+                CallbackQueryHandler(
+                    edit_rm, pattern="^edit:delete:",
                     pass_chat_data=True),
                 MessageHandler(
                     Filters.text, edit_op,
                     pass_chat_data=True)
             ],
             CONFIRM: [
-                MessageHandler(
-                    Filters.text, edit_confirm,
+                CallbackQueryHandler(
+                    edit_confirm, pattern="^edit:(save|remove):",
                     pass_chat_data=True)
             ]
         },
-        fallbacks=[]
+        fallbacks=[
+            CallbackQueryHandler(
+                edit_cancel, pattern="^edit:cancel$",
+                pass_chat_data=True)
+        ],
+        allow_reentry=True,
+        conversation_timeout=EDIT_TIMEOUT,
+        name="edit",
+        persistent=dp.persistence is not None
     ))
 
-    dp.add_handler(ConversationHandler(
-        entry_points=[MessageHandler(
-            Filters.text, journal, pass_chat_data=True)],
-        states={
-            CONFIRM: [
-                MessageHandler(
-                    Filters.text, journal_confirm,
-                    pass_chat_data=True)
-            ]
-        },
-        fallbacks=[]
-    ))
+    dp.add_handler(CallbackQueryHandler(journal_confirm, pattern="^journal:"))
+    dp.add_handler(CallbackQueryHandler(expired, pattern="^edit:"))
+    dp.add_handler(MessageHandler(Filters.text, journal))
@@ -0,0 +1,265 @@
+"""Access to the live (not yet archived) journal entries
+
+Keys of entries are "{seconds}-{microseconds}" strings (see `new_key`), which
+are unique and sort by time; entries made before that format have plain
+seconds as keys. They are stored through `widt.storage.STORAGE` (see
+`FirestoreStorage` for the Firestore layout).
+
+Entries are written with `LIVE.write`. By default every write goes straight
+to the storage. With LIVE_WRITE_BEHIND enabled, writes are acknowledged once
+they are appended to a local journal file. They are coalesced per chat and
+flushed to the storage in batched writes every FLUSH_INTERVAL seconds, or
+sooner once FLUSH_SIZE fields are pending. The journal is replayed on
+startup, so unflushed writes survive a crash. Reads overlay the pending
+writes on the stored entries, and `LIVE.collect` flushes before the report
+job archives the entries.
+
+`LIVE.entries` reads through a per-chat LRU cache of the sorted entries. The
+bot is the only writer of the live entries, so writes update the cached
+entries in place and archiving invalidates them.
+"""
+import os
+import json
+import logging
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .storage import STORAGE, new_key, key_timestamp, is_legacy_key  # noqa: F401
+
+WRITE_BEHIND = os.environ.get("LIVE_WRITE_BEHIND", "") not in ("", "0")
+JOURNAL_PATH = os.environ.get("LIVE_JOURNAL_PATH", "live.journal")
+FLUSH_INTERVAL = float(os.environ.get("LIVE_FLUSH_INTERVAL", "2"))
+FLUSH_SIZE = int(os.environ.get("LIVE_FLUSH_SIZE", "200"))
+# Chats whose entries are cached (least recently used are dropped)
+CACHE_SIZE = int(os.environ.get("LIVE_CACHE_SIZE", "1000"))
+LOGGER = logging.getLogger(__name__)
+
+
+class LiveStore:
+    def __init__(
+            self, write_behind: bool = WRITE_BEHIND, journal_path: str = JOURNAL_PATH,
+            cache_size: int = CACHE_SIZE):
+        self.write_behind = write_behind
+        self.journal_path = journal_path
+        self.cache_size = cache_size
+        # chat_id -> [(entry key, content)] sorted by key
+        self._cache: Dict[str, List[Tuple[str, str]]] = OrderedDict()
+        # Bumped on every change, so a read racing with a write isn't cached
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        # chat_id -> {entry key: content or None (deleted)}
+        self._pending: Dict[str, Dict] = {}
+        self._pending_fields = 0
+        self._lock = threading.Lock()
+        # Serializes flushes (the flusher thread and the report workers)
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _record(chat_id: str, fields: Dict) -> str:
+        return json.dumps({
+            "chat_id": chat_id,
+            "fields": fields
+        }) + "\n"
+
+    def _append(self, chat_id: str, fields: Dict):
+        # Caller must hold self._lock
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a")
+        self._journal.write(self._record(chat_id, fields))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _merge(self, chat_id: str, fields: Dict):
+        # Caller must hold self._lock
+        if not fields:
+            return
+        pending = self._pending.setdefault(chat_id, {})
+        for key, value in fields.items():
+            if key not in pending:
+                self._pending_fields += 1
+            pending[key] = value
+
+    def _update_cache(self, chat_id: str, fields: Dict):
+        # Caller must hold self._lock
+        self._version += 1
+        entries = self._cache.get(chat_id)
+        if entries is None:
+            return
+        for key, value in fields.items():
+            i = bisect.bisect_left(entries, (key,))
+            found = i < len(entries) and entries[i][0] == key
+            if value is None:
+                if found:
+                    del entries[i]
+            elif found:
+                entries[i] = (key, value)
+            else:
+                entries.insert(i, (key, value))
+
+    def write(self, chat_id, fields: Dict):
+        """Set (or delete, with None) entries of a chat."""
+        if not self.write_behind:
+            if STORAGE.write_live({str(chat_id): fields}):
+                raise RuntimeError(f"Failed to write the entries of {chat_id}")
+            with self._lock:
+                self._update_cache(str(chat_id), fields)
+            return
+        with self._lock:
+            self._append(str(chat_id), fields)
+            self._merge(str(chat_id), fields)
+            self._update_cache(str(chat_id), fields)
+            if self._pending_fields >= FLUSH_SIZE:
+                self._wakeup.set()
+
+    def entries(self, chat_id) -> List[Tuple[str, str]]:
+        """The (key, content) entries of a chat sorted by key, including the
+        writes not flushed yet."""
+        chat_id = str(chat_id)
+        with self._lock:
+            if chat_id in self._cache:
+                self._cache.move_to_end(chat_id)
+                self.hits += 1
+                return list(self._cache[chat_id])
+            self.misses += 1
+            version = self._version
+        # Holding the flush lock, no pending write can be in the middle of
+        # moving to the document
+        with self._flush_lock:
+            data = STORAGE.read_live(chat_id)
+            with self._lock:
+                pending = dict(self._pending.get(chat_id, {}))
+        with self._lock:
+            for key, value in pending.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            entries = sorted(data.items())
+            if version == self._version:
+                self._cache[chat_id] = entries
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return list(entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+                "pending": self._pending_fields
+            }
+
+    def invalidate(self, chat_ids: Iterable):
+        with self._lock:
+            self._version += 1
+            for chat_id in chat_ids:
+                self._cache.pop(str(chat_id), None)
+
+    def flush(self, chat_ids: Optional[Iterable] = None):
+        """Write the pending writes (of the given chats) to the storage."""
+        with self._flush_lock:
+            with self._lock:
+                if chat_ids is None:
+                    chat_ids = list(self._pending)
+                pending = {
+                    str(chat_id): self._pending.pop(str(chat_id))
+                    for chat_id in chat_ids if str(chat_id) in self._pending
+                }
+                self._pending_fields -= sum(len(fields) for fields in pending.values())
+            if not pending:
+                return
+            try:
+                failed = STORAGE.write_live(pending)
+            except Exception:
+                failed = list(pending)
+                raise
+            finally:
+                with self._lock:
+                    for chat_id in failed:
+                        # Newer writes win
+                        self._merge(chat_id, {
+                            key: value for key, value in pending[chat_id].items()
+                            if key not in self._pending.get(chat_id, {})
+                        })
+                    self._compact()
+            if failed:
+                raise RuntimeError(f"Failed to flush the live entries of {len(failed)} chats")
+            LOGGER.debug("Flushed the live entries of %d chats", len(pending))
+
+    def collect(self, chat_ids: List, until: int) -> Dict[str, Dict[str, str]]:
+        """Read the entries of chats to be archived.
+
+        Only the entries made at or before `until` (Unix time) are collected,
+        so the entries made while the report is being made stay for the next
+        day.
+        """
+        self.flush(chat_ids)
+        return STORAGE.collect_live(chat_ids, until)
+
+    def _compact(self):
+        """Rewrite the journal with only the writes still pending."""
+        # Caller must hold self._lock (and self._flush_lock)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not self._pending:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return
+        tmp_path = self.journal_path + ".tmp"
+        self._journal = open(tmp_path, "w")
+        for chat_id, fields in self._pending.items():
+            self._journal.write(self._record(chat_id, fields))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def recover(self):
+        """Load the writes left in the journal by the previous run."""
+        if not os.path.exists(self.journal_path):
+            return
+        with self._lock:
+            with open(self.journal_path) as fin:
+                for line in fin:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A write interrupted by the crash
+                        continue
+                    self._merge(record["chat_id"], record["fields"])
+        LOGGER.info("Recovered %d unflushed live entries", self._pending_fields)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                LOGGER.exception("Failed to flush the live entries")
+
+    def start(self):
+        if not self.write_behind or self._thread is not None:
+            return
+        self.recover()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="live-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.write_behind:
+            self.flush()
+
+
+LIVE = LiveStore()
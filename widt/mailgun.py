@@ -0,0 +1,106 @@
+"""A shared Mailgun client
+
+All emails go through one `requests.Session`, so connections to the API are
+pooled and kept alive instead of paying for a new TCP/TLS handshake per email.
+Requests have connect/read timeouts and are retried with exponential backoff
+on connection errors, timeouts, 429 and 5xx responses.
+"""
+import os
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Optional
+
+from retrying import Retrying, RetryError
+
+if TYPE_CHECKING:
+    import requests
+
+MAILGUN_DOMAIN = os.environ.get("MG_DOMAIN", "")
+MAILGUN_API_KEY = os.environ.get("MG_KEY", "")
+# Can be pointed to a local stand-in of the Mailgun API
+MAILGUN_API_BASE = os.environ.get("MG_API_BASE", "https://api.mailgun.net/v3")
+SENDER = f"What I Did Today <bot@{MAILGUN_DOMAIN}>"
+CONNECT_TIMEOUT = float(os.environ.get("MG_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.environ.get("MG_READ_TIMEOUT", "15"))
+POOL_SIZE = int(os.environ.get("MG_POOL_SIZE", "10"))
+MAX_ATTEMPTS = int(os.environ.get("MG_MAX_ATTEMPTS", "4"))
+# The first retry waits 2 * BACKOFF_MS, the second 4 * BACKOFF_MS, ...
+BACKOFF_MS = int(os.environ.get("MG_BACKOFF_MS", "500"))
+MAX_BACKOFF_MS = 10000
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+LOGGER = logging.getLogger(__name__)
+
+_SESSION: Optional["requests.Session"] = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session() -> "requests.Session":
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            # requests is imported with the first email, not at startup
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+    return _SESSION
+
+
+def is_configured() -> bool:
+    if MAILGUN_DOMAIN == "" or MAILGUN_API_KEY == "":
+        LOGGER.warning(
+            "MAILGUN_DOMAIN and/or MAILGUN_API_KEY environment "
+            "variable is not set! Skipping emailing...")
+        return False
+    return True
+
+
+def _should_retry_response(res: "requests.Response") -> bool:
+    return res.status_code in RETRY_STATUS_CODES
+
+
+def _should_retry_exception(exc: Exception) -> bool:
+    import requests
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def _post(url: str, data: Dict) -> "requests.Response":
+    return get_session().post(
+        url,
+        auth=("api", MAILGUN_API_KEY),
+        data=data,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+    )
+
+
+def send_message(data: Dict) -> Optional["requests.Response"]:
+    """Send a message through the Mailgun messages API.
+
+    `data` holds the form fields of the API call. The "from" field defaults to
+    the bot's address. Returns the final response, or None if Mailgun is not
+    configured or the request could not be completed.
+    """
+    if not is_configured():
+        return None
+    import requests
+    data = dict(data)
+    data.setdefault("from", SENDER)
+    retrying = Retrying(
+        stop_max_attempt_number=MAX_ATTEMPTS,
+        wait_exponential_multiplier=BACKOFF_MS,
+        wait_exponential_max=MAX_BACKOFF_MS,
+        retry_on_result=_should_retry_response,
+        retry_on_exception=_should_retry_exception
+    )
+    try:
+        return retrying.call(
+            _post, f"{MAILGUN_API_BASE}/{MAILGUN_DOMAIN}/messages", data)
+    except RetryError as e:
+        # Ran out of attempts on a retryable status code
+        return e.last_attempt.value
+    except requests.RequestException:
+        LOGGER.exception("Failed to reach the Mailgun API")
+        return None
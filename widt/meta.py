@@ -1,17 +1,85 @@
-from typing import Dict
-from .db import DB
+from datetime import datetime, timedelta, timezone as dt_timezone, tzinfo
+from typing import Dict, Optional, Union
+from zoneinfo import ZoneInfo
+
+from .storage import key_timestamp
+from .meta_cache import META_CACHE
+
+# A timezone is either an IANA name (e.g., "America/New_York") or, for
+# configs made before IANA names were supported, an integer UTC offset
+Timezone = Union[str, int]
+
+
+def get_tzinfo(timezone: Timezone) -> tzinfo:
+    if isinstance(timezone, str):
+        return ZoneInfo(timezone)
+    return dt_timezone(timedelta(hours=timezone))
+
+
+def to_user_time(utc_time: datetime, timezone: Timezone) -> datetime:
+    """Convert a naive UTC datetime to the naive local time of the user."""
+    return utc_time.replace(tzinfo=dt_timezone.utc).astimezone(
+        get_tzinfo(timezone)).replace(tzinfo=None)
+
+
+def timestamp_to_user_time(timestamp, timezone: Timezone) -> datetime:
+    """Convert a Unix timestamp (or an entry key) to the user's local time."""
+    return to_user_time(datetime.utcfromtimestamp(key_timestamp(timestamp)), timezone)
+
+
+def _report_time(timezone, end_of_day: int, day) -> datetime:
+    """The report instant (naive UTC) of a local calendar day."""
+    local = datetime(day.year, day.month, day.day, end_of_day, tzinfo=get_tzinfo(timezone))
+    return local.astimezone(dt_timezone.utc).replace(tzinfo=None)
+
+
+def next_report_time(metadata: Dict, after: datetime) -> datetime:
+    """The first report instant (naive UTC) strictly after `after` (naive UTC)."""
+    today = to_user_time(after, metadata["timezone"]).date()
+    for days in range(3):
+        candidate = _report_time(
+            metadata["timezone"], metadata["end_of_day"], today + timedelta(days=days))
+        if candidate > after:
+            return candidate
+    raise ValueError("Failed to find the next report time")
+
+
+def previous_report_time(metadata: Dict, before: datetime) -> datetime:
+    """The last report instant (naive UTC) at or before `before` (naive UTC)."""
+    today = to_user_time(before, metadata["timezone"]).date()
+    for days in range(3):
+        candidate = _report_time(
+            metadata["timezone"], metadata["end_of_day"], today - timedelta(days=days))
+        if candidate <= before:
+            return candidate
+    raise ValueError("Failed to find the previous report time")
+
+
+def get_report_hour(timezone: Timezone, end_of_day: int, after: Optional[datetime] = None) -> int:
+    """Return the UTC hour in which the user's next day ends (after `after`,
+    a naive UTC datetime; now by default).
+
+    For IANA timezones this depends on the UTC offset on that day, so it
+    changes with daylight saving time; the reports refresh it (see
+    `widt.reporting._checkpoint_reports`).
+    """
+    if isinstance(timezone, str):
+        user_time = to_user_time(after or datetime.utcnow(), timezone)
+        day_end = user_time.replace(hour=end_of_day, minute=0, second=0, microsecond=0)
+        if day_end <= user_time:
+            day_end += timedelta(days=1)
+        offset = get_tzinfo(timezone).utcoffset(day_end)
+        return int((timedelta(hours=end_of_day) - offset).total_seconds() // 3600) % 24
+    return (end_of_day - timezone) % 24
 
 
 def _get_user_meta(chat_id, user_data, update_cache: bool = False):
-    if update_cache is True or "metadata" not in user_data:
-        doc = DB.collection("meta").document(str(chat_id)).get()
-        metadata: Dict = {}
-        if doc.exists:
-            metadata = doc.to_dict()
-            if "timezone" not in metadata or "end_of_day" not in metadata:
-                metadata = {}
-        user_data["metadata"] = metadata
-    return user_data["metadata"]
+    """Load the user's config (a copy from META_CACHE) into user_data."""
+    metadata: Dict = META_CACHE.get(chat_id, refresh=update_cache)
+    if "timezone" not in metadata or "end_of_day" not in metadata:
+        metadata = {}
+    user_data["metadata"] = metadata
+    return metadata
 
 
 def check_config_exists(update, chat_id, user_data, update_cache: bool = False):
@@ -0,0 +1,120 @@
+"""A process-wide cache of the `meta` documents (user configs)
+
+Handlers, the scheduler and the report job read user configs through
+META_CACHE. Entries expire after META_CACHE_TTL seconds and the least
+recently used ones are dropped beyond META_CACHE_SIZE. The bot writes configs
+through `update` (write-through), so the cache stays consistent without
+rereading; the TTL bounds the staleness of changes made elsewhere (e.g., by
+the utility scripts).
+
+The returned dicts are copies, so callers can modify them freely.
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from .storage import STORAGE
+
+META_CACHE_TTL = float(os.environ.get("META_CACHE_TTL", "3600"))
+META_CACHE_SIZE = int(os.environ.get("META_CACHE_SIZE", "10000"))
+LOGGER = logging.getLogger(__name__)
+
+
+class MetaCache:
+    def __init__(self, ttl: float = META_CACHE_TTL, max_size: int = META_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # chat_id -> (expires at, document data ({} if missing))
+        self._data: Dict[str, Tuple[float, Dict]] = OrderedDict()
+        # Bumped on every write, so a read racing with a write isn't cached
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, chat_id: str):
+        # Caller must hold self._lock
+        entry = self._data.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._data.move_to_end(chat_id)
+        self.hits += 1
+        return dict(entry[1])
+
+    def _store(self, chat_id: str, data: Dict, since: Optional[int]):
+        # Caller must hold self._lock
+        if since is not None and since != self.version:
+            return
+        self._data[chat_id] = (time.monotonic() + self.ttl, dict(data))
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, chat_id, refresh: bool = False) -> Dict:
+        """The config of a chat ({} if there is none)."""
+        chat_id = str(chat_id)
+        with self._lock:
+            if not refresh:
+                data = self._lookup(chat_id)
+                if data is not None:
+                    return data
+            since = self.version
+        data = STORAGE.get_meta(chat_id) or {}
+        self.put(chat_id, data, since)
+        return dict(data)
+
+    def get_many(self, chat_ids: Iterable) -> Dict[str, Dict]:
+        """The configs of several chats (the misses are read in one round trip)."""
+        results, missing = {}, []
+        with self._lock:
+            for chat_id in map(str, chat_ids):
+                data = self._lookup(chat_id)
+                if data is None:
+                    missing.append(chat_id)
+                else:
+                    results[chat_id] = data
+            since = self.version
+        if missing:
+            for chat_id, data in STORAGE.get_metas(missing).items():
+                data = data or {}
+                self.put(chat_id, data, since)
+                results[chat_id] = dict(data)
+        return results
+
+    def put(self, chat_id, data: Dict, since: Optional[int] = None):
+        """Cache a config read elsewhere (e.g., by a query).
+
+        If `since` (the `version` before the read) is given, the config is
+        only cached if nothing was written in the meantime.
+        """
+        with self._lock:
+            self._store(str(chat_id), data, since)
+
+    def update(self, chat_id, fields: Dict):
+        """Write the fields to the storage (merged) and to the cache."""
+        STORAGE.put_meta(chat_id, fields)
+        self.update_cached(chat_id, fields)
+
+    def update_cached(self, chat_id, fields: Dict):
+        """Apply fields already written to the storage (e.g., by archiving)."""
+        with self._lock:
+            self.version += 1
+            entry = self._data.get(str(chat_id))
+            if entry is not None:
+                self._data[str(chat_id)] = (entry[0], dict(entry[1], **fields))
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self.version += 1
+            self._data.pop(str(chat_id), None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"cached": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+META_CACHE = MetaCache()
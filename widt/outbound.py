@@ -0,0 +1,305 @@
+"""Rate limiting of outbound Telegram messages
+
+Telegram allows roughly 30 messages per second overall and about one message
+per second in a chat. Outgoing messages go on a queue served by a scheduler
+thread and OUTBOUND_WORKERS sender threads, so no handler (and not the
+dispatcher thread) ever waits for a token. A message is sent once a token is
+available from a global bucket and from its chat's bucket; the messages of a
+chat go out one at a time, in order. Interactive replies get the global
+tokens before bulk messages (the end-of-day reports), but a reply held back
+only by its own chat's bucket doesn't hold up the bulk messages. A
+RetryAfter error makes the chat wait for the time Telegram asked before the
+message is retried.
+
+`QueuedBot` routes the bot's sending methods through the queue, so handlers
+keep calling `reply_text` / `send_message` as usual; they get a
+`PendingMessage` back at once. Code sending bulk messages wraps the calls in
+`with bulk():` and waits for them to be sent.
+"""
+import os
+import time
+import logging
+import threading
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+# Threads making the requests to Telegram
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", "4"))
+# Short bursts in a chat are fine (e.g., two replies to one command)
+CHAT_BURST = 3
+# Per-chat buckets kept in memory (least recently used are dropped)
+MAX_CHATS = 10000
+MAX_RETRIES = 3
+INTERACTIVE, BULK = 0, 1
+LOGGER = logging.getLogger(__name__)
+
+_PRIORITY = threading.local()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait until a token is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Request:
+    def __init__(self, chat_id, func, args, kwargs, priority: int, seq: int):
+        self.key = str(chat_id)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.queued = time.monotonic()
+        self.future: Future = Future()
+
+
+class Limiter:
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 workers: int = OUTBOUND_WORKERS):
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[str, TokenBucket] = OrderedDict()
+        # The queued messages of each chat, in order
+        self._queues: Dict[str, Deque[_Request]] = {}
+        # Chats with a message being sent
+        self._sending: Set[str] = set()
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.sent = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _chat_bucket(self, key: str) -> TokenBucket:
+        # Caller must hold self._cond
+        bucket = self._chats.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, CHAT_BURST)
+            self._chats[key] = bucket
+            if len(self._chats) > MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        return bucket
+
+    def submit(self, chat_id, func, *args, priority: int = INTERACTIVE, **kwargs) -> Future:
+        """Queue a request to a chat; returns at once with its Future."""
+        request = _Request(chat_id, func, args, kwargs, priority, next(self._seq))
+        with self._cond:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="outbound")
+                self._thread = threading.Thread(
+                    target=self._run, name="outbound-scheduler", daemon=True)
+                self._thread.start()
+            self._queues.setdefault(request.key, deque()).append(request)
+            self._cond.notify_all()
+        return request.future
+
+    def call(self, chat_id, func, *args, priority: int = INTERACTIVE, **kwargs):
+        """Queue a request and wait for its outcome."""
+        return self.submit(chat_id, func, *args, priority=priority, **kwargs).result()
+
+    def _next(self, now: float) -> Tuple[Optional[_Request], Optional[float]]:
+        """The request to send now, or the seconds to wait for one (None: until notified)."""
+        # Caller must hold self._cond
+        ready: List[_Request] = []
+        wait = None
+        for key, queue in self._queues.items():
+            if key in self._sending:
+                continue
+            delay = self._chat_bucket(key).delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            ready.append(queue[0])
+        if not ready:
+            return None, wait
+        # Only the messages ready in their chats compete for the global token
+        delay = self._global.delay(now)
+        if delay > 0:
+            return None, delay if wait is None else min(wait, delay)
+        return min(ready, key=lambda request: (request.priority, request.seq)), 0
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                request, wait = self._next(now)
+                if request is None:
+                    self._cond.wait(wait)
+                    continue
+                queue = self._queues[request.key]
+                queue.popleft()
+                if not queue:
+                    del self._queues[request.key]
+                self._global.take()
+                self._chat_bucket(request.key).take()
+                self._sending.add(request.key)
+                waited = now - request.queued
+                self.sent += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+                self._executor.submit(self._send, request)
+
+    def _send(self, request: _Request):
+        retry_after = None
+        try:
+            result = request.func(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            if request.attempts == MAX_RETRIES:
+                request.future.set_exception(e)
+            else:
+                LOGGER.warning(
+                    "Flood control on chat %s: retrying in %.1f seconds", request.key, e.retry_after)
+                retry_after = e.retry_after
+        except Exception as e:
+            request.future.set_exception(e)
+        else:
+            request.future.set_result(result)
+        with self._cond:
+            self._sending.discard(request.key)
+            if retry_after is not None:
+                request.attempts += 1
+                self._block(request.key, retry_after)
+                # Still the first message of its chat
+                self._queues.setdefault(request.key, deque()).appendleft(request)
+            self._cond.notify_all()
+
+    def _block(self, key: str, seconds: float):
+        # Caller must hold self._cond
+        bucket = self._chat_bucket(key)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+        self.retries += 1
+
+    def block(self, chat_id, seconds: float):
+        with self._cond:
+            self._block(str(chat_id), seconds)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            queued = [request for queue in self._queues.values() for request in queue]
+            return {
+                "queue_depth": len(queued),
+                "queue_depth_bulk": sum(request.priority == BULK for request in queued),
+                "sent": self.sent,
+                "retries": self.retries,
+                "mean_wait": self.total_wait / self.sent if self.sent else 0.0,
+                "max_wait": self.max_wait
+            }
+
+
+LIMITER = Limiter()
+
+
+def current_priority() -> int:
+    return getattr(_PRIORITY, "value", INTERACTIVE)
+
+
+@contextmanager
+def bulk():
+    """Mark the messages sent by this thread inside the block as bulk."""
+    previous = current_priority()
+    _PRIORITY.value = BULK
+    try:
+        yield
+    finally:
+        _PRIORITY.value = previous
+
+
+class PendingMessage:
+    """The outcome of a queued request (usually a Message) once it's sent.
+
+    Reading an attribute waits for it, but `edit_text` is queued after the
+    message is sent without waiting.
+    """
+
+    def __init__(self, future: Future):
+        self.future = future
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future: Future):
+        if future.exception() is not None:
+            LOGGER.warning("Failed to send a message", exc_info=future.exception())
+
+    def result(self, timeout: Optional[float] = None):
+        return self.future.result(timeout)
+
+    def edit_text(self, *args, **kwargs) -> "PendingMessage":
+        edited: Future = Future()
+
+        def forward(future: Future):
+            if future.exception() is not None:
+                edited.set_exception(future.exception())
+            else:
+                edited.set_result(future.result())
+
+        def edit(future: Future):
+            try:
+                pending = future.result().edit_text(*args, **kwargs)
+            except Exception as e:
+                edited.set_exception(e)
+                return
+            if isinstance(pending, PendingMessage):
+                pending.future.add_done_callback(forward)
+            else:
+                edited.set_result(pending)
+        self.future.add_done_callback(edit)
+        return PendingMessage(edited)
+
+    def __getattr__(self, name):
+        return getattr(self.future.result(), name)
+
+
+class QueuedBot(Bot):
+    """A Bot that sends messages through the shared outbound queue.
+
+    Interactive sends return a PendingMessage at once; bulk sends wait for
+    the outcome (they run on the report workers).
+    """
+
+    def _queue(self, chat_id, func, *args, **kwargs):
+        priority = current_priority()
+        future = LIMITER.submit(chat_id, func, *args, priority=priority, **kwargs)
+        if priority == BULK:
+            return future.result()
+        return PendingMessage(future)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._queue(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._queue(chat_id, super().send_document, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        chat_id = kwargs.get("chat_id")
+        if chat_id is None and kwargs.get("inline_message_id") is None and len(args) > 1:
+            chat_id = args[1]
+        return self._queue(chat_id, super().edit_message_text, *args, **kwargs)
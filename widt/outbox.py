@@ -0,0 +1,232 @@
+"""A durable local outbox for report emails
+
+The report job only writes emails into a SQLite database. A background thread
+delivers them through Mailgun at a limited rate and retries failures with
+exponential backoff, so the job's latency does not depend on the email
+provider and a failed send is not lost. An email is identified by
+(chat_id, date), so the same day's report is never queued twice.
+
+Due emails sharing a template are delivered with Mailgun batch calls (see
+`widt.emails`), so a report wave costs one API call per
+MAX_BATCH_RECIPIENTS recipients instead of one per user.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from .mailgun import send_message
+from .emails import MAX_BATCH_RECIPIENTS, build_batch, build_single, is_batchable
+
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", "outbox.sqlite")
+# Maximum number of Mailgun API calls per second
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", "5"))
+MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+# The n-th retry waits RETRY_DELAY * 2 ** (n - 1) seconds
+RETRY_DELAY = 30
+POLL_INTERVAL = 10
+# Wait for this many seconds without new emails before sending, so a report
+# wave is gathered into batch calls
+BATCH_WINDOW = 2
+# Delivered emails are kept this long to deduplicate late enqueues
+KEEP_SENT = 7 * 24 * 3600
+LOGGER = logging.getLogger(__name__)
+
+PENDING, SENT, FAILED = "pending", "sent", "failed"
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        chat_id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (chat_id, date)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)"
+)
+
+
+class Outbox:
+    def __init__(self, path: str, rate: float = OUTBOX_RATE):
+        self.path = path
+        self.rate = rate
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_enqueue = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller must hold self._lock
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, chat_id, date: str, payload: Dict) -> bool:
+        """Queue an email. Returns False if (chat_id, date) is already queued."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO outbox "
+                "(chat_id, date, payload, next_attempt, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(chat_id), date, json.dumps(payload), now, now)
+            )
+            conn.commit()
+        self._last_enqueue = time.monotonic()
+        self._wakeup.set()
+        return cursor.rowcount == 1
+
+    def _due(self, limit: int) -> List[Tuple[str, str, str, int]]:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT chat_id, date, payload, attempts FROM outbox "
+                "WHERE status = ? AND next_attempt <= ? "
+                "ORDER BY next_attempt LIMIT ?",
+                (PENDING, time.time(), limit)
+            ).fetchall()
+
+    def _update(self, chat_id: str, date: str, status: str, attempts: int, next_attempt: float):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, "
+                "updated_at = ? WHERE chat_id = ? AND date = ?",
+                (status, attempts, next_attempt, time.time(), chat_id, date)
+            )
+            conn.commit()
+
+    def _deliver(self, rows: List[Tuple[str, str, str, int]], data: Dict) -> int:
+        """Send one API call covering `rows` and record the outcome."""
+        res = send_message(data)
+        keys = [f"{chat_id}/{date}" for chat_id, date, _, _ in rows]
+        if res is not None and res.status_code == 200:
+            LOGGER.info("Report email delivered: %s", keys)
+            for chat_id, date, _, attempts in rows:
+                self._update(chat_id, date, SENT, attempts + 1, 0)
+            return len(rows)
+        if res is not None:
+            LOGGER.error("Report email: %s %d %s", keys, res.status_code, res.text)
+        permanent = res is not None and 400 <= res.status_code < 500 and res.status_code != 429
+        for chat_id, date, _, attempts in rows:
+            attempts += 1
+            if permanent or attempts >= MAX_ATTEMPTS:
+                LOGGER.error("Giving up on the report email of %s %s", chat_id, date)
+                self._update(chat_id, date, FAILED, attempts, 0)
+            else:
+                self._update(
+                    chat_id, date, PENDING, attempts,
+                    time.time() + RETRY_DELAY * 2 ** (attempts - 1))
+        return 0
+
+    def _calls(self, rows: List[Tuple[str, str, str, int]]):
+        """Group due emails into API calls. Yields (rows, form data) pairs."""
+        groups = defaultdict(list)
+        for row in rows:
+            payload = json.loads(row[2])
+            if "template" not in payload:
+                # Already rendered (e.g., queued by an older version)
+                yield [row], payload
+                continue
+            groups[payload["template"]].append((row, payload))
+        for template, items in groups.items():
+            batch, recipients = [], set()
+            for row, payload in items:
+                # Recipient variables are keyed by address, so an address
+                # shared by several chats can only appear once in a batch
+                if is_batchable(payload) and payload["to"] not in recipients:
+                    batch.append((row, payload))
+                    recipients.add(payload["to"])
+                else:
+                    yield [row], build_single(payload)
+            for i in range(0, len(batch), MAX_BATCH_RECIPIENTS):
+                chunk = batch[i:i + MAX_BATCH_RECIPIENTS]
+                if len(chunk) == 1:
+                    yield [chunk[0][0]], build_single(chunk[0][1])
+                else:
+                    yield (
+                        [row for row, _ in chunk],
+                        build_batch(template, [payload for _, payload in chunk])
+                    )
+
+    def drain_once(self, limit: int = MAX_BATCH_RECIPIENTS) -> int:
+        """Try to deliver the due emails. Returns the number delivered."""
+        delivered = 0
+        for rows, data in self._calls(self._due(limit)):
+            if self._stopped.is_set():
+                break
+            started = time.monotonic()
+            try:
+                delivered += self._deliver(rows, data)
+            except Exception:
+                LOGGER.exception(
+                    "Failed to deliver the report emails of %s",
+                    [f"{chat_id}/{date}" for chat_id, date, _, _ in rows])
+            if self.rate > 0:
+                time.sleep(max(0, 1 / self.rate - (time.monotonic() - started)))
+        return delivered
+
+    def prune(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "DELETE FROM outbox WHERE status != ? AND updated_at < ?",
+                (PENDING, time.time() - KEEP_SENT)
+            )
+            conn.commit()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+
+    def _run(self):
+        self.prune()
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            quiet = time.monotonic() - self._last_enqueue
+            if quiet < BATCH_WINDOW:
+                self._stopped.wait(BATCH_WINDOW - quiet)
+                continue
+            try:
+                if self.drain_once():
+                    # More emails might be due
+                    continue
+            except Exception:
+                LOGGER.exception("Outbox sender failed")
+            self._wakeup.wait(POLL_INTERVAL)
+
+    def start(self):
+        if self._thread is None:
+            LOGGER.info("Outbox has %d pending emails", self.pending_count())
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="outbox-sender", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+OUTBOX = Outbox(OUTBOX_PATH)
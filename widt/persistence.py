@@ -0,0 +1,179 @@
+"""SQLite persistence of user_data, chat_data and conversation states
+
+The dispatcher keeps its state in memory; this backend saves it, so a deploy
+doesn't drop the conversations in progress (e.g., a half-done /config or
+/edit). Each user, chat and conversation is a row holding a pickled value:
+
++ Rows are loaded lazily, when the dispatcher first touches a user or a chat,
+  so startup doesn't read the whole table. Conversation states (only the
+  unfinished ones are stored) are loaded when their handler is registered.
++ Updates only mark rows dirty (a snapshot is taken at update time, so later
+  changes by the handlers can't race with the flush). The dirty rows are
+  written in one transaction every STATE_FLUSH_INTERVAL seconds and when the
+  bot stops.
+
+Set STATE_PATH to an empty string to disable persistence.
+"""
+import os
+import json
+import pickle
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence
+
+STATE_PATH = os.environ.get("STATE_PATH", "state.sqlite")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "30"))
+LOGGER = logging.getLogger(__name__)
+
+USER, CHAT, CONVERSATION = "user", "chat", "conversation"
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS state (
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value BLOB NOT NULL,
+        PRIMARY KEY (kind, name, key)
+    )
+    """,
+)
+
+# (kind, conversation name or "", key)
+RowKey = Tuple[str, str, str]
+
+
+class _LazyData(defaultdict):
+    """A defaultdict(dict) that loads a missing key from the database."""
+
+    def __init__(self, load):
+        super().__init__(dict)
+        self._load = load
+
+    def __missing__(self, key):
+        value = self._load(key)
+        self[key] = value
+        return value
+
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self, path: str, store_user_data: bool = True, store_chat_data: bool = True):
+        super().__init__(store_user_data, store_chat_data)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # The last value read or written of each row, to skip unchanged updates
+        self._saved: Dict[RowKey, bytes] = {}
+        # Rows to write on the next flush (None deletes the row)
+        self._dirty: Dict[RowKey, Optional[bytes]] = {}
+        self._user_data: Optional[_LazyData] = None
+        self._chat_data: Optional[_LazyData] = None
+        self.loads = 0
+        self.flushes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller must hold self._lock
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _load(self, kind: str, key) -> Dict:
+        row_key = (kind, "", str(key))
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM state WHERE kind = ? AND name = ? AND key = ?", row_key
+            ).fetchone()
+            self.loads += 1
+            if row is None:
+                return {}
+            self._saved[row_key] = row[0]
+        return pickle.loads(row[0])
+
+    def _mark(self, row_key: RowKey, value):
+        blob = None if value is None or value == {} else pickle.dumps(value)
+        with self._lock:
+            if blob == self._saved.get(row_key):
+                self._dirty.pop(row_key, None)
+            else:
+                self._dirty[row_key] = blob
+
+    def get_user_data(self) -> defaultdict:
+        if self._user_data is None:
+            self._user_data = _LazyData(lambda user_id: self._load(USER, user_id))
+        return self._user_data
+
+    def get_chat_data(self) -> defaultdict:
+        if self._chat_data is None:
+            self._chat_data = _LazyData(lambda chat_id: self._load(CHAT, chat_id))
+        return self._chat_data
+
+    def get_conversations(self, name: str) -> Dict:
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT key, value FROM state WHERE kind = ? AND name = ?", (CONVERSATION, name)
+            ).fetchall()
+            for key, value in rows:
+                self._saved[(CONVERSATION, name, key)] = value
+        return {tuple(json.loads(key)): pickle.loads(value) for key, value in rows}
+
+    def update_conversation(self, name: str, key, new_state):
+        self._mark((CONVERSATION, name, json.dumps(list(key))), new_state)
+
+    def update_user_data(self, user_id, data: Dict):
+        self._mark((USER, "", str(user_id)), data)
+
+    def update_chat_data(self, chat_id, data: Dict):
+        self._mark((CHAT, "", str(chat_id)), data)
+
+    def flush(self):
+        """Write the dirty rows in one transaction."""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty = self._dirty
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM state WHERE kind = ? AND name = ? AND key = ?",
+                    [row_key for row_key, blob in dirty.items() if blob is None]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO state (kind, name, key, value) VALUES (?, ?, ?, ?)",
+                    [row_key + (blob,) for row_key, blob in dirty.items() if blob is not None]
+                )
+            for row_key, blob in dirty.items():
+                if blob is None:
+                    self._saved.pop(row_key, None)
+                else:
+                    self._saved[row_key] = blob
+            self._dirty = {}
+            self.flushes += 1
+        LOGGER.debug("Flushed %d state rows", len(dirty))
+
+    def flush_job(self, context):
+        """A JobQueue callback flushing the dirty rows."""
+        try:
+            self.flush()
+        except sqlite3.Error:
+            LOGGER.exception("Failed to flush the bot state")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"saved": len(self._saved), "dirty": len(self._dirty),
+                    "loads": self.loads, "flushes": self.flushes}
+
+
+def create(path: str = STATE_PATH) -> Optional[SqlitePersistence]:
+    """The persistence backend of the bot (None if disabled)."""
+    if not path:
+        return None
+    return SqlitePersistence(path)
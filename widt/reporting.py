@@ -1,126 +1,192 @@
 import os
+import time
 import logging
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import List
+from typing import Collection, Dict, List, Optional, Tuple
 
-import requests
 from telegram.ext import CallbackContext
-from jinja2 import FileSystemLoader, Environment
 
-from .db import DB
+from .emails import make_payload
+from .export_cache import EXPORT_CACHE
+from .meta import get_report_hour, previous_report_time, to_user_time
+from .digest import DIGESTS
+from .live import LIVE
+from .meta_cache import META_CACHE
+from .mailgun import is_configured
+from .outbox import OUTBOX
+from .outbound import LIMITER, bulk
+from .storage import STORAGE, ArchivedDay, key_timestamp
 
-MAILGUN_DOMAIN = os.environ.get("MG_DOMAIN", "")
-MAILGUN_API_KEY = os.environ.get("MG_KEY", "")
+# Number of users processed concurrently in a report tick
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "8"))
+# Users archived together (their entries are read and their writes are
+# packed into as few storage write batches as possible)
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "100"))
+# Attempts at archiving a batch (and then its users whose writes failed)
+ARCHIVE_ATTEMPTS = int(os.environ.get("ARCHIVE_ATTEMPTS", "3"))
+# Seconds before the next attempt (times the attempts made)
+ARCHIVE_RETRY_DELAY = 1
 LOGGER = logging.getLogger(__name__)
 
 
-def _send_email(recipient: str, user_time: datetime, entries: List, message: str):
-    if MAILGUN_DOMAIN == "" or MAILGUN_API_KEY == "":
-        LOGGER.warning(
-            "MAILGUN_DOMAIN and/or MAILGUN_API_KEY environment "
-            "variable is not set! Skipping emailing...")
+def _send_email(chat_id, recipient: str, user_time: datetime, entries_html: str, message: str):
+    """Queue the report email in the outbox."""
+    if not is_configured():
         return
-    template_loader = FileSystemLoader(
-        searchpath=str(Path(__file__).parent / "templates")
+    queued = OUTBOX.enqueue(
+        chat_id, user_time.strftime("%Y%m%d"),
+        make_payload(recipient, user_time, entries_html, message)
     )
-    template_env = Environment(loader=template_loader)
-    if len(entries) == 0:
-        template = template_env.get_template("skip.jinja")
-        output = template.render(
-            formatted_date=user_time.strftime("%Y-%m-%d")
-        )
-        subject = f"{user_time.strftime('%Y%m%d')} — Remember that You Are Awesome!"
-    else:
-        template = template_env.get_template("normal.jinja")
-        output = template.render(
-            formatted_date=user_time.strftime("%Y-%m-%d"),
-            entries=entries
-        )
-        subject = f"{user_time.strftime('%Y%m%d')} — Congratulation on Another Awesome Day!"
-    res = requests.post(
-        f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-        auth=("api", MAILGUN_API_KEY),
-        data={
-            "from": f"What I Did Today <bot@{MAILGUN_DOMAIN}>",
-            "to": [recipient],
-            "subject": subject,
-            "text": message,
-            "html": output
-        }
-    )
-    LOGGER.info("Report email: %s %d" % (recipient, res.status_code))
-    if res.status_code != 200:
-        LOGGER.error(res.text)
+    if not queued:
+        LOGGER.info("Report email of %s is already queued. Skipped...", chat_id)
+
 
+def get_due_metadata(report_hour: int):
+    """Fetch the metadata of users whose day ends in the given UTC hour.
 
-def get_all_metadata():
-    # Then query for documents
-    meta_ref = DB.collection(u'meta')
+    Relies on the derived `report_hour` field written by `widt.config.done`
+    (see `utility_scripts/backfill_report_hour.py` for older documents).
+    """
+    since = META_CACHE.version
     user_meta = []
-    for doc in meta_ref.stream():
-        data = doc.to_dict()
-        data["chat_id"] = doc.id
+    for chat_id, data in STORAGE.stream_meta(report_hour):
+        META_CACHE.put(chat_id, data, since)
+        data["chat_id"] = chat_id
         user_meta.append(data)
     return user_meta
 
 
-def _archive_journal(user_time, chat_id, archive):
-    doc = DB.collection("live").document(str(chat_id)).get()
-    if doc.exists is False:
-        return None
+def _report_date(user_time: datetime) -> str:
+    return user_time.strftime("%Y%m%d")
+
+
+def _archived_entries(chat_id, day: str) -> Dict[str, str]:
+    """The entries of an archived day (YYYYMMDD-HH), or of the days of a date (YYYYMMDD)."""
+    month = int(day[:6])
+    found: Dict[str, str] = {}
+    for day_month, archived_day, entries in STORAGE.query_archive(chat_id, month, month):
+        if day_month == month and archived_day.startswith(day):
+            found.update(entries)
+    return found
+
+
+def _split_leftovers(chat_id, entries: Dict[str, str], report_date: str,
+                     until: int) -> Tuple[Dict[str, str], Tuple[str, ...]]:
+    """Split off the live entries that the report of `report_date` (which
+    collected the entries up to `until`) archived but failed to remove.
+
+    Returns the entries to archive and the keys only to remove.
+    """
+    if all(key_timestamp(key) > until for key in entries):
+        return entries, ()
+    archived = _archived_entries(chat_id, report_date)
+    leftovers = tuple(key for key in entries if key_timestamp(key) <= until and key in archived)
+    return {key: text for key, text in entries.items() if key not in leftovers}, leftovers
+
+
+def _archive_journals(jobs: List[Tuple[datetime, str]], archive: bool,
+                      archived: Collection[str] = (),
+                      previous: Optional[Dict[str, Tuple[str, int]]] = None) -> Dict[str, Optional[List]]:
+    """Archive the live entries of a group of users with batched writes.
+
+    `jobs` holds (user_time, chat_id) pairs. Every user's archive write,
+    checkpoint (`last_archive_date` and `last_archive_until` in `meta`) and
+    entry deletes succeed or fail together (see `Storage.archive_days`),
+    except for deletes that didn't fit in the batch. The report is
+    checkpointed (`last_report_date`) once it's delivered (see
+    `_deliver_report`), so the days of `archived` chats were archived by an
+    attempt that didn't deliver the report; their entries are read back from
+    the archive. `previous` holds the last checkpoint of the other chats
+    (`last_archive_date`, `last_archive_until`): the entries it archived but
+    failed to remove are removed, not archived again.
+
+    Returns the sorted entries of each archived chat_id (None if there are no
+    entries). Users whose writes failed ARCHIVE_ATTEMPTS times are left out.
+    """
+    until = int(time.time())
+    live = LIVE.collect([chat_id for _, chat_id in jobs], until)
+    days = []
+    results: Dict[str, Optional[List]] = {}
+    for user_time, chat_id in jobs:
+        entries = live[str(chat_id)]
+        day = user_time.strftime("%Y%m%d-%H")
+        leftovers: Tuple[str, ...] = ()
+        if chat_id in archived:
+            entries = dict(_archived_entries(chat_id, day), **entries)
+        elif previous and chat_id in previous:
+            entries, leftovers = _split_leftovers(chat_id, entries, *previous[chat_id])
+        days.append(ArchivedDay(str(chat_id), _report_date(user_time), day, entries, until, leftovers))
+        results[chat_id] = sorted(entries.items()) if entries else None
     if archive:
-        DB.collection(str(chat_id)).document(
-            user_time.strftime("%Y%m")
-        ).set(
-            {
-                user_time.strftime("%Y%m%d-%H"): doc.to_dict(),
-                "month": int(user_time.strftime("%Y%m"))
-            },
-            merge=True
-        )
-        DB.collection("live").document(str(chat_id)).delete()
-    entries = sorted(
-        [(key, item) for key, item in doc.to_dict().items()],
-        key=lambda x: x[0]
-    )
-    return entries
+        pending = days
+        for attempt in range(1, ARCHIVE_ATTEMPTS + 1):
+            failed = set(STORAGE.archive_days(pending))
+            pending = [day for day in pending if day.chat_id in failed]
+            if not pending or attempt == ARCHIVE_ATTEMPTS:
+                break
+            LOGGER.warning("Retrying the archive writes of %s", sorted(failed))
+            time.sleep(ARCHIVE_RETRY_DELAY * attempt)
+        for day in pending:
+            del results[day.chat_id]
+        try:
+            # Cached exports of these months are stale (failed writes may be partial)
+            EXPORT_CACHE.bump((day.chat_id, int(day.day[:6])) for day in days if day.entries)
+        except Exception:
+            # The archive is written; the users still get their reports
+            LOGGER.exception(
+                "Failed to invalidate the cached exports of %s", [day.chat_id for day in days])
+        LIVE.invalidate([chat_id for _, chat_id in jobs])
+        for day in days:
+            if day.chat_id in results:
+                META_CACHE.update_cached(day.chat_id, day.checkpoint)
+    return results
 
 
-def _parse_timestamp(timestamp, metadata):
-    return datetime.utcfromtimestamp(int(timestamp)) + timedelta(hours=metadata["timezone"])
+def _archive_chunk(jobs: List[Tuple[datetime, str]], archive: bool,
+                   archived: Collection[str] = (),
+                   previous: Optional[Dict[str, Tuple[str, int]]] = None) -> Dict[str, Optional[List]]:
+    """`_archive_journals`, retried when it raises (before writing anything,
+    e.g. when the live entries can't be read)."""
+    for attempt in range(1, ARCHIVE_ATTEMPTS + 1):
+        try:
+            return _archive_journals(jobs, archive, archived, previous)
+        except Exception:
+            if attempt == ARCHIVE_ATTEMPTS:
+                raise
+            LOGGER.warning(
+                "Failed to archive journals for %s. Retrying...",
+                [chat_id for _, chat_id in jobs], exc_info=True)
+            time.sleep(ARCHIVE_RETRY_DELAY * attempt)
+    return {}
 
 
 def _send_report(context: CallbackContext, user_time, entries, metadata):
+    # The lines were rendered as the entries came in (see widt.digest)
+    text, entries_html = DIGESTS.build(metadata["chat_id"], entries or [], metadata["timezone"])
+    DIGESTS.discard(metadata["chat_id"])
     if not entries:
         if metadata.get("reminder", True):
-            context.bot.send_message(
-                metadata["chat_id"],
-                text=(
-                    "You don't have any entries today.\nNo worries. Tomorrow's a brand new day!\n"
-                    "(Use the  `/reminder no` command to stop receiving this message.)"
+            with bulk():
+                context.bot.send_message(
+                    metadata["chat_id"],
+                    text=(
+                        "You don't have any entries today.\nNo worries. Tomorrow's a brand new day!\n"
+                        "(Use the  `/reminder no` command to stop receiving this message.)"
+                    )
                 )
-            )
         message = ""
-        entries = []
     else:
-        formatted = [
-            "* {} — {}".format(
-                _parse_timestamp(
-                    key, metadata
-                ).strftime('%H:%M:%S'),
-                item
-            ) for key, item in entries
-        ]
         message = (
             "What you did today:\n" +
-            "\n".join(formatted) +
+            text +
             "\nGood job!"
         )
-        context.bot.send_message(
-            int(metadata["chat_id"]),
-            text=message
-        )
+        with bulk():
+            context.bot.send_message(
+                int(metadata["chat_id"]),
+                text=message
+            )
     if "email" in metadata and metadata["email"] != "":
         if not metadata.get("email_verified"):
             LOGGER.info(
@@ -130,30 +196,130 @@ def _send_report(context: CallbackContext, user_time, entries, metadata):
             return
         if metadata.get("reminder", True) or entries:
             _send_email(
+                metadata["chat_id"],
                 metadata["email"],
                 user_time,
                 message=message,
-                entries=[
-                    (
-                        _parse_timestamp(key, metadata).strftime('%H:%M'),
-                        item
-                    ) for key, item in entries
-                ]
+                entries_html=entries_html
             )
 
 
+def _checkpoint_reports(reports: List[Tuple[datetime, Dict]]):
+    """Record the delivered reports (`last_report_date`).
+
+    A report that isn't checkpointed is made again when the user is caught
+    up (see `widt.scheduler`), from the entries archived for it. The
+    `report_hour` of IANA timezones is refreshed for the next report, which
+    may fall after a daylight saving time change.
+    """
+    checkpoints = {}
+    for user_time, metadata in reports:
+        fields = {"last_report_date": _report_date(user_time)}
+        if isinstance(metadata.get("timezone"), str) and "end_of_day" in metadata:
+            fields["report_hour"] = get_report_hour(metadata["timezone"], metadata["end_of_day"])
+        checkpoints[metadata["chat_id"]] = fields
+    failed = set(STORAGE.put_metas(checkpoints))
+    if failed:
+        LOGGER.error("Failed to checkpoint the reports of %s", sorted(failed))
+    for chat_id, fields in checkpoints.items():
+        if chat_id not in failed:
+            META_CACHE.update_cached(chat_id, fields)
+
+
+def _deliver_report(context: CallbackContext, user_time, entries, metadata, archive: bool):
+    """Send a report and checkpoint it right away, so that a restart in the
+    middle of a tick doesn't make the delivered reports again."""
+    _send_report(context, user_time, entries, metadata)
+    if archive:
+        _checkpoint_reports([(user_time, metadata)])
+
+
+def _find_due(tick_time: datetime, whitelist=None) -> List[Tuple[datetime, Dict]]:
+    """Find the users whose day ended within the hour before `tick_time`
+    (UTC) and who have not been reported for that day yet."""
+    due = []
+    seen = set()
+    # The day ends of fractional offsets (e.g., 16:30) fall within the hour
+    # before the tick but not necessarily in its UTC hour
+    for report_hour in (tick_time.hour, (tick_time.hour - 1) % 24):
+        for metadata in get_due_metadata(report_hour):
+            LOGGER.debug("Processing chat_id: %s", metadata["chat_id"])
+            if "timezone" not in metadata or "end_of_day" not in metadata:
+                continue
+            if whitelist and metadata["chat_id"] not in whitelist:
+                continue
+            if metadata["chat_id"] in seen:
+                continue
+            seen.add(metadata["chat_id"])
+            previous = previous_report_time(metadata, tick_time)
+            if tick_time - previous >= timedelta(hours=1):
+                continue
+            user_time = to_user_time(previous, metadata["timezone"])
+            if metadata.get("last_report_date", "") >= _report_date(user_time):
+                LOGGER.info("Already reported %s for %s", metadata["chat_id"], _report_date(user_time))
+                continue
+            due.append((user_time, metadata))
+    return due
+
+
+def _make_reports(context: CallbackContext, due: List[Tuple[datetime, Dict]], archive: bool):
+    start_time = time.monotonic()
+    failed = 0
+    if due:
+        # Errors are isolated per batch (archiving) and per user (sending)
+        # so one failure does not abort the tick
+        with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+            archive_futures = {}
+            for i in range(0, len(due), ARCHIVE_BATCH_SIZE):
+                batch = due[i:i + ARCHIVE_BATCH_SIZE]
+                chunk = [(user_time, metadata["chat_id"]) for user_time, metadata in batch]
+                # Archived by an earlier attempt that didn't deliver the report
+                undelivered = {
+                    metadata["chat_id"] for user_time, metadata in batch
+                    if metadata.get("last_archive_date", "") >= _report_date(user_time)
+                }
+                previous = {
+                    metadata["chat_id"]: (metadata["last_archive_date"], metadata["last_archive_until"])
+                    for _, metadata in batch if "last_archive_until" in metadata
+                }
+                archive_futures[executor.submit(
+                    _archive_chunk, chunk, archive, undelivered, previous)] = chunk
+            archived: Dict[str, Optional[List]] = {}
+            for future in as_completed(archive_futures):
+                try:
+                    archived.update(future.result())
+                except Exception:
+                    chunk = archive_futures[future]
+                    LOGGER.exception(
+                        "Failed to archive journals for %s",
+                        [chat_id for _, chat_id in chunk])
+            failed += len(due) - len(archived)
+            send_futures = {
+                executor.submit(
+                    _deliver_report, context, user_time,
+                    archived[metadata["chat_id"]], metadata, archive
+                ): metadata["chat_id"]
+                for user_time, metadata in due
+                if metadata["chat_id"] in archived
+            }
+            for future in as_completed(send_futures):
+                try:
+                    future.result()
+                except Exception:
+                    failed += 1
+                    LOGGER.exception("Failed to make report for %s", send_futures[future])
+    elapsed = time.monotonic() - start_time
+    LOGGER.info(
+        "Made %d reports (%d failed) in %.2f seconds (%.1f users/s)",
+        len(due) - failed, failed, elapsed, len(due) / elapsed if elapsed > 0 else 0
+    )
+    LOGGER.info("Telegram outbound: %s", LIMITER.stats())
+    LOGGER.info("Digests: %s", DIGESTS.stats())
+    LOGGER.info("Live entries: %s", LIVE.stats())
+    LOGGER.info("Configs: %s", META_CACHE.stats())
+
+
 def check_and_make_report(context: CallbackContext, archive: bool = True, whitelist=None):
     LOGGER.info("Check and make reports...")
-    user_meta = get_all_metadata()
-    current_time = datetime.utcnow()
-    for metadata in user_meta:
-        LOGGER.debug("Processing chat_id: %s", metadata["chat_id"])
-        if "timezone" not in metadata or "end_of_day" not in metadata:
-            continue
-        if whitelist and metadata["chat_id"] not in whitelist:
-            continue
-        user_time = current_time + timedelta(hours=metadata["timezone"])
-        if user_time.hour == metadata["end_of_day"]:
-            LOGGER.info(f"Making report for {metadata['chat_id']}")
-            entries = _archive_journal(user_time, metadata["chat_id"], archive)
-            _send_report(context, user_time, entries, metadata)
+    due = _find_due(datetime.utcnow(), whitelist)
+    _make_reports(context, due, archive)
@@ -0,0 +1,152 @@
+"""Event-driven scheduling of the end-of-day reports
+
+Instead of scanning the users every hour, the scheduler keeps a min-heap of
+each user's next report instant (computed with `zoneinfo`, so daylight saving
+time and fractional offsets are handled) and sets a single `JobQueue` job for
+the earliest one. The job reports every user who is due and schedules the next
+wakeup. Config changes update the heap incrementally through `reschedule`.
+"""
+import os
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from telegram.ext import CallbackContext
+
+from .meta import next_report_time, previous_report_time, to_user_time  # noqa: F401
+from .meta_cache import META_CACHE
+from .reporting import _make_reports, _report_date
+from .storage import STORAGE
+
+# How far back the initial load looks for reports missed while the bot was
+# down (e.g., during a deploy)
+CATCHUP_HOURS = int(os.environ.get("CATCHUP_HOURS", "23"))
+LOGGER = logging.getLogger(__name__)
+
+SCHEDULER: Optional["ReportScheduler"] = None
+
+
+def _missed(metadata: Dict, previous: datetime) -> bool:
+    """Whether the report at `previous` (naive UTC) hasn't been delivered.
+
+    Without any checkpoint (new users, and configs from before the
+    checkpoints), only a config saved after it (`config_time`) tells that
+    there was no report to make.
+    """
+    if "last_report_date" not in metadata and "last_archive_date" not in metadata:
+        configured = metadata.get("config_time")
+        if configured is not None and configured > (previous - datetime(1970, 1, 1)).total_seconds():
+            return False
+    return metadata.get("last_report_date", "") < _report_date(
+        to_user_time(previous, metadata["timezone"]))
+
+
+class ReportScheduler:
+    def __init__(self, job_queue, archive: bool = True):
+        self.job_queue = job_queue
+        self.archive = archive
+        self._heap: List[Tuple[datetime, str]] = []
+        # The valid heap entry of each chat (other entries are stale)
+        self._next: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._job = None
+        self._job_time: Optional[datetime] = None
+
+    def _push(self, chat_id: str, when: datetime):
+        # Caller must hold self._lock
+        self._next[chat_id] = when
+        heapq.heappush(self._heap, (when, chat_id))
+
+    def load(self):
+        """Build the heap from all the configs and schedule the first wakeup.
+
+        Users whose last report instant passed within CATCHUP_HOURS without a
+        report (see `_missed`) are due now.
+        """
+        now = datetime.utcnow()
+        catch_up = 0
+        since = META_CACHE.version
+        with self._lock:
+            for chat_id, metadata in STORAGE.stream_meta():
+                # Warm up the config cache for the handlers
+                META_CACHE.put(chat_id, metadata, since)
+                if "timezone" not in metadata or "end_of_day" not in metadata:
+                    continue
+                previous = previous_report_time(metadata, now)
+                if now - previous < timedelta(hours=CATCHUP_HOURS) and _missed(metadata, previous):
+                    self._push(chat_id, previous)
+                    catch_up += 1
+                else:
+                    self._push(chat_id, next_report_time(metadata, now))
+        LOGGER.info("Scheduled %d users (%d to catch up)", len(self._next), catch_up)
+        self._schedule_wakeup()
+
+    def reschedule(self, chat_id, metadata: Dict):
+        """Update the report instant of a user after a config change."""
+        with self._lock:
+            self._push(str(chat_id), next_report_time(metadata, datetime.utcnow()))
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        with self._lock:
+            while self._heap and self._next.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return
+            when = self._heap[0][0]
+            if self._job is not None:
+                if self._job_time <= when:
+                    return
+                self._job.schedule_removal()
+            delay = max((when - datetime.utcnow()).total_seconds(), 0)
+            self._job = self.job_queue.run_once(self._wakeup, when=delay)
+            self._job_time = when
+
+    def _pop_due(self, now: datetime) -> List[Tuple[datetime, str]]:
+        due = []
+        with self._lock:
+            self._job = None
+            while self._heap and self._heap[0][0] <= now:
+                when, chat_id = heapq.heappop(self._heap)
+                if self._next.get(chat_id) == when:
+                    del self._next[chat_id]
+                    due.append((when, chat_id))
+        return due
+
+    def _wakeup(self, context: CallbackContext):
+        now = datetime.utcnow()
+        due = self._pop_due(now)
+        configs = META_CACHE.get_many([chat_id for _, chat_id in due]) if due else {}
+        reports = []
+        with self._lock:
+            for when, chat_id in due:
+                metadata = configs.get(chat_id, {})
+                if "timezone" not in metadata or "end_of_day" not in metadata:
+                    continue
+                metadata["chat_id"] = chat_id
+                user_time = to_user_time(when, metadata["timezone"])
+                if chat_id not in self._next:
+                    self._push(chat_id, next_report_time(metadata, now))
+                if metadata.get("last_report_date", "") >= _report_date(user_time):
+                    LOGGER.info("Already reported %s for %s", chat_id, _report_date(user_time))
+                    continue
+                reports.append((user_time, metadata))
+        try:
+            _make_reports(context, reports, self.archive)
+        finally:
+            self._schedule_wakeup()
+
+
+def start(job_queue, archive: bool = True) -> ReportScheduler:
+    global SCHEDULER
+    SCHEDULER = ReportScheduler(job_queue, archive)
+    SCHEDULER.load()
+    return SCHEDULER
+
+
+def reschedule(chat_id, metadata: Dict):
+    """Notify the scheduler (if running) of a config change."""
+    if SCHEDULER is not None:
+        SCHEDULER.reschedule(chat_id, metadata)
@@ -0,0 +1,313 @@
+"""An embedded SQLite storage backend for single-node deployments
+
+Enable with STORAGE_BACKEND=sqlite (the file is STORAGE_PATH). The database
+runs in WAL mode, so readers don't block the writer. Each thread (the
+dispatcher, the report workers and the live-entry flusher) gets its own
+connection; writes are serialized by SQLite itself.
+
+Tables:
+
++ `meta` — the config of a chat as JSON, with `report_hour` in its own
+  indexed column for the report job
++ `live` — one row per live entry, indexed by (chat_id, ts)
++ `archive` — one row per archived entry, indexed by (chat_id, month);
+  days loaded from the legacy Firestore archive have no month and are
+  returned for any range (like the Firestore backend does) until
+  `migrate_legacy_archive` assigns them one
+
+Load a Firestore dump (`utility_scripts/export_db.py`) into it with
+`utility_scripts/load_sqlite.py`.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .storage import ArchivedDay, Storage, key_timestamp
+
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "widt.sqlite")
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS meta (
+        chat_id TEXT PRIMARY KEY,
+        report_hour INTEGER,
+        data TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS meta_report_hour ON meta (report_hour)",
+    """
+    CREATE TABLE IF NOT EXISTS live (
+        chat_id TEXT NOT NULL,
+        key TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (chat_id, key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS live_ts ON live (chat_id, ts)",
+    """
+    CREATE TABLE IF NOT EXISTS archive (
+        chat_id TEXT NOT NULL,
+        month INTEGER,
+        day TEXT NOT NULL,
+        key TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (chat_id, day, key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive_month ON archive (chat_id, month)",
+)
+# The legacy days whose keys are dates (see storage.day_month)
+_LEGACY_DAY = "month IS NULL AND substr(day, 1, 8) GLOB '[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'"
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path: str = STORAGE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are explicit (see _transaction)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    for statement in SCHEMA:
+                        conn.execute(statement)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        # Take the write lock up front, so read-modify-writes don't deadlock
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get_meta(self, chat_id) -> Optional[Dict]:
+        row = self._connection().execute(
+            "SELECT data FROM meta WHERE chat_id = ?", (str(chat_id),)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_metas(self, chat_ids: Iterable) -> Dict[str, Optional[Dict]]:
+        results: Dict[str, Optional[Dict]] = {str(chat_id): None for chat_id in chat_ids}
+        keys = list(results)
+        conn = self._connection()
+        # Stay under SQLite's limit of bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                f"SELECT chat_id, data FROM meta WHERE chat_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for chat_id, data in rows:
+                results[chat_id] = json.loads(data)
+        return results
+
+    @staticmethod
+    def _merge_meta(conn: sqlite3.Connection, chat_id: str, fields: Dict):
+        # Caller must be in a transaction
+        row = conn.execute("SELECT data FROM meta WHERE chat_id = ?", (chat_id,)).fetchone()
+        data = json.loads(row[0]) if row is not None else {}
+        data.update(fields)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (chat_id, report_hour, data) VALUES (?, ?, ?)",
+            (chat_id, data.get("report_hour"), json.dumps(data))
+        )
+
+    def put_meta(self, chat_id, fields: Dict):
+        with self._transaction() as conn:
+            self._merge_meta(conn, str(chat_id), fields)
+
+    def put_metas(self, fields: Dict[str, Dict]) -> List[str]:
+        try:
+            with self._transaction() as conn:
+                for chat_id, chat_fields in fields.items():
+                    self._merge_meta(conn, str(chat_id), chat_fields)
+        except sqlite3.Error:
+            LOGGER.exception("Failed to update the configs of %s", list(fields))
+            return [str(chat_id) for chat_id in fields]
+        return []
+
+    def stream_meta(self, report_hour: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        if report_hour is None:
+            rows = self._connection().execute("SELECT chat_id, data FROM meta")
+        else:
+            rows = self._connection().execute(
+                "SELECT chat_id, data FROM meta WHERE report_hour = ?", (report_hour,))
+        for chat_id, data in rows.fetchall():
+            yield chat_id, json.loads(data)
+
+    def read_live(self, chat_id) -> Dict[str, str]:
+        return dict(self._connection().execute(
+            "SELECT key, text FROM live WHERE chat_id = ?", (str(chat_id),)
+        ).fetchall())
+
+    def write_live(self, changes: Dict[str, Dict[str, Optional[str]]]) -> List[str]:
+        try:
+            with self._transaction() as conn:
+                for chat_id, fields in changes.items():
+                    conn.executemany(
+                        "DELETE FROM live WHERE chat_id = ? AND key = ?",
+                        [(str(chat_id), key) for key, value in fields.items() if value is None]
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO live (chat_id, key, ts, text) VALUES (?, ?, ?, ?)",
+                        [
+                            (str(chat_id), key, key_timestamp(key), value)
+                            for key, value in fields.items() if value is not None
+                        ]
+                    )
+        except sqlite3.Error:
+            LOGGER.exception("Failed to write the live entries of %s", list(changes))
+            return [str(chat_id) for chat_id in changes]
+        return []
+
+    def collect_live(self, chat_ids: Iterable, until: int) -> Dict[str, Dict[str, str]]:
+        conn = self._connection()
+        results = {}
+        for chat_id in map(str, chat_ids):
+            # Legacy entries are collected regardless of their time
+            results[chat_id] = dict(conn.execute(
+                "SELECT key, text FROM live WHERE chat_id = ? AND (ts <= ? OR key NOT LIKE '%-%')",
+                (chat_id, until)
+            ).fetchall())
+        return results
+
+    @staticmethod
+    def _insert_archive(conn: sqlite3.Connection, chat_id: str, month: Optional[int],
+                        day: str, entries: Dict[str, str]):
+        conn.executemany(
+            "INSERT OR REPLACE INTO archive (chat_id, month, day, key, ts, text) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (chat_id, month, day, key, key_timestamp(key), text)
+                for key, text in entries.items()
+            ]
+        )
+
+    def archive_days(self, days: List[ArchivedDay]) -> List[str]:
+        try:
+            with self._transaction() as conn:
+                for day in days:
+                    self._merge_meta(conn, day.chat_id, day.checkpoint)
+                    self._insert_archive(conn, day.chat_id, int(day.day[:6]), day.day, day.entries)
+                    conn.executemany(
+                        "DELETE FROM live WHERE chat_id = ? AND key = ?",
+                        [(day.chat_id, key) for key in day.removed]
+                    )
+        except sqlite3.Error:
+            LOGGER.exception("Failed to archive %s", [day.chat_id for day in days])
+            return [day.chat_id for day in days]
+        return []
+
+    def append_archive(self, chat_id, days: Dict[str, Dict[str, str]]):
+        with self._transaction() as conn:
+            for day, entries in days.items():
+                self._insert_archive(conn, str(chat_id), int(day[:6]), day, entries)
+
+    def append_legacy_archive(self, chat_id, days: Dict[str, Dict[str, str]]):
+        """Load days of the legacy Firestore archive (which have no month)."""
+        with self._transaction() as conn:
+            for day, entries in days.items():
+                self._insert_archive(conn, str(chat_id), None, day, entries)
+
+    def query_archive(self, chat_id, first_month: int,
+                      last_month: int) -> Iterator[Tuple[Optional[int], str, Dict[str, str]]]:
+        # NULLs (the legacy days) sort first
+        rows = self._connection().execute(
+            "SELECT month, day, key, text FROM archive WHERE chat_id = ? AND "
+            "(month BETWEEN ? AND ? OR month IS NULL) ORDER BY month, day",
+            (str(chat_id), first_month, last_month)
+        )
+        month, day, entries = None, None, {}
+        for row_month, row_day, key, text in rows:
+            if row_day != day:
+                if entries:
+                    yield month, day, entries
+                month, day, entries = row_month, row_day, {}
+            entries[key] = text
+        if entries:
+            yield month, day, entries
+
+    def migrate_legacy_archive(self) -> Dict[str, int]:
+        with self._transaction() as conn:
+            moved = dict(conn.execute(
+                f"SELECT chat_id, COUNT(DISTINCT day) FROM archive WHERE {_LEGACY_DAY} GROUP BY chat_id"
+            ).fetchall())
+            conn.execute(
+                f"UPDATE archive SET month = CAST(substr(day, 1, 6) AS INTEGER) WHERE {_LEGACY_DAY}")
+        return moved
+
+    def close(self):
+        """Close the connection of the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def _is_chat_id(name: str) -> bool:
+    # Group chats have negative ids
+    return name.lstrip("-").isdigit()
+
+
+def load_export(export_path: str, storage: SqliteStorage) -> Dict[str, int]:
+    """Load a Firestore dump made by `utility_scripts/export_db.py`.
+
+    Returns the number of configs, live entries and archived entries loaded.
+    """
+    counts = {"meta": 0, "live": 0, "archive": 0}
+
+    def documents(*parts) -> Iterator[Tuple[str, Dict]]:
+        path = os.path.join(export_path, *parts)
+        if not os.path.isdir(path):
+            return
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".json"):
+                with open(os.path.join(path, name)) as fin:
+                    yield name[:-len(".json")], json.load(fin)
+
+    for chat_id, data in documents("meta"):
+        storage.put_meta(chat_id, data)
+        counts["meta"] += 1
+    for chat_id, data in documents("live"):
+        # Entries made before the `entries` subcollection
+        storage.write_live({chat_id: data})
+        counts["live"] += len(data)
+    live_path = os.path.join(export_path, "live")
+    for chat_id in sorted(os.listdir(live_path)) if os.path.isdir(live_path) else []:
+        entries = {key: data["text"] for key, data in documents("live", chat_id, "entries")}
+        if entries:
+            storage.write_live({chat_id: entries})
+            counts["live"] += len(entries)
+    for chat_id, data in documents("archive"):
+        days = {day: entries for day, entries in data.items() if isinstance(entries, dict)}
+        storage.append_legacy_archive(chat_id, days)
+        counts["archive"] += sum(len(entries) for entries in days.values())
+    for collection in sorted(os.listdir(export_path)):
+        if not _is_chat_id(collection):
+            continue
+        for _, data in documents(collection):
+            days = {day: entries for day, entries in data.items() if isinstance(entries, dict)}
+            storage.append_archive(collection, days)
+            counts["archive"] += sum(len(entries) for entries in days.values())
+    return counts
@@ -0,0 +1,533 @@
+"""The storage backends of the bot's data
+
+The handlers and the report job don't talk to Firestore directly; they call
+the operations of a `Storage` on the STORAGE singleton:
+
++ configs (the `meta` documents): `get_meta`, `get_metas`, `put_meta`,
+  `put_metas`, `stream_meta`
++ live entries: `read_live`, `write_live`, `collect_live`
++ archive: `archive_days`, `append_archive`, `query_archive`,
+  `migrate_legacy_archive`
+
+Chat ids are strings. Entries are {key: content} dicts, where a key is
+"{seconds}-{microseconds}" (see `new_key`), "{seconds}-i{sequence}" for
+imported entries (see `widt.importer`) or, for entries made before that
+format, plain seconds.
+
+`FirestoreStorage` is the production backend. `SqliteStorage` (see
+`widt.sqlite_storage`) serves single-node deployments from a local file.
+`MemoryStorage` keeps everything in dicts, for tests and for benchmarking the
+journal, reporting and export paths without a network. STORAGE_BACKEND
+selects the backend ("firestore", "sqlite" or "memory"; "memory" by default
+in TEST_MODE).
+"""
+import os
+import copy
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from .db import DB
+
+STORAGE_BACKEND = os.environ.get(
+    "STORAGE_BACKEND", "memory" if os.environ.get("TEST_MODE") else "firestore")
+# Set to 0 once `utility_scripts/migrate_legacy_archive.py` has run, so
+# exports stop reading the legacy archive documents
+LEGACY_ARCHIVE = os.environ.get("LEGACY_ARCHIVE", "1") not in ("", "0")
+# A Firestore write batch holds at most 500 operations
+BATCH_SIZE = 500
+# Month documents fetched per round trip by an archive query
+ARCHIVE_READ_MONTHS = 12
+# Chats whose live entries are queried concurrently when collecting them
+COLLECT_THREADS = 16
+# Attempts at the live entry deletes committed after the archive of a day
+DELETE_ATTEMPTS = 3
+LOGGER = logging.getLogger(__name__)
+
+# A write is ("set" | "merge" | "delete", document reference, data)
+Write = Tuple[str, Any, Optional[Dict]]
+
+_KEY_LOCK = threading.Lock()
+_LAST_KEY = 0
+
+
+def new_key() -> str:
+    """A unique key for a new entry that sorts after all the earlier keys."""
+    global _LAST_KEY
+    with _KEY_LOCK:
+        _LAST_KEY = max(int(time.time() * 1e6), _LAST_KEY + 1)
+        seconds, micros = divmod(_LAST_KEY, 1000000)
+    return f"{seconds}-{micros:06d}"
+
+
+def key_timestamp(key) -> int:
+    """The Unix time of an entry key (new or legacy)."""
+    return int(str(key).split("-", 1)[0])
+
+
+def is_legacy_key(key: str) -> bool:
+    return "-" not in key
+
+
+def month_range(first_month: int, last_month: int) -> List[int]:
+    """The months (YYYYMM) from `first_month` to `last_month`."""
+    months = []
+    year, month = divmod(first_month, 100)
+    while year * 100 + month <= last_month:
+        months.append(year * 100 + month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def day_month(day: str) -> Optional[int]:
+    """The month (YYYYMM) of an archived day, None if the key isn't a date."""
+    return int(day[:6]) if len(day) >= 8 and day[:8].isdigit() else None
+
+
+class ArchivedDay(NamedTuple):
+    """A user's day moved from the live entries to the archive."""
+    chat_id: str
+    # The date of the report (YYYYMMDD), written to `last_archive_date`
+    report_date: str
+    # The archive field of the day (YYYYMMDD-HH, the local end of the day)
+    day: str
+    # The archived live entries (removed from the live entries)
+    entries: Dict[str, str]
+    # The Unix time the entries were collected up to, written to `last_archive_until`
+    until: Optional[int] = None
+    # Keys of live entries archived by an earlier report whose removal
+    # failed (only removed)
+    leftovers: Tuple[str, ...] = ()
+
+    @property
+    def checkpoint(self) -> Dict[str, Any]:
+        """The fields written to `meta` with the day."""
+        fields: Dict[str, Any] = {"last_archive_date": self.report_date}
+        if self.until is not None:
+            fields["last_archive_until"] = self.until
+        return fields
+
+    @property
+    def removed(self) -> List[str]:
+        """The keys of the live entries to remove."""
+        return list(self.entries) + list(self.leftovers)
+
+
+class Storage(ABC):
+    """The operations the bot needs from its database."""
+
+    @abstractmethod
+    def get_meta(self, chat_id) -> Optional[Dict]:
+        """The config of a chat (None if there is none)."""
+
+    def get_metas(self, chat_ids: Iterable) -> Dict[str, Optional[Dict]]:
+        """The configs of several chats."""
+        return {str(chat_id): self.get_meta(chat_id) for chat_id in chat_ids}
+
+    @abstractmethod
+    def put_meta(self, chat_id, fields: Dict):
+        """Merge fields into the config of a chat."""
+
+    def put_metas(self, fields: Dict[str, Dict]) -> List[str]:
+        """Merge fields into the configs of several chats ({chat_id: fields}).
+
+        Returns the chats whose writes failed.
+        """
+        failed = []
+        for chat_id, chat_fields in fields.items():
+            try:
+                self.put_meta(chat_id, chat_fields)
+            except Exception:
+                LOGGER.exception("Failed to update the config of %s", chat_id)
+                failed.append(str(chat_id))
+        return failed
+
+    @abstractmethod
+    def stream_meta(self, report_hour: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        """(chat_id, config) of every chat (whose `report_hour` matches)."""
+
+    @abstractmethod
+    def read_live(self, chat_id) -> Dict[str, str]:
+        """The live entries of a chat."""
+
+    @abstractmethod
+    def write_live(self, changes: Dict[str, Dict[str, Optional[str]]]) -> List[str]:
+        """Set (or delete, with None) live entries of several chats.
+
+        Returns the chats whose writes failed.
+        """
+
+    @abstractmethod
+    def collect_live(self, chat_ids: Iterable, until: int) -> Dict[str, Dict[str, str]]:
+        """The live entries made at or before `until` (Unix time) of chats."""
+
+    @abstractmethod
+    def archive_days(self, days: List[ArchivedDay]) -> List[str]:
+        """Archive days and write their checkpoints (`ArchivedDay.checkpoint`).
+
+        A day's archive write, checkpoint and live entry removals succeed or
+        fail together, except that the removals may be committed (and retried)
+        after the rest when there are too many of them for one write. Returns
+        the chats whose writes failed.
+        """
+
+    @abstractmethod
+    def append_archive(self, chat_id, days: Dict[str, Dict[str, str]]):
+        """Merge entries into archived days ({YYYYMMDD-HH: entries})."""
+
+    @abstractmethod
+    def query_archive(self, chat_id, first_month: int,
+                      last_month: int) -> Iterator[Tuple[Optional[int], str, Dict[str, str]]]:
+        """(month, day, entries) of the archived days of a range of months (YYYYMM).
+
+        Days archived before the monthly layout (month None) may be included
+        regardless of the range and come first; then the months follow in
+        order, though the days within a month are not in any particular order.
+        """
+
+    def migrate_legacy_archive(self) -> Dict[str, int]:
+        """Move the days archived before the monthly layout into it.
+
+        Idempotent. Returns the number of days moved per chat.
+        """
+        return {}
+
+
+class FirestoreStorage(Storage):
+    """The Firestore layout:
+
+    + `meta/{chat_id}` — the config
+    + `live/{chat_id}/entries/{key}` — a live entry ({"text", "ts"}); legacy
+      live entries are fields of `live/{chat_id}`
+    + `{chat_id}/{YYYYMM}` — the archive of a month ({day: entries, "month"});
+      the legacy archive is `archive/{chat_id}` ({day: entries}) until
+      `migrate_legacy_archive` moves it
+    """
+
+    def _meta_ref(self, chat_id):
+        return DB.collection("meta").document(str(chat_id))
+
+    def _live_ref(self, chat_id):
+        return DB.collection("live").document(str(chat_id))
+
+    def _entry_ref(self, chat_id, key: str):
+        return self._live_ref(chat_id).collection("entries").document(key)
+
+    def _month_ref(self, chat_id, month: str):
+        return DB.collection(str(chat_id)).document(month)
+
+    def _legacy_ref(self, chat_id):
+        return DB.collection("archive").document(str(chat_id))
+
+    def get_meta(self, chat_id) -> Optional[Dict]:
+        doc = self._meta_ref(chat_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_metas(self, chat_ids: Iterable) -> Dict[str, Optional[Dict]]:
+        # One round trip
+        chat_ids = [str(chat_id) for chat_id in chat_ids]
+        docs = {doc.id: doc for doc in DB.get_all([self._meta_ref(chat_id) for chat_id in chat_ids])}
+        return {
+            chat_id: docs[chat_id].to_dict() if chat_id in docs and docs[chat_id].exists else None
+            for chat_id in chat_ids
+        }
+
+    def put_meta(self, chat_id, fields: Dict):
+        self._meta_ref(chat_id).set(fields, merge=True)
+
+    def put_metas(self, fields: Dict[str, Dict]) -> List[str]:
+        return commit_writes([
+            (str(chat_id), [("merge", self._meta_ref(chat_id), chat_fields)])
+            for chat_id, chat_fields in fields.items()
+        ])
+
+    def stream_meta(self, report_hour: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        query = DB.collection("meta")
+        if report_hour is not None:
+            query = query.where("report_hour", "==", report_hour)
+        for doc in query.stream():
+            yield doc.id, doc.to_dict()
+
+    def read_live(self, chat_id) -> Dict[str, str]:
+        doc = self._live_ref(chat_id).get()
+        data = doc.to_dict() if doc.exists else {}
+        for entry in self._live_ref(chat_id).collection("entries").stream():
+            data[entry.id] = entry.to_dict()["text"]
+        return data
+
+    def _live_writes(self, chat_id, fields: Dict[str, Optional[str]]) -> List[Write]:
+        from google.cloud import firestore
+        writes: List[Write] = []
+        legacy = {}
+        for key, value in fields.items():
+            if is_legacy_key(key):
+                legacy[key] = firestore.DELETE_FIELD if value is None else value
+            elif value is None:
+                writes.append(("delete", self._entry_ref(chat_id, key), None))
+            else:
+                writes.append((
+                    "set", self._entry_ref(chat_id, key),
+                    {"text": value, "ts": key_timestamp(key)}
+                ))
+        if legacy:
+            writes.append(("merge", self._live_ref(chat_id), legacy))
+        return writes
+
+    def write_live(self, changes: Dict[str, Dict[str, Optional[str]]]) -> List[str]:
+        return commit_writes([
+            (str(chat_id), self._live_writes(chat_id, fields))
+            for chat_id, fields in changes.items()
+        ])
+
+    def _collect_entries(self, chat_id: str, until: int) -> Dict[str, str]:
+        query = self._live_ref(chat_id).collection("entries").where("ts", "<=", until)
+        return {entry.id: entry.to_dict()["text"] for entry in query.stream()}
+
+    def collect_live(self, chat_ids: Iterable, until: int) -> Dict[str, Dict[str, str]]:
+        chat_ids = [str(chat_id) for chat_id in chat_ids]
+        legacy_docs = {
+            doc.id: doc for doc in DB.get_all([self._live_ref(chat_id) for chat_id in chat_ids])
+        }
+        # A query per chat (a collection group query would read every chat's
+        # entries), made concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(COLLECT_THREADS, len(chat_ids)))) as executor:
+            collected = executor.map(lambda chat_id: self._collect_entries(chat_id, until), chat_ids)
+            results = {}
+            for chat_id, entries in zip(chat_ids, collected):
+                doc = legacy_docs.get(chat_id)
+                results[chat_id] = doc.to_dict() if doc is not None and doc.exists else {}
+                results[chat_id].update(entries)
+        return results
+
+    def archive_days(self, days: List[ArchivedDay]) -> List[str]:
+        groups = []
+        deletes: List[Tuple[str, Write]] = []
+        for day in days:
+            writes: List[Write] = [
+                ("merge", self._meta_ref(day.chat_id), day.checkpoint)
+            ]
+            if day.entries:
+                writes.append((
+                    "merge", self._month_ref(day.chat_id, day.day[:6]),
+                    {day.day: day.entries, "month": int(day.day[:6])}
+                ))
+            # Legacy entries are collected as a whole document
+            if any(is_legacy_key(key) for key in day.removed):
+                writes.append(("delete", self._live_ref(day.chat_id), None))
+            entry_deletes = [
+                ("delete", self._entry_ref(day.chat_id, key), None)
+                for key in day.removed if not is_legacy_key(key)
+            ]
+            # The deletes that don't fit in the day's batch are committed after
+            # it: they only remove archived entries, so they can be retried
+            room = BATCH_SIZE - len(writes)
+            groups.append((day.chat_id, writes + entry_deletes[:room]))
+            deletes.extend((day.chat_id, write) for write in entry_deletes[room:])
+        failed = commit_writes(groups)
+        self._delete_archived([(chat_id, write) for chat_id, write in deletes if chat_id not in failed])
+        return failed
+
+    def _delete_archived(self, deletes: List[Tuple[str, Write]]):
+        for _ in range(DELETE_ATTEMPTS):
+            if not deletes:
+                return
+            failed = set(commit_writes([(i, [write]) for i, (_, write) in enumerate(deletes)]))
+            deletes = [delete for i, delete in enumerate(deletes) if i in failed]
+        if deletes:
+            # The next report only removes them (see `ArchivedDay.leftovers`)
+            LOGGER.error(
+                "Failed to delete %d archived live entries of %s",
+                len(deletes), sorted({chat_id for chat_id, _ in deletes}))
+
+    def append_archive(self, chat_id, days: Dict[str, Dict[str, str]]):
+        months: Dict[str, Dict] = {}
+        for day, entries in days.items():
+            months.setdefault(day[:6], {"month": int(day[:6])})[day] = entries
+        failed = commit_writes([
+            (month, [("merge", self._month_ref(chat_id, month), fields)])
+            for month, fields in months.items()
+        ])
+        if failed:
+            raise RuntimeError(f"Failed to write the archive of {len(failed)} months")
+
+    def query_archive(self, chat_id, first_month: int,
+                      last_month: int) -> Iterator[Tuple[Optional[int], str, Dict[str, str]]]:
+        if LEGACY_ARCHIVE:
+            legacy_doc = self._legacy_ref(chat_id).get()
+            if legacy_doc.exists:
+                for day, entries in legacy_doc.to_dict().items():
+                    yield None, day, entries
+        # The month documents are read by id, a few months per round trip
+        refs = [self._month_ref(chat_id, str(month)) for month in month_range(first_month, last_month)]
+        for i in range(0, len(refs), ARCHIVE_READ_MONTHS):
+            # get_all returns the documents in any order
+            docs = sorted(
+                (doc for doc in DB.get_all(refs[i:i + ARCHIVE_READ_MONTHS]) if doc.exists),
+                key=lambda doc: doc.id
+            )
+            for doc in docs:
+                data = doc.to_dict()
+                month = data.pop("month", int(doc.id))
+                for day, entries in data.items():
+                    yield month, day, entries
+
+    def migrate_legacy_archive(self) -> Dict[str, int]:
+        moved = {}
+        for ref in DB.collection("archive").list_documents():
+            doc = ref.get()
+            if not doc.exists:
+                continue
+            months: Dict[int, Dict] = {}
+            kept = {}
+            for day, entries in doc.to_dict().items():
+                month = day_month(day)
+                if month is None or not isinstance(entries, dict):
+                    kept[day] = entries
+                    continue
+                months.setdefault(month, {"month": month})[day] = entries
+            failed = commit_writes([
+                (month, [("merge", self._month_ref(ref.id, str(month)), fields)])
+                for month, fields in months.items()
+            ])
+            if failed:
+                # Rerunning rewrites the same days
+                LOGGER.error("Failed to migrate the legacy archive of %s (months %s)", ref.id, failed)
+                continue
+            if kept:
+                LOGGER.warning("Kept %d legacy fields of %s that aren't days", len(kept), ref.id)
+                ref.set(kept)
+            else:
+                ref.delete()
+            moved[ref.id] = sum(len(fields) - 1 for fields in months.values())
+        return moved
+
+
+def commit_writes(groups: List[Tuple[Any, List[Write]]]) -> List:
+    """Commit groups of Firestore writes in as few batches as possible.
+
+    A group is never split across batches unless it doesn't fit in one.
+    Returns the keys of the groups that failed.
+    """
+    batches: List[Tuple[List, List[Write]]] = [([], [])]
+    for key, writes in groups:
+        if len(batches[-1][1]) + len(writes) > BATCH_SIZE and batches[-1][1]:
+            batches.append(([], []))
+        batches[-1][0].append(key)
+        for write in writes:
+            if len(batches[-1][1]) == BATCH_SIZE:
+                batches.append(([key], []))
+            batches[-1][1].append(write)
+    failed: List = []
+    for keys, writes in batches:
+        if not writes:
+            continue
+        batch = DB.batch()
+        for method, ref, data in writes:
+            if method == "delete":
+                batch.delete(ref)
+            else:
+                batch.set(ref, data, merge=(method == "merge"))
+        try:
+            batch.commit()
+        except Exception:
+            LOGGER.exception("Failed to commit the writes of %s", keys)
+            failed.extend(key for key in keys if key not in failed)
+    return failed
+
+
+class MemoryStorage(Storage):
+    """Everything in dicts (nothing survives the process)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.meta: Dict[str, Dict] = {}
+        self.live: Dict[str, Dict[str, str]] = {}
+        # chat_id -> {YYYYMM: {YYYYMMDD-HH: entries}}
+        self.archive: Dict[str, Dict[str, Dict[str, Dict[str, str]]]] = {}
+
+    def get_meta(self, chat_id) -> Optional[Dict]:
+        with self._lock:
+            return copy.deepcopy(self.meta.get(str(chat_id)))
+
+    def put_meta(self, chat_id, fields: Dict):
+        with self._lock:
+            self.meta.setdefault(str(chat_id), {}).update(copy.deepcopy(fields))
+
+    def stream_meta(self, report_hour: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        with self._lock:
+            docs = [
+                (chat_id, copy.deepcopy(data)) for chat_id, data in self.meta.items()
+                if report_hour is None or data.get("report_hour") == report_hour
+            ]
+        return iter(docs)
+
+    def read_live(self, chat_id) -> Dict[str, str]:
+        with self._lock:
+            return dict(self.live.get(str(chat_id), {}))
+
+    def write_live(self, changes: Dict[str, Dict[str, Optional[str]]]) -> List[str]:
+        with self._lock:
+            for chat_id, fields in changes.items():
+                entries = self.live.setdefault(str(chat_id), {})
+                for key, value in fields.items():
+                    if value is None:
+                        entries.pop(key, None)
+                    else:
+                        entries[key] = value
+        return []
+
+    def collect_live(self, chat_ids: Iterable, until: int) -> Dict[str, Dict[str, str]]:
+        with self._lock:
+            return {
+                str(chat_id): {
+                    key: value for key, value in self.live.get(str(chat_id), {}).items()
+                    if is_legacy_key(key) or key_timestamp(key) <= until
+                }
+                for chat_id in chat_ids
+            }
+
+    def archive_days(self, days: List[ArchivedDay]) -> List[str]:
+        with self._lock:
+            for day in days:
+                self.meta.setdefault(day.chat_id, {}).update(day.checkpoint)
+                if day.entries:
+                    self.archive.setdefault(day.chat_id, {}).setdefault(
+                        day.day[:6], {}).setdefault(day.day, {}).update(day.entries)
+                live = self.live.get(day.chat_id, {})
+                for key in day.removed:
+                    live.pop(key, None)
+        return []
+
+    def append_archive(self, chat_id, days: Dict[str, Dict[str, str]]):
+        with self._lock:
+            archive = self.archive.setdefault(str(chat_id), {})
+            for day, entries in days.items():
+                archive.setdefault(day[:6], {}).setdefault(day, {}).update(entries)
+
+    def query_archive(self, chat_id, first_month: int,
+                      last_month: int) -> Iterator[Tuple[Optional[int], str, Dict[str, str]]]:
+        with self._lock:
+            days = [
+                (int(month), day, dict(entries))
+                for month, month_days in sorted(self.archive.get(str(chat_id), {}).items())
+                if first_month <= int(month) <= last_month
+                for day, entries in month_days.items()
+            ]
+        return iter(days)
+
+
+def create(backend: str = STORAGE_BACKEND) -> Storage:
+    if backend == "firestore":
+        return FirestoreStorage()
+    if backend == "sqlite":
+        from .sqlite_storage import SqliteStorage
+        return SqliteStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+STORAGE = create()
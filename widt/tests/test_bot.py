@@ -1,4 +1,4 @@
-from widt.bot import start, help_
+from widt.bot import start, help_, error
 import widt.bot
 
 
@@ -20,3 +20,13 @@ def test_help(mocker):
     args, _ = update.message.reply_text.call_args
     # Test the help message
     assert args[0].startswith("How to use this bot:")
+
+
+def test_error_on_callback_query(mocker):
+    update = mocker.MagicMock()
+    # A button press has no update.message
+    update.message = None
+    error(update, mocker.MagicMock())
+    update.effective_message.reply_text.assert_called_once()
+    # Errors outside updates (e.g., in jobs) have nothing to reply to
+    error(None, mocker.MagicMock())
@@ -47,6 +47,26 @@ def test_set_timezone_success(mocker):
     assert user_data['timezone_new'] == -5
 
 
+def test_set_timezone_name(mocker):
+    context = mocker.MagicMock()
+    user_data = {}
+    context.user_data.__setitem__.side_effect = user_data.__setitem__
+    update = mocker.MagicMock()
+    update.message.text = "Asia/Kolkata"
+    assert set_timezone(update, context) == END_OF_DAY
+    assert user_data['timezone_new'] == "Asia/Kolkata"
+
+
+def test_set_timezone_wrong(mocker):
+    context = mocker.MagicMock()
+    update = mocker.MagicMock()
+    for text in ("15", "Mars/Olympus_Mons", "../../etc/passwd"):
+        update.message.text = text
+        assert set_timezone(update, context) == TIMEZONE
+        reply_text = update.message.reply_text.call_args[0][0]
+        assert "Timezone should be" in reply_text
+
+
 def test_set_end_of_day_success(mocker):
     context = mocker.MagicMock()
     user_data = {}
@@ -100,7 +120,7 @@ def test_set_email_skip(mocker):
 
 def test_done(mocker):
     mocker.patch('widt.config.send_code')
-    mocker.patch('widt.config.DB')
+    mocker.patch('widt.config.META_CACHE')
     context = mocker.MagicMock()
     user_data = {
         "timezone_new": 5,
@@ -121,21 +141,22 @@ def test_done(mocker):
     assert "end_of_day_new" not in user_data
     assert "timezone_new" not in user_data
     assert "email_new" not in user_data
-    widt.config.DB.collection.return_value.document.\
-        return_value.set.assert_called_once()
-    set_args = widt.config.DB.collection.return_value.\
-        document.return_value.set.call_args[0][0]
+    widt.config.META_CACHE.update.assert_called_once()
+    set_args = widt.config.META_CACHE.update.call_args[0][1]
     assert set_args["end_of_day"] == 3
     assert set_args["timezone"] == 5
     assert set_args["email"] == "good@place.ea"
+    assert set_args["report_hour"] == 22
+    assert set_args["config_time"] > 0
     assert user_data["metadata"]["email"] == "good@place.ea"
     assert user_data["metadata"]["timezone"] == 5
     assert user_data["metadata"]["end_of_day"] == 3
+    assert user_data["metadata"]["report_hour"] == 22
 
 
 def test_done_same_email(mocker):
     mocker.patch('widt.config.send_code')
-    mocker.patch('widt.config.DB')
+    mocker.patch('widt.config.META_CACHE')
     context = mocker.MagicMock()
     user_data = {
         "timezone_new": 5,
@@ -151,10 +172,8 @@ def test_done_same_email(mocker):
     reply_text = update.message.reply_text.call_args[0][0]
     assert widt.config.send_code.called == False
     assert reply_text.startswith("All set!")
-    widt.config.DB.collection.return_value.document.\
-        return_value.set.assert_called_once()
-    set_args = widt.config.DB.collection.return_value.\
-        document.return_value.set.call_args[0][0]
+    widt.config.META_CACHE.update.assert_called_once()
+    set_args = widt.config.META_CACHE.update.call_args[0][1]
     assert set_args["end_of_day"] == 3
     assert set_args["timezone"] == 5
     assert set_args["email"] == "good@place.ea"
@@ -165,7 +184,7 @@ def test_done_same_email(mocker):
 
 def test_set_reminder_yes(mocker):
     mocker.patch('widt.config.set_reminder')
-    mocker.patch('widt.config.DB')
+    mocker.patch('widt.config.META_CACHE')
     user_data = {}
     context = mocker.MagicMock()
     context.args = ["yes"]
@@ -174,17 +193,15 @@ def test_set_reminder_yes(mocker):
     set_reminder(update, context)
     reply_text = update.message.reply_text.call_args[0][0]
     assert "will send you reminder" in reply_text
-    widt.config.DB.collection.return_value.document.\
-        return_value.set.assert_called_once()
-    set_args = widt.config.DB.collection.return_value.\
-        document.return_value.set.call_args[0][0]
+    widt.config.META_CACHE.update.assert_called_once()
+    set_args = widt.config.META_CACHE.update.call_args[0][1]
     assert set_args["reminder"] is True
-    assert user_data["reminder"] is True
+    assert "reminder" not in user_data
 
 
 def test_set_reminder_yes(mocker):
     mocker.patch('widt.config.set_reminder')
-    mocker.patch('widt.config.DB')
+    mocker.patch('widt.config.META_CACHE')
     user_data = {}
     context = mocker.MagicMock()
     context.args = ["no"]
@@ -193,9 +210,7 @@ def test_set_reminder_yes(mocker):
     set_reminder(update, context)
     reply_text = update.message.reply_text.call_args[0][0]
     assert "will stop bugging you" in reply_text
-    widt.config.DB.collection.return_value.document.\
-        return_value.set.assert_called_once()
-    set_args = widt.config.DB.collection.return_value.\
-        document.return_value.set.call_args[0][0]
+    widt.config.META_CACHE.update.assert_called_once()
+    set_args = widt.config.META_CACHE.update.call_args[0][1]
     assert set_args["reminder"] is False
-    assert user_data["reminder"] is False
+    assert "reminder" not in user_data
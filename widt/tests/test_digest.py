@@ -0,0 +1,41 @@
+from widt.digest import Digests
+
+
+def test_build_uses_rendered_lines(mocker):
+    digests = Digests()
+    digests.set("1", "1577934000", "Wrote tests", 8)
+    digests.set("1", "1577937600", "Fixed bugs", 8)
+    render_line = mocker.patch('widt.digest.render_line')
+    text, html = digests.build(
+        "1", [("1577934000", "Wrote tests"), ("1577937600", "Fixed bugs")], 8)
+    render_line.assert_not_called()
+    assert text == "* 11:00:00 — Wrote tests\n* 12:00:00 — Fixed bugs"
+    assert html.count("<li>") == 2
+    assert "<li>12:00 — Fixed bugs</li>" in html
+    assert digests.stats()["hits"] == 2
+
+
+def test_build_renders_stale_lines():
+    digests = Digests()
+    digests.set("1", "1577934000", "Wrote tests", 8)
+    digests.set("1", "1577937600", "Fixed bugs", 8)
+    digests.remove("1", "1577937600")
+    # Edited without going through the bot (e.g., before a restart)
+    entries = [("1577934000", "Wrote more tests"), ("1577937600", "Fixed bugs")]
+    text, _ = digests.build("1", entries, 8)
+    assert text == "* 11:00:00 — Wrote more tests\n* 12:00:00 — Fixed bugs"
+    assert digests.stats()["misses"] == 2
+    # The timezone changed
+    text, html = digests.build("1", entries[1:], "America/New_York")
+    assert text == "* 23:00:00 — Fixed bugs"
+    # Empty days
+    assert digests.build("1", [], 8) == ("", "")
+
+
+def test_max_digests():
+    digests = Digests(max_digests=2)
+    for chat_id in ("1", "2", "3"):
+        digests.set(chat_id, "1577934000", "x", 0)
+    assert digests.stats()["digests"] == 2
+    digests.discard("3")
+    assert digests.stats()["digests"] == 1
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from widt.emails import make_payload, render_entries, build_single, substitute, is_batchable
+
+
+def test_substitute_single_pass():
+    text = "%recipient.a% and %recipient.b% and %recipient.c%"
+    assert substitute(text, {"a": "%recipient.b%", "b": "2"}) == (
+        "%recipient.b% and 2 and %recipient.c%")
+
+
+def test_build_single():
+    payload = make_payload(
+        "a@b.c", datetime(2020, 1, 2, 21), render_entries([("10:00", "Wrote tests")]), "What you did today")
+    assert payload["template"] == "normal"
+    assert is_batchable(payload)
+    data = build_single(payload)
+    assert data["to"] == ["a@b.c"]
+    assert data["text"] == "What you did today"
+    assert data["subject"].startswith("20200102 — Congratulation")
+    assert "<li>10:00 — Wrote tests</li>" in data["html"]
+    assert "2020-01-02" in data["html"]
+    assert "%recipient." not in data["html"]
+
+
+def test_not_batchable():
+    payload = make_payload(
+        "a@b.c", datetime(2020, 1, 2, 21), render_entries([("10:00", "50%recipient.x%")]), "")
+    assert not is_batchable(payload)
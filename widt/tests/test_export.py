@@ -0,0 +1,222 @@
+import io
+import gzip
+import zipfile
+from datetime import datetime
+
+from widt.export import OPEN_MONTH, cancel_export, iter_archive, list_archive
+from widt.export_jobs import ExportJob, ExportJobs
+from widt.export_cache import ExportCache
+from widt.storage import MemoryStorage
+
+
+def test_iter_archive(mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    storage.archive["1"] = {
+        "202002": {"20200201-00": {"1580515200-000000": "feb"}},
+        "202001": {
+            "20200102-00": {"1577923200-000000": "jan 2", "1577923300-000000": "jan 2 later"},
+            "20200101-00": {"1577836800-000000": "jan 1"},
+        },
+    }
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 1), datetime(2020, 2, 1))))
+    assert [entry.content for entry in entries] == ["jan 1", "jan 2", "jan 2 later", "feb"]
+    assert entries[0] == ("1577836800-000000", datetime(2020, 1, 1), "jan 1")
+    # Filtered to the range
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 2), datetime(2020, 1, 3))))
+    assert [entry.content for entry in entries] == ["jan 2", "jan 2 later"]
+
+
+def test_iter_archive_repeat_across_months(mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    # Archived by the report of Jan 31 and again (after a failed delete) by that of Feb 1
+    storage.archive["1"] = {
+        "202001": {"20200131-22": {"1580500000-000000": "jan 31"}},
+        "202002": {"20200201-22": {"1580500000-000000": "jan 31", "1580580000-000000": "feb 1"}},
+    }
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 30), datetime(2020, 2, 2))))
+    assert [entry.content for entry in entries] == ["jan 31", "feb 1"]
+
+
+def test_iter_archive_merges_legacy(mocker):
+    storage = mocker.patch('widt.export.STORAGE')
+    storage.query_archive.return_value = iter([
+        (None, "20200101", {"1577840000": "legacy", "1577930000": "legacy later"}),
+        (202001, "20200102-00", {"1577923200-000000": "new"}),
+    ])
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 1), datetime(2020, 2, 1))))
+    assert [entry.content for entry in entries] == ["legacy", "new", "legacy later"]
+
+
+def test_list_archive(mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    storage.archive["1"] = {"202001": {"20200101-00": {"1577840000-000000": "entry"}}}
+    mocker.patch('widt.export.check_config_exists', return_value=True)
+    exports = mocker.patch('widt.export.EXPORTS', ExportJobs(workers=1))
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    update.message.chat_id = 1
+    context.args = ["20200101", "20200131"]
+    context.user_data = {"metadata": {"timezone": 0}}
+    sent = {}
+    # The upload is queued (the mock's return value stands for the pending message)
+    update.effective_chat.send_document.side_effect = lambda fin, filename: sent.update(
+        content=fin.read(), filename=filename) or mocker.DEFAULT
+    list_archive(update, context)
+    exports.join()
+    assert sent["filename"] == "export-20200101-20200131.html"
+    assert b"00:53: entry" in sent["content"]
+    # The progress message
+    assert "queued" in update.message.reply_text.call_args[0][0]
+    progress = update.message.reply_text.return_value.edit_text
+    assert progress.call_args[0][0].endswith("done (1 entries). There you go!")
+
+
+def test_list_archive_formats(mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    storage.archive["1"] = {"202001": {"20200101-00": {"1577840000-000000": "entry"}}}
+    mocker.patch('widt.export.check_config_exists', return_value=True)
+    exports = mocker.patch('widt.export.EXPORTS', ExportJobs(workers=1))
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    update.message.chat_id = 1
+    update.effective_user.id = 42
+    context.user_data = {"metadata": {"timezone": "Asia/Taipei"}}
+    sent = {}
+    update.effective_chat.send_document.side_effect = lambda fin, filename: sent.update(
+        content=fin.read(), filename=filename) or mocker.DEFAULT
+
+    context.args = ["20200101", "20200131", "CSV", "gz"]
+    list_archive(update, context)
+    exports.join()
+    assert sent["filename"] == "export-20200101-20200131.csv.gz"
+    assert gzip.decompress(sent["content"]).decode("utf8").splitlines() == [
+        "date,create_time,update_time,content,user_id",
+        "2020-01-01,2020-01-01T08:53:20+08:00,2020-01-01T08:53:20+08:00,entry,42"]
+
+    context.args = ["20200101", "20200131", "zip", "md"]
+    list_archive(update, context)
+    exports.join()
+    assert sent["filename"] == "export-20200101-20200131.zip"
+    with zipfile.ZipFile(io.BytesIO(sent["content"])) as archive:
+        assert archive.namelist() == ["export-20200101-20200131.md"]
+        assert "+ 08:53: entry" in archive.read("export-20200101-20200131.md").decode("utf8")
+
+
+def test_list_archive_cached(tmp_path, mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    storage.archive["1"] = {
+        "202001": {"20200101-00": {"1577840000-000000": "entry"}},
+        "202002": {"20200203-00": {"1580700000-000000": "after"}},
+    }
+    mocker.spy(storage, "query_archive")
+    cache = mocker.patch('widt.export.EXPORT_CACHE', ExportCache(str(tmp_path)))
+    mocker.patch('widt.export.check_config_exists', return_value=True)
+    exports = mocker.patch('widt.export.EXPORTS', ExportJobs(workers=1))
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    update.message.chat_id = 1
+    context.args = ["20200101", "20200131", "csv"]
+    context.user_data = {"metadata": {"timezone": 0}}
+    sent = []
+    update.effective_chat.send_document.side_effect = lambda fin, filename: (
+        sent.append(fin.read()) or mocker.DEFAULT)
+    for _ in range(2):
+        list_archive(update, context)
+        exports.join()
+    assert sent[0] == sent[1]
+    # The second one was served from the cache
+    assert storage.query_archive.call_count == 1
+    assert update.message.reply_text.return_value.edit_text.call_args[0][0].endswith(
+        "done (1 entries). There you go!")
+    # Reports after the first day past the range don't matter
+    cache.bump([("1", 202003)])
+    list_archive(update, context)
+    exports.join()
+    assert storage.query_archive.call_count == 1
+    # Until the archive of a month in range changes
+    cache.bump([("1", 202002)])
+    list_archive(update, context)
+    exports.join()
+    assert storage.query_archive.call_count == 2
+    assert cache.stats()["hits"] == 2
+
+
+def test_list_archive_bad_options(mocker):
+    mocker.patch('widt.export.check_config_exists', return_value=True)
+    mocker.patch('widt.export.is_available', return_value=False)
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    for options in (["pdf"], ["gz", "zip"], ["md", "csv"], ["csv", "gz", "csv"]):
+        context.args = ["20200101", "20200131"] + options
+        list_archive(update, context)
+        assert "Failed to parse the options" in update.message.reply_text.call_args[0][0]
+    context.args = ["20200101", "20200131", "parquet"]
+    list_archive(update, context)
+    assert "isn't available" in update.message.reply_text.call_args[0][0]
+    update.effective_chat.send_document.assert_not_called()
+
+
+def test_list_archive_rejected(mocker):
+    mocker.patch('widt.export.check_config_exists', return_value=True)
+    exports = mocker.patch('widt.export.EXPORTS', ExportJobs(workers=1, max_queued=0))
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    context.args = ["20200101", "20200131"]
+    context.user_data = {"metadata": {"timezone": 0}}
+    list_archive(update, context)
+    # Rejected before anything says it was queued
+    update.message.reply_text.assert_called_once()
+    assert "Too many exports" in update.message.reply_text.call_args[0][0]
+    assert exports.stats()["rejected"] == 1
+
+
+def test_cancel_export(mocker):
+    exports = mocker.patch('widt.export.EXPORTS')
+    exports.cancel.return_value = []
+    update, context = mocker.MagicMock(), mocker.MagicMock()
+    update.effective_user.id = 42
+    context.args = ["abc123"]
+    cancel_export(update, context)
+    exports.cancel.assert_called_once_with(42, "abc123")
+    assert update.message.reply_text.call_args[0][0] == "Export abc123 isn't in progress."
+    job = ExportJob(1, 42)
+    job.uploading = True
+    exports.cancel.return_value = [job]
+    cancel_export(update, context)
+    assert "can't be canceled" in update.message.reply_text.call_args[0][0]
+
+
+def test_iter_archive_prunes_days(mocker):
+    storage = mocker.patch('widt.export.STORAGE')
+    untouched = mocker.MagicMock()
+    untouched.__iter__.side_effect = AssertionError("decoded")
+    untouched.items.side_effect = AssertionError("decoded")
+    storage.query_archive.return_value = iter([
+        (None, "20190101", untouched),
+        (202001, "20200105-21", untouched),
+        (202001, "20200131-21", {"1580472000-000000": "jan 31"}),
+        (202002, "20200201-03", {"1580500000-000000": "jan 31 late"}),
+        (202002, "20200220-21", {"1582200000-000000": "feb 20"}),
+        (202003, "20200301-21", untouched),
+    ])
+    months = []
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 31), datetime(2020, 1, 31, 23, 59)), months))
+    assert [entry.content for entry in entries] == ["jan 31", "jan 31 late"]
+    # The months are read until a day starts after the range
+    assert storage.query_archive.call_args[0][:2] == (1, 202001)
+    assert months == [202001, 202002]
+
+
+def test_iter_archive_late_report(mocker):
+    storage = mocker.patch('widt.export.STORAGE', MemoryStorage())
+    # Reported days later, after an outage
+    storage.archive["1"] = {"202001": {
+        "20200110-21": {"1578225600-000000": "jan 5", "1578657600-000000": "jan 10"},
+        "20200111-21": {"1578744000-000000": "jan 11"},
+    }}
+    months = []
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 1), datetime(2020, 1, 5, 23, 59)), months))
+    assert [entry.content for entry in entries] == ["jan 5"]
+    assert months == [201912, 202001]
+    # In the next month too
+    storage.archive["1"] = {"202002": {"20200203-21": {"1578225600-000000": "jan 5"}}}
+    months = []
+    entries = list(iter_archive(1, 0, (datetime(2020, 1, 1), datetime(2020, 1, 5, 23, 59)), months))
+    assert [entry.content for entry in entries] == ["jan 5"]
+    # Later reports may still add to the range
+    assert months == [201912, OPEN_MONTH]
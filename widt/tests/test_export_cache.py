@@ -0,0 +1,66 @@
+import io
+
+from widt.export_cache import ExportCache
+
+
+def test_get_and_bump(tmp_path):
+    cache = ExportCache(str(tmp_path), max_size=1000)
+    assert cache.get(1, "a.csv") is None
+    version = cache.version()
+    cache.put(1, "a.csv", 202001, 202003, version, 2, io.BytesIO(b"a,b"))
+    cached = cache.get(1, "a.csv")
+    with cached.file:
+        assert cached.file.read() == b"a,b"
+    assert cached.entries == 2
+    # Writes to other chats and months don't matter
+    cache.bump([("2", 202002), ("1", 202004)])
+    assert cache.get("1", "a.csv") is not None
+    cache.bump([("1", 202003)])
+    assert cache.get(1, "a.csv") is None
+    assert cache.stats() == {"files": 0, "bytes": 0, "hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+def test_put_after_bump_is_stale(tmp_path):
+    cache = ExportCache(str(tmp_path), max_size=1000)
+    version = cache.version()
+    # Written while the export was reading the archive
+    cache.bump([("1", 202001)])
+    cache.put(1, "a.csv", 202001, 202001, version, 1, io.BytesIO(b"a"))
+    assert cache.get(1, "a.csv") is None
+
+
+def test_survives_restart(tmp_path):
+    cache = ExportCache(str(tmp_path), max_size=1000)
+    cache.put(1, "a.csv", 202001, 202001, cache.version(), 1, io.BytesIO(b"a"))
+    cache.bump([("1", 202002)])
+    cache = ExportCache(str(tmp_path), max_size=1000)
+    assert cache.version() == 1
+    assert cache.get(1, "a.csv").file.read() == b"a"
+
+
+def test_lru_eviction(tmp_path, mocker):
+    now = mocker.patch('widt.export_cache.time.time', return_value=100)
+    cache = ExportCache(str(tmp_path), max_size=10)
+    cache.put(1, "a", 202001, 202001, 0, 1, io.BytesIO(b"aaaa"))
+    now.return_value = 101
+    cache.put(1, "b", 202001, 202001, 0, 1, io.BytesIO(b"bbbb"))
+    now.return_value = 102
+    cache.get(1, "a").file.close()
+    now.return_value = 103
+    cache.put(1, "c", 202001, 202001, 0, 1, io.BytesIO(b"cccc"))
+    assert cache.get(1, "b") is None
+    assert cache.get(1, "a") is not None
+    assert cache.stats()["bytes"] == 8
+    # Too large to cache
+    cache.put(1, "d", 202001, 202001, 0, 1, io.BytesIO(b"d" * 11))
+    assert cache.get(1, "d") is None
+    assert {path.name for path in tmp_path.iterdir() if not path.name.startswith("index")} == {
+        cache._name("1", "a"), cache._name("1", "c")}
+
+
+def test_disabled():
+    cache = ExportCache("", max_size=1000)
+    cache.bump([("1", 202001)])
+    cache.put(1, "a", 202001, 202001, cache.version(), 1, io.BytesIO(b"a"))
+    assert cache.get(1, "a") is None
+    assert cache.stats()["files"] == 0
@@ -0,0 +1,108 @@
+import io
+import json
+import gzip
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from widt.export_formats import (
+    ExportEntry, compressed, export_filename, export_row, is_available, write_export
+)
+import widt.export_formats
+
+ENTRIES = [
+    ExportEntry("1577865600-000000", datetime(2020, 1, 1, 8, 0), "first"),
+    ExportEntry("1577871000-000000", datetime(2020, 1, 1, 9, 30), "**second**"),
+    ExportEntry("1577959200-000000", datetime(2020, 1, 2, 10, 0), "(prev) third, \"quoted\""),
+]
+UTC = timezone.utc
+
+
+def _write(export_format, entries=ENTRIES):
+    fout = io.BytesIO()
+    assert write_export(export_format, iter(entries), fout, UTC, 42) == len(entries)
+    return fout.getvalue().decode("utf8")
+
+
+def test_export_row():
+    assert export_row("1577959200", "prev done", timezone(timedelta(hours=8)), 42) == {
+        "date": date(2020, 1, 1),
+        "create_time": "2020-01-02T18:00:00+08:00",
+        "update_time": "2020-01-02T18:00:00+08:00",
+        "content": "done",
+        "user_id": "42",
+    }
+
+
+def test_write_html():
+    html = _write("html")
+    assert html.index("<h2>2020-01-01</h2>") < html.index("<li>08:00: first</li>")
+    assert "<li>09:30: <strong>second</strong></li>" in html
+    assert html.count("<h2>") == 2
+
+
+def test_write_markdown():
+    assert _write("md") == (
+        "\n## 2020-01-01\n\n+ 08:00: first\n+ 09:30: **second**\n"
+        "\n## 2020-01-02\n\n+ 10:00: (prev) third, \"quoted\"\n")
+
+
+def test_write_csv(mocker):
+    mocker.patch('widt.export_formats.CHUNK_SIZE', 10)
+    assert _write("csv").splitlines() == [
+        "date,create_time,update_time,content,user_id",
+        "2020-01-01,2020-01-01T08:00:00+00:00,2020-01-01T08:00:00+00:00,first,42",
+        "2020-01-01,2020-01-01T09:30:00+00:00,2020-01-01T09:30:00+00:00,**second**,42",
+        '2020-01-01,2020-01-02T10:00:00+00:00,2020-01-02T10:00:00+00:00,"third, ""quoted""",42',
+    ]
+
+
+def test_write_jsonl():
+    rows = [json.loads(line) for line in _write("jsonl").splitlines()]
+    assert rows[2] == {
+        "date": "2020-01-01", "create_time": "2020-01-02T10:00:00+00:00",
+        "update_time": "2020-01-02T10:00:00+00:00", "content": "third, \"quoted\"", "user_id": "42"}
+
+
+def test_write_parquet():
+    pl = pytest.importorskip("polars")
+    fout = io.BytesIO()
+    write_export("parquet", ENTRIES, fout, UTC, 42)
+    fout.seek(0)
+    frame = pl.read_parquet(fout)
+    assert frame.columns == list(widt.export_formats.COLUMNS)
+    assert frame["content"].to_list() == ["first", "**second**", "third, \"quoted\""]
+
+
+@pytest.mark.parametrize("compression", ["gz", "zip"])
+def test_write_parquet_compressed(compression):
+    pl = pytest.importorskip("polars")
+    fout = io.BytesIO()
+    with compressed(fout, compression, "export.parquet") as stream:
+        write_export("parquet", ENTRIES, stream, UTC, 42)
+    if compression == "gz":
+        data = gzip.decompress(fout.getvalue())
+    else:
+        with zipfile.ZipFile(io.BytesIO(fout.getvalue())) as archive:
+            data = archive.read("export.parquet")
+    frame = pl.read_parquet(io.BytesIO(data))
+    assert frame["date"].to_list() == [date(2020, 1, 1)] * 3
+    assert frame["user_id"].to_list() == ["42"] * 3
+
+
+def test_is_available(mocker):
+    assert is_available("csv")
+    assert not is_available("pdf")
+    mocker.patch('widt.export_formats.importlib.util.find_spec', return_value=None)
+    assert not is_available("parquet")
+
+
+def test_compressed():
+    fout = io.BytesIO()
+    with compressed(fout, "gz", "export.csv") as stream:
+        stream.write(b"a,b\n")
+    assert gzip.decompress(fout.getvalue()) == b"a,b\n"
+    assert export_filename("export", "csv", "gz") == "export.csv.gz"
+    assert export_filename("export", "csv", "zip") == "export.zip"
+    assert export_filename("export", "csv", None) == "export.csv"
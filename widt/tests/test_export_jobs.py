@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+from widt.export_jobs import ExportCanceled, ExportJob, ExportJobs, ExportRejected
+
+
+def _blocking_run(started: threading.Event, release: threading.Event):
+    def run(job):
+        started.set()
+        for _ in job.track(iter(lambda: release.wait(0.01), True)):
+            pass
+    return run
+
+
+def test_submit_runs_job(mocker):
+    jobs = ExportJobs(workers=1)
+    message = mocker.MagicMock()
+    job = ExportJob(1, 42, message)
+    jobs.submit(job, lambda job: list(job.track(range(3))))
+    jobs.join()
+    assert job.count == 3
+    message.edit_text.assert_called_once_with(f"Export {job.id}: collecting entries...")
+    assert jobs.stats() == {
+        "completed": 1, "failed": 0, "canceled": 0, "rejected": 0, "queued": 0, "running": 0}
+    jobs.stop()
+
+
+def test_failed_job(mocker):
+    jobs = ExportJobs(workers=1)
+    job = ExportJob(1, 42, mocker.MagicMock())
+
+    def run(job):
+        raise RuntimeError("unavailable")
+    jobs.submit(job, run)
+    jobs.join()
+    assert "failed" in job.message.edit_text.call_args[0][0]
+    assert jobs.stats()["failed"] == 1
+    jobs.stop()
+
+
+def test_limits_and_cancel(mocker):
+    jobs = ExportJobs(workers=1, max_queued=1, user_limit=1)
+    started, release = threading.Event(), threading.Event()
+    running = ExportJob(1, 42, mocker.MagicMock())
+    jobs.submit(running, _blocking_run(started, release))
+    assert started.wait(5)
+    # One job per user
+    with pytest.raises(ExportRejected):
+        jobs.submit(ExportJob(1, 42), _blocking_run(started, release))
+    queued = ExportJob(2, 43, mocker.MagicMock())
+    jobs.submit(queued, _blocking_run(started, release))
+    # The queue is full
+    with pytest.raises(ExportRejected):
+        jobs.submit(ExportJob(3, 44), _blocking_run(started, release))
+    assert jobs.stats()["queued"] == 1
+    assert jobs.stats()["running"] == 1
+    assert jobs.stats()["rejected"] == 2
+
+    # A queued job is dropped right away
+    assert jobs.cancel(43) == [queued]
+    assert queued.future.cancelled()
+    assert queued.message.edit_text.call_args[0][0] == f"Export {queued.id}: canceled."
+    # A running one stops at its next entry
+    assert jobs.cancel(42, "other") == []
+    assert jobs.cancel(42, running.id) == [running]
+    jobs.join()
+    with pytest.raises(ExportCanceled):
+        next(running.track([1]))
+    assert running.message.edit_text.call_args[0][0] == f"Export {running.id}: canceled."
+    assert jobs.stats() == {
+        "completed": 0, "failed": 0, "canceled": 2, "rejected": 2, "queued": 0, "running": 0}
+    jobs.stop()
+def test_announce_before_start(mocker):
+    jobs = ExportJobs(workers=1)
+    job = ExportJob(1, 42)
+    ran = []
+
+    def announce(job, queued):
+        assert job.future is None and queued == 0
+        job.message = mocker.MagicMock()
+    jobs.submit(job, ran.append, announce)
+    jobs.join()
+    assert ran == [job]
+    job.message.edit_text.assert_called_once_with(f"Export {job.id}: collecting entries...")
+
+    # A failed announcement frees the slot
+    def broken(job, queued):
+        raise RuntimeError()
+    with pytest.raises(RuntimeError):
+        jobs.submit(ExportJob(1, 42), ran.append, broken)
+    assert jobs.stats()["queued"] == 0
+    jobs.submit(ExportJob(1, 42), ran.append)
+    jobs.join()
+    assert len(ran) == 2
+
+
+def test_cancel_during_upload(mocker):
+    jobs = ExportJobs(workers=1)
+    uploading, release = threading.Event(), threading.Event()
+
+    def run(job):
+        job.start_upload()
+        uploading.set()
+        release.wait(5)
+    job = ExportJob(1, 42, mocker.MagicMock())
+    jobs.submit(job, run)
+    assert uploading.wait(5)
+    assert jobs.cancel(42) == [job]
+    assert job.uploading and not job.canceled
+    release.set()
+    jobs.join()
+    assert jobs.stats()["completed"] == 1
+
+    # Canceled before the upload starts
+    job = ExportJob(1, 42)
+    assert job.cancel()
+    with pytest.raises(ExportCanceled):
+        job.start_upload()
+    assert not job.uploading
+
+
+def test_progress_is_throttled(mocker):
+    monotonic = mocker.patch('widt.export_jobs.time.monotonic', return_value=100)
+    job = ExportJob(1, 42, mocker.MagicMock())
+    job.progress("a")
+    job.progress("b")
+    monotonic.return_value = 103
+    job.progress("c")
+    job.progress("d", force=True)
+    monotonic.return_value = 110
+    job.progress("e")
+    assert [call[0][0][-1] for call in job.message.edit_text.call_args_list] == ["a", "d", "e"]
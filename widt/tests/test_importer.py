@@ -0,0 +1,139 @@
+import io
+from datetime import datetime
+
+import pytest
+from telegram.ext import ConversationHandler
+
+from widt.importer import (
+    Importer, RecordError, import_file, parse_records, _read_csv, _read_jsonl, _read_text
+)
+from widt.storage import MemoryStorage, key_timestamp
+import widt.importer
+import widt.live
+
+
+def _parse(reader, text, timezone=8):
+    return list(parse_records(io.StringIO(text), reader, timezone))
+
+
+def test_parse_text():
+    records = _parse(_read_text, (
+        "2020-01-02 10:00 Wrote tests\n"
+        "\n"
+        "2020-01-02 10:00:30 Fixed bugs\n"
+        "Not an entry\n"
+        "2999-01-01 10:00 From the future\n"
+    ))
+    assert records[:2] == [(1577930400, "Wrote tests"), (1577930430, "Fixed bugs")]
+    assert [str(error) for error in records[2:]] == [
+        'line 4: expected "YYYY-MM-DD HH:MM content"',
+        "line 5: the time is in the future"]
+
+
+def test_parse_csv_and_jsonl():
+    records = _parse(_read_csv, (
+        "date,create_time,content\n"
+        "2020-01-02,2020-01-02T10:00:00+08:00,Wrote tests\n"
+        "2020-01-02,,No time\n"
+    ), timezone="America/New_York")
+    assert records[0] == (1577930400, "Wrote tests")
+    assert isinstance(records[1], RecordError)
+    records = _parse(_read_jsonl, (
+        '{"time": "2020-01-02T02:00:00Z", "content": "Wrote tests"}\n'
+        '{"time": "2020-01-02 10:00", "content": ""}\n'
+        "[1, 2]\n"
+        "{\n"
+    ))
+    assert records[0] == (1577930400, "Wrote tests")
+    assert [str(error) for error in records[1:]] == [
+        "line 2: missing time or content",
+        "line 3: expected an object",
+        "line 4: invalid JSON"]
+
+
+def test_importer_write(mocker):
+    storage = mocker.patch('widt.importer.STORAGE', MemoryStorage())
+    mocker.patch('widt.importer.LIVE')
+    mocker.patch('widt.importer.previous_report_time', return_value=datetime(2020, 1, 2, 14, 30))
+    mocker.patch('widt.importer.uuid.uuid4').return_value.hex = "abcdef0123456789"
+    importer = Importer(1, {"timezone": 8, "end_of_day": 21})
+    importer.write([
+        # 2020-01-02 10:00 and 22:00 (+08:00)
+        (1577930400, "a"), (1577930400, "b"), (1577973600, "c"),
+        # After the last report: today
+        (1577975500, "d"),
+    ])
+    widt.importer.LIVE.write.assert_called_once_with("1", {"1577975500-iabcdef01000000": "d"})
+    assert storage.archive == {"1": {"202001": {
+        "20200102-21": {"1577930400-iabcdef01000000": "a", "1577930400-iabcdef01000001": "b"},
+        "20200103-21": {"1577973600-iabcdef01000000": "c"}}}}
+    assert importer.summary() == (
+        "Imported 4 entries (1 for today, 3 into the archive of 1 months).")
+
+
+def test_importer_keys_unique_across_imports(mocker):
+    mocker.patch('widt.importer.previous_report_time', return_value=datetime(2020, 1, 2, 14, 30))
+    metadata = {"timezone": 8, "end_of_day": 21}
+    first, second = Importer(1, metadata), Importer(1, metadata)
+    # The same second in two imports
+    assert first._key(1577930400) != second._key(1577930400)
+    assert key_timestamp(second._key(1577930400)) == 1577930400
+
+
+def test_importer_write_failed(mocker):
+    mocker.patch('widt.importer.STORAGE').append_archive.side_effect = RuntimeError("unavailable")
+    mocker.patch('widt.importer.LIVE')
+    mocker.patch('widt.importer.EXPORT_CACHE')
+    mocker.patch('widt.importer.previous_report_time', return_value=datetime(2020, 1, 2, 14, 30))
+    importer = Importer(1, {"timezone": 8, "end_of_day": 21})
+    with pytest.raises(RuntimeError):
+        importer.write([(1577930400, "a")])
+    # Only what was written counts
+    assert importer.archived == 0
+
+
+def test_import_file(mocker):
+    mocker.patch('widt.importer.Importer.write', autospec=True)
+    mocker.patch('widt.importer.IMPORT_CHUNK', 2)
+    content = "".join(f"2020-01-02 10:{i:02d} Entry {i}\n" for i in range(5)) + "oops\n"
+    context = mocker.MagicMock()
+    context.user_data = {"metadata": {"timezone": 8, "end_of_day": 21}}
+    context.bot.get_file.return_value.download.side_effect = \
+        lambda out: out.write(content.encode())
+    update = mocker.MagicMock()
+    update.message.document.file_name = "entries.txt"
+    update.message.document.file_size = len(content)
+    assert import_file(update, context) == ConversationHandler.END
+    chunks = [call[0][1] for call in widt.importer.Importer.write.call_args_list]
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    message = update.message.reply_text.return_value.edit_text.call_args[0][0]
+    assert "Skipped 1 invalid records" in message
+
+
+def test_import_file_failed(mocker):
+    written = []
+
+    def write(importer, chunk):
+        if written:
+            raise RuntimeError("unavailable")
+        written.append(chunk)
+        importer.archived += len(chunk)
+    mocker.patch('widt.importer.Importer.write', autospec=True, side_effect=write)
+    mocker.patch('widt.importer.IMPORT_CHUNK', 2)
+    content = "".join(f"2020-01-02 10:{i:02d} Entry {i}\n" for i in range(5))
+    context = mocker.MagicMock()
+    context.user_data = {"metadata": {"timezone": 8, "end_of_day": 21}}
+    context.bot.get_file.return_value.download.side_effect = \
+        lambda out: out.write(content.encode())
+    update = mocker.MagicMock()
+    update.message.document.file_name = "entries.txt"
+    update.message.document.file_size = len(content)
+    assert import_file(update, context) == ConversationHandler.END
+    message = update.message.reply_text.return_value.edit_text.call_args[0][0]
+    assert message == "Sorry, the import failed after 2 entries were written. Please try again later."
+
+
+def test_import_file_wrong_type(mocker):
+    update = mocker.MagicMock()
+    update.message.document.file_name = "entries.pdf"
+    assert import_file(update, mocker.MagicMock()) == widt.importer.UPLOAD
@@ -1,60 +1,123 @@
+from datetime import datetime
+
+from telegram import Chat, Message, MessageEntity, Update, User
 from telegram.ext import ConversationHandler
 
-from widt.journal import journal, journal_confirm, CONFIRM
+from widt.journal import (
+    add_journal_handlers, journal, journal_confirm, edit_select, edit_op, edit_confirm,
+    edit_list, EDIT, CONFIRM
+)
+from widt.live import is_legacy_key
+from widt.storage import MemoryStorage
 import widt.journal
 
 
+def _callback(mocker, data, reply_to=None):
+    update = mocker.MagicMock()
+    update.callback_query.data = data
+    update.callback_query.message.chat_id = 123
+    update.callback_query.message.reply_to_message = reply_to
+    return update
+
+
 def test_journal_positive(mocker):
     # pretend hat the test user already has config set
     mocker.patch('widt.journal.check_config_exists')
     widt.journal.check_config_exists.return_value = True
     context = mocker.MagicMock()
     context.chat_data = {}
+    context.user_data = {"metadata": {"timezone": 8}}
     update = mocker.MagicMock()
     text = "Test entry"
     update.message.text = text
-    assert journal(update, context) == CONFIRM
-    assert context.chat_data["pending"] == text
-    args, _ = update.message.reply_text.call_args
-    assert text in args[0]
+    update.message.message_id = 42
+    journal(update, context)
+    _, kwargs = update.message.reply_text.call_args
+    assert kwargs["quote"] is True
+    buttons = kwargs["reply_markup"].inline_keyboard[0]
+    assert buttons[0].callback_data == "journal:save:42"
+    # Nothing is kept in chat_data
+    assert context.chat_data == {}
     # confirm
-    mocker.patch('widt.journal.DB')
-    update = mocker.MagicMock()
-    update.message.text = "y"
-    update.message.chat_id = 123
-    assert journal_confirm(update, context) == ConversationHandler.END
-    args, _ = update.message.reply_text.call_args
-    assert args[0] == "Done!"
-    widt.journal.DB.collection.assert_called_once_with("live")
-    widt.journal.DB.collection.return_value.document.assert_called_once_with(
-        "123")
-    widt.journal.DB.collection.return_value.document.return_value.set.assert_called_once()
-    args, kwargs = widt.journal.DB.collection.return_value.document.return_value.set.call_args
-    assert list(args[0].values())[0] == text
-    assert kwargs["merge"] is True
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    mocker.patch('widt.journal.DIGESTS')
+    update = _callback(mocker, "journal:save:42", update.message)
+    journal_confirm(update, context)
+    update.callback_query.answer.assert_called_once()
+    update.callback_query.edit_message_text.assert_called_once_with("Saved!")
+    [(key, item)] = storage.live["123"].items()
+    assert item == text
+    assert not is_legacy_key(key)
+    widt.journal.DIGESTS.set.assert_called_once_with(123, key, text, 8)
 
 
 def test_journal_negative(mocker):
-    # pretend hat the test user already has config set
-    mocker.patch('widt.journal.check_config_exists')
-    widt.journal.check_config_exists.return_value = True
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    context = mocker.MagicMock()
+    entry = mocker.MagicMock()
+    entry.message_id, entry.text = 42, "Test entry"
+    update = _callback(mocker, "journal:discard:42", entry)
+    journal_confirm(update, context)
+    update.callback_query.edit_message_text.assert_called_once_with("Discarded.")
+    assert storage.live == {}
+    # The quoted message is gone
+    update = _callback(mocker, "journal:save:42", None)
+    journal_confirm(update, context)
+    update.callback_query.edit_message_text.assert_called_once_with("Cannot find the entry!")
+    assert storage.live == {}
+
+
+def test_edit(mocker):
+    mocker.patch('widt.journal.LIVE')
+    mocker.patch('widt.journal.DIGESTS')
+    widt.journal.LIVE.entries.return_value = [
+        ("1500000000-000001", "Old entry")]
     context = mocker.MagicMock()
     context.chat_data = {}
+    context.user_data = {"metadata": {"timezone": 8}}
+    update = _callback(mocker, "edit:pick:1500000000-000001")
+    assert edit_select(update, context) == EDIT
+    assert context.chat_data == {"editing": "1500000000-000001"}
+    assert "Old entry" in update.callback_query.edit_message_text.call_args[0][0]
+
     update = mocker.MagicMock()
-    text = "Test entry"
-    update.message.text = text
-    assert journal(update, context) == CONFIRM
-    assert context.chat_data["pending"] == text
-    args, _ = update.message.reply_text.call_args
-    assert text in args[0]
-    # confirm
-    mocker.patch('widt.journal.DB')
-    update = mocker.MagicMock()
-    update.message.text = "n"
-    update.message.chat_id = 123
-    assert journal_confirm(update, context) == ConversationHandler.END
-    args, _ = update.message.reply_text.call_args
-    assert args[0] == "Canceled!"
-    assert widt.journal.DB.collection.called == False
-    assert widt.journal.DB.collection.return_value.document.called == False
-    assert widt.journal.DB.collection.return_value.document.return_value.set.called == False
+    update.message.text = "New entry"
+    assert edit_op(update, context) == CONFIRM
+    _, kwargs = update.message.reply_text.call_args
+    assert kwargs["reply_markup"].inline_keyboard[0][0].callback_data == (
+        "edit:save:1500000000-000001")
+
+    update = _callback(mocker, "edit:save:1500000000-000001", update.message)
+    assert edit_confirm(update, context) == ConversationHandler.END
+    widt.journal.LIVE.write.assert_called_once_with(
+        123, {"1500000000-000001": "New entry"})
+    assert context.chat_data == {}
+
+
+def test_edit_delete(mocker):
+    mocker.patch('widt.journal.LIVE')
+    mocker.patch('widt.journal.DIGESTS')
+    context = mocker.MagicMock()
+    context.chat_data = {"editing": "1500000000"}
+    update = _callback(mocker, "edit:remove:1500000000")
+    assert edit_confirm(update, context) == ConversationHandler.END
+    widt.journal.LIVE.write.assert_called_once_with(
+        123, {"1500000000": None})
+    widt.journal.DIGESTS.remove.assert_called_once_with(123, "1500000000")
+
+
+def test_edit_reentry(mocker):
+    dp = mocker.MagicMock()
+    dp.persistence = None
+    add_journal_handlers(dp)
+    handler = next(
+        call[0][0] for call in dp.add_handler.call_args_list
+        if isinstance(call[0][0], ConversationHandler))
+    assert handler.conversation_timeout == widt.journal.EDIT_TIMEOUT
+    # An abandoned menu doesn't swallow the next /edit
+    handler.conversations[(10, 1)] = EDIT
+    message = Message(
+        1, User(1, "a", False), datetime.now(), Chat(10, "private"), text="/edit",
+        entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, 5)], bot=mocker.MagicMock())
+    _, entry_point, _ = handler.check_update(Update(1, message=message))
+    assert entry_point.callback is edit_list
@@ -0,0 +1,114 @@
+import pytest
+
+from widt.live import LiveStore, new_key, is_legacy_key, key_timestamp
+from widt.storage import MemoryStorage
+
+
+def test_new_key():
+    keys = [new_key() for _ in range(1000)]
+    assert len(set(keys)) == 1000
+    assert keys == sorted(keys)
+    assert not any(is_legacy_key(key) for key in keys)
+    assert key_timestamp(keys[0]) == int(keys[0][:10])
+    assert key_timestamp("1500000000") == 1500000000
+
+
+def test_write_through(mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    storage.live["1"] = {"1500000000-000002": "x"}
+    mocker.spy(storage, "write_live")
+    store = LiveStore(write_behind=False)
+    store.write(1, {"1500000000-000001": "a", "1500000000-000002": None})
+    storage.write_live.assert_called_once_with(
+        {"1": {"1500000000-000001": "a", "1500000000-000002": None}})
+    assert storage.live == {"1": {"1500000000-000001": "a"}}
+
+
+def test_write_through_fails(mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    mocker.patch.object(storage, "write_live", return_value=["1"])
+    store = LiveStore(write_behind=False)
+    with pytest.raises(RuntimeError):
+        store.write(1, {"1500000000-000001": "a"})
+
+
+def test_write_behind_coalesces(tmp_path, mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    storage.live["1"] = {"1499999999": "x", "1500000001": "old"}
+    mocker.spy(storage, "write_live")
+    store = LiveStore(write_behind=True, journal_path=str(tmp_path / "live.journal"))
+    store.write(1, {"1500000000": "a"})
+    store.write(1, {"1500000001": "b"})
+    store.write(1, {"1500000000": "c"})
+    store.write(2, {"1500000002": "d"})
+    store.write(1, {"1500000001": None})
+    assert storage.write_live.called is False
+    # Reads see the pending writes
+    assert store.entries(1) == [("1499999999", "x"), ("1500000000", "c")]
+
+    store.flush([1])
+    storage.write_live.assert_called_once_with({"1": {"1500000000": "c", "1500000001": None}})
+    assert storage.live["1"] == {"1499999999": "x", "1500000000": "c"}
+    # Only chat 2 is left in the journal
+    recovered = LiveStore(write_behind=True, journal_path=str(tmp_path / "live.journal"))
+    recovered.recover()
+    assert recovered._pending == {"2": {"1500000002": "d"}}
+    store.flush()
+    assert not (tmp_path / "live.journal").exists()
+
+
+def test_write_behind_recovers(tmp_path, mocker):
+    mocker.patch('widt.live.STORAGE', MemoryStorage())
+    path = str(tmp_path / "live.journal")
+    store = LiveStore(write_behind=True, journal_path=path)
+    store.write(1, {"1500000000": "a"})
+    store.write(1, {"1500000001": None})
+    # A write torn by a crash
+    with open(path, "a") as fout:
+        fout.write('{"chat_id": "1", "fie')
+    recovered = LiveStore(write_behind=True, journal_path=path)
+    recovered.recover()
+    assert recovered._pending == {
+        "1": {"1500000000": "a", "1500000001": None}}
+
+
+def test_failed_flush_keeps_writes(tmp_path, mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    mocker.patch.object(storage, "write_live", return_value=["1"])
+    path = str(tmp_path / "live.journal")
+    store = LiveStore(write_behind=True, journal_path=path)
+    store.write(1, {"1500000000": "a"})
+    with pytest.raises(RuntimeError):
+        store.flush()
+    assert store._pending == {"1": {"1500000000": "a"}}
+    recovered = LiveStore(write_behind=True, journal_path=path)
+    recovered.recover()
+    assert recovered._pending == store._pending
+
+
+def test_entries_cache(mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    storage.live["1"] = {"1500000001": "b", "1500000000": "a"}
+    mocker.spy(storage, "read_live")
+    store = LiveStore(write_behind=False, cache_size=2)
+    assert store.entries(1) == [("1500000000", "a"), ("1500000001", "b")]
+    store.write(1, {"1500000002": "c", "1499999999": "z"})
+    store.write(1, {"1500000000": None, "1500000001": "B"})
+    for _ in range(3):
+        assert store.entries(1) == [("1499999999", "z"), ("1500000001", "B"), ("1500000002", "c")]
+    assert storage.read_live.call_count == 1
+    assert store.stats()["hits"] == 3
+    # Least recently used chats are dropped
+    assert store.entries(2) == []
+    assert store.entries(3) == []
+    assert sorted(store._cache) == ["2", "3"]
+    store.invalidate([2])
+    assert sorted(store._cache) == ["3"]
+
+
+def test_collect(mocker):
+    storage = mocker.patch('widt.live.STORAGE', MemoryStorage())
+    storage.live["1"] = {"1500000000": "legacy", "1500000001-000000": "a", "1500000100-000000": "b"}
+    store = LiveStore(write_behind=False)
+    assert store.collect(["1", "2"], 1500000050) == {
+        "1": {"1500000000": "legacy", "1500000001-000000": "a"}, "2": {}}
@@ -0,0 +1,79 @@
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from widt.mailgun import send_message
+import widt.mailgun
+
+
+class MailgunStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, parse_qs(body.decode())))
+        self.server.client_ports.add(self.client_address[1])
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        payload = b'{"message": "Queued. Thank you."}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mailgun(mocker):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MailgunStandIn)
+    server.received, server.client_ports, server.statuses = [], set(), []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    mocker.patch('widt.mailgun.MAILGUN_API_BASE',
+                 f"http://127.0.0.1:{server.server_port}/v3")
+    mocker.patch('widt.mailgun.MAILGUN_DOMAIN', "example.com")
+    mocker.patch('widt.mailgun.MAILGUN_API_KEY', "key")
+    mocker.patch('widt.mailgun.BACKOFF_MS', 1)
+    mocker.patch('widt.mailgun._SESSION', None)
+    yield server
+    if widt.mailgun._SESSION is not None:
+        widt.mailgun._SESSION.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_send_message_reuses_connection(mailgun):
+    for i in range(3):
+        res = send_message({"to": ["a@b.c"], "subject": str(i), "text": "hi"})
+        assert res.status_code == 200
+    assert len(mailgun.received) == 3
+    path, form = mailgun.received[0]
+    assert path == "/v3/example.com/messages"
+    assert form["to"] == ["a@b.c"]
+    assert form["from"] == [widt.mailgun.SENDER]
+    # keep-alive: every request went through the same connection
+    assert len(mailgun.client_ports) == 1
+
+
+def test_send_message_retries(mailgun):
+    mailgun.statuses = [429, 503]
+    res = send_message({"to": ["a@b.c"], "subject": "s", "text": "hi"})
+    assert res.status_code == 200
+    assert len(mailgun.received) == 3
+
+
+def test_send_message_gives_up(mailgun, mocker):
+    mocker.patch('widt.mailgun.MAX_ATTEMPTS', 2)
+    mailgun.statuses = [500, 500, 500]
+    res = send_message({"to": ["a@b.c"], "subject": "s", "text": "hi"})
+    assert res.status_code == 500
+    assert len(mailgun.received) == 2
+
+
+def test_send_message_not_configured(mocker):
+    mocker.patch('widt.mailgun.MAILGUN_API_KEY', "")
+    assert send_message({"to": ["a@b.c"]}) is None
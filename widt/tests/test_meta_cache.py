@@ -0,0 +1,79 @@
+from widt.meta_cache import MetaCache
+from widt.storage import MemoryStorage
+
+
+def test_get_caches(mocker):
+    storage = mocker.patch('widt.meta_cache.STORAGE', MemoryStorage())
+    storage.meta["1"] = {"timezone": 8}
+    mocker.spy(storage, "get_meta")
+    cache = MetaCache(ttl=60, max_size=10)
+    assert cache.get(1) == {"timezone": 8}
+    # Callers get copies
+    cache.get(1)["timezone"] = 0
+    assert cache.get("1") == {"timezone": 8}
+    assert storage.get_meta.call_count == 1
+    assert cache.stats() == {"cached": 1, "hits": 2, "misses": 1}
+    # Forced reread
+    cache.get(1, refresh=True)
+    assert storage.get_meta.call_count == 2
+
+
+def test_get_missing_and_expired(mocker):
+    storage = mocker.patch('widt.meta_cache.STORAGE', MemoryStorage())
+    mocker.spy(storage, "get_meta")
+    monotonic = mocker.patch('widt.meta_cache.time.monotonic', return_value=100)
+    cache = MetaCache(ttl=60, max_size=10)
+    assert cache.get(1) == {}
+    assert cache.get(1) == {}
+    assert storage.get_meta.call_count == 1
+    monotonic.return_value = 161
+    cache.get(1)
+    assert storage.get_meta.call_count == 2
+
+
+def test_lru(mocker):
+    cache = MetaCache(ttl=60, max_size=2)
+    cache.put(1, {"a": 1})
+    cache.put(2, {"a": 2})
+    cache.get(1)
+    cache.put(3, {"a": 3})
+    assert cache.stats()["cached"] == 2
+    assert "2" not in cache._data
+
+
+def test_update_write_through(mocker):
+    storage = mocker.patch('widt.meta_cache.STORAGE', MemoryStorage())
+    mocker.spy(storage, "get_meta")
+    cache = MetaCache(ttl=60, max_size=10)
+    cache.put(1, {"timezone": 8, "reminder": True})
+    cache.update(1, {"reminder": False})
+    assert storage.meta["1"] == {"reminder": False}
+    assert cache.get(1) == {"timezone": 8, "reminder": False}
+    storage.get_meta.assert_not_called()
+    # Not cached: only written to the storage
+    cache.update(2, {"reminder": False})
+    assert "2" not in cache._data
+    assert storage.meta["2"] == {"reminder": False}
+
+
+def test_put_after_write_is_dropped():
+    cache = MetaCache(ttl=60, max_size=10)
+    since = cache.version
+    cache.invalidate(1)
+    # A read started before the write may be stale
+    cache.put(1, {"timezone": 8}, since)
+    assert "1" not in cache._data
+    cache.put(1, {"timezone": 8}, cache.version)
+    assert "1" in cache._data
+
+
+def test_get_many(mocker):
+    storage = mocker.patch('widt.meta_cache.STORAGE', MemoryStorage())
+    storage.meta.update({"1": {"timezone": 1}, "2": {"timezone": 2}})
+    mocker.spy(storage, "get_metas")
+    cache = MetaCache(ttl=60, max_size=10)
+    cache.put(1, {"timezone": 1})
+    assert cache.get_many([1, 2, 3]) == {"1": {"timezone": 1}, "2": {"timezone": 2}, "3": {}}
+    storage.get_metas.assert_called_once_with(["2", "3"])
+    cache.get_many([1, 2, 3])
+    assert storage.get_metas.call_count == 1
@@ -0,0 +1,106 @@
+import time
+from concurrent.futures import wait
+
+import pytest
+from telegram.error import RetryAfter
+
+from widt.outbound import Limiter, PendingMessage, BULK, INTERACTIVE, bulk, current_priority
+
+
+def test_chat_rate(mocker):
+    limiter = Limiter(global_rate=1000, chat_rate=20)
+    func = mocker.MagicMock(return_value="sent")
+    started = time.monotonic()
+    # The burst allowance is used up by the first three messages
+    wait([limiter.submit("1", func) for _ in range(5)])
+    assert time.monotonic() - started >= 0.09
+    # Other chats are not affected
+    started = time.monotonic()
+    assert limiter.call("2", func) == "sent"
+    assert time.monotonic() - started < 0.05
+    assert limiter.stats()["sent"] == 6
+
+
+def test_chat_order(mocker):
+    limiter = Limiter(global_rate=1000, chat_rate=1000)
+    sent = []
+    wait([limiter.submit("1", sent.append, i) for i in range(10)])
+    assert sent == list(range(10))
+
+
+def test_retry_after(mocker):
+    limiter = Limiter(global_rate=1000, chat_rate=1000)
+    func = mocker.MagicMock(side_effect=[RetryAfter(0.1), "sent"])
+    started = time.monotonic()
+    assert limiter.call("1", func, "hi", priority=BULK) == "sent"
+    assert time.monotonic() - started >= 0.1
+    assert func.call_count == 2
+    assert limiter.stats()["retries"] == 1
+
+
+def test_retry_after_gives_up(mocker):
+    mocker.patch('widt.outbound.MAX_RETRIES', 1)
+    limiter = Limiter(global_rate=1000, chat_rate=1000)
+    func = mocker.MagicMock(side_effect=RetryAfter(0.01))
+    with pytest.raises(RetryAfter):
+        limiter.call("1", func)
+    assert func.call_count == 2
+
+
+def test_flood_control_doesnt_block(mocker):
+    limiter = Limiter(global_rate=1000, chat_rate=1000)
+    limiter.block("1", 30)
+    func = mocker.MagicMock(return_value="sent")
+    started = time.monotonic()
+    blocked = limiter.submit("1", func, "interactive")
+    # Neither the caller nor the bulk messages to other chats wait for chat 1
+    assert limiter.call("2", func, "bulk", priority=BULK) == "sent"
+    assert time.monotonic() - started < 1
+    assert not blocked.done()
+    func.assert_called_once_with("bulk")
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_interactive_goes_first(mocker):
+    # A fake clock: no token comes back until the test says so
+    clock = mocker.patch('widt.outbound.time')
+    clock.monotonic.return_value = 0.0
+    limiter = Limiter(global_rate=10, chat_rate=1000)
+    order = []
+    # Use up the global burst
+    wait([limiter.submit(str(i), order.append, None) for i in range(10)])
+    order.clear()
+    bulk_sends = [limiter.submit(f"b{i}", order.append, BULK, priority=BULK) for i in range(3)]
+    interactive = limiter.submit("i", order.append, INTERACTIVE)
+    assert limiter.stats()["queue_depth"] == 4
+    # One token: the interactive reply gets it although the bulk messages waited longer
+    clock.monotonic.return_value = 0.1
+    interactive.result(5)
+    assert order == [INTERACTIVE]
+    clock.monotonic.return_value = 1.0
+    wait(bulk_sends, 5)
+    assert order == [INTERACTIVE, BULK, BULK, BULK]
+
+
+def test_pending_message(mocker):
+    limiter = Limiter(global_rate=1000, chat_rate=1000)
+    message = mocker.MagicMock()
+    message.edit_text.side_effect = lambda text: PendingMessage(limiter.submit("1", lambda: text))
+    pending = PendingMessage(limiter.submit("1", lambda: message))
+    # Queued without waiting for the message
+    edited = pending.edit_text("done")
+    assert edited.result(5) == "done"
+    assert pending.chat_id is message.chat_id
+
+
+def test_bulk_context():
+    assert current_priority() == INTERACTIVE
+    with bulk():
+        assert current_priority() == BULK
+    assert current_priority() == INTERACTIVE
@@ -0,0 +1,72 @@
+import json
+from datetime import datetime
+
+from widt.emails import make_payload, render_entries
+from widt.outbox import Outbox, PENDING, SENT, FAILED
+import widt.outbox
+
+
+def _statuses(outbox):
+    with outbox._lock:
+        return outbox._connection().execute(
+            "SELECT chat_id, status, attempts FROM outbox ORDER BY chat_id"
+        ).fetchall()
+
+
+def test_enqueue_dedupes(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"))
+    assert outbox.enqueue(1, "20200101", {"to": ["a@b.c"]}) is True
+    assert outbox.enqueue(1, "20200101", {"to": ["a@b.c"]}) is False
+    assert outbox.enqueue(1, "20200102", {"to": ["a@b.c"]}) is True
+    assert outbox.pending_count() == 2
+
+
+def test_drain_once(tmp_path, mocker):
+    mocker.patch('widt.outbox.send_message')
+    responses = {"1": 200, "2": 503, "3": 400}
+    widt.outbox.send_message.side_effect = lambda payload: mocker.MagicMock(
+        status_code=responses[payload["to"][0]])
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), rate=0)
+    for chat_id in ("1", "2", "3"):
+        outbox.enqueue(chat_id, "20200101", {"to": [chat_id]})
+    assert outbox.drain_once() == 1
+    assert _statuses(outbox) == [("1", SENT, 1), ("2", PENDING, 1), ("3", FAILED, 1)]
+    # The retry is scheduled in the future
+    assert outbox.drain_once() == 0
+    assert widt.outbox.send_message.call_count == 3
+
+
+def test_drain_once_gives_up(tmp_path, mocker):
+    mocker.patch('widt.outbox.send_message')
+    mocker.patch('widt.outbox.RETRY_DELAY', 0)
+    mocker.patch('widt.outbox.MAX_ATTEMPTS', 3)
+    widt.outbox.send_message.return_value = None
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), rate=0)
+    outbox.enqueue("1", "20200101", {"to": ["1"]})
+    for _ in range(5):
+        outbox.drain_once()
+    assert _statuses(outbox) == [("1", FAILED, 3)]
+
+
+def test_drain_once_batches(tmp_path, mocker):
+    mocker.patch('widt.outbox.send_message')
+    widt.outbox.send_message.return_value = mocker.MagicMock(status_code=200)
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), rate=0)
+    user_time = datetime(2020, 1, 2, 21)
+    outbox.enqueue("1", "20200102", make_payload("a@b.c", user_time, render_entries([("10:00", "x")]), "m"))
+    outbox.enqueue("2", "20200102", make_payload("d@e.f", user_time, render_entries([("11:00", "y")]), "m"))
+    # Same address as chat 1: can't share its batch
+    outbox.enqueue("3", "20200102", make_payload("a@b.c", user_time, render_entries([("12:00", "z")]), "m"))
+    outbox.enqueue("4", "20200102", make_payload("g@h.i", user_time, "", ""))
+    assert outbox.drain_once() == 4
+    calls = [call[0][0] for call in widt.outbox.send_message.call_args_list]
+    assert len(calls) == 3
+    batch = [data for data in calls if len(data["to"]) > 1][0]
+    assert batch["to"] == ["a@b.c", "d@e.f"]
+    variables = json.loads(batch["recipient-variables"])
+    assert "11:00 — y" in variables["d@e.f"]["entries"]
+    assert "%recipient.entries%" in batch["html"]
+    singles = {data["to"][0]: data for data in calls if len(data["to"]) == 1}
+    assert "12:00 — z" in singles["a@b.c"]["html"]
+    assert "%recipient." not in singles["g@h.i"]["html"]
+    assert singles["g@h.i"]["subject"].startswith("20200102")
@@ -0,0 +1,79 @@
+from queue import Queue
+
+from telegram.ext import ConversationHandler, CommandHandler, Dispatcher
+
+from widt.persistence import SqlitePersistence, create
+
+
+def test_lazy_user_and_chat_data(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    persistence = SqlitePersistence(path)
+    user_data = persistence.get_user_data()
+    user_data[1]["timezone_new"] = 8
+    persistence.update_user_data(1, user_data[1])
+    persistence.update_user_data(2, user_data[2])
+    chat_data = persistence.get_chat_data()
+    chat_data[10]["editing"] = "1580000000-000000"
+    persistence.update_chat_data(10, chat_data[10])
+    # Nothing is written before the flush
+    assert SqlitePersistence(path).get_user_data()[1] == {}
+    persistence.flush()
+    assert persistence.stats()["dirty"] == 0
+
+    restarted = SqlitePersistence(path)
+    user_data = restarted.get_user_data()
+    assert len(user_data) == 0
+    assert user_data[1] == {"timezone_new": 8}
+    assert user_data[2] == {}
+    assert restarted.get_chat_data()[10] == {"editing": "1580000000-000000"}
+    assert restarted.stats()["loads"] == 3
+
+
+def test_skip_unchanged_and_delete(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    persistence = SqlitePersistence(path)
+    persistence.update_user_data(1, {"email_new": "a@b.c"})
+    persistence.flush()
+    persistence.update_user_data(1, {"email_new": "a@b.c"})
+    assert persistence.stats()["dirty"] == 0
+    # Changed and changed back before the flush
+    persistence.update_user_data(1, {"email_new": ""})
+    persistence.update_user_data(1, {"email_new": "a@b.c"})
+    assert persistence.stats()["dirty"] == 0
+    persistence.update_user_data(1, {})
+    persistence.flush()
+    assert SqlitePersistence(path).get_user_data()[1] == {}
+
+
+def test_conversations(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    persistence = SqlitePersistence(path)
+    assert persistence.get_conversations("config") == {}
+    # State 0 is a valid state; None ends the conversation
+    persistence.update_conversation("config", (10, 1), 0)
+    persistence.update_conversation("config", (10, 2), 1)
+    persistence.update_conversation("edit", (10, 1), 2)
+    persistence.flush()
+    persistence.update_conversation("config", (10, 2), None)
+    persistence.flush()
+    restarted = SqlitePersistence(path)
+    assert restarted.get_conversations("config") == {(10, 1): 0}
+    assert restarted.get_conversations("edit") == {(10, 1): 2}
+
+
+def test_dispatcher(tmp_path, mocker):
+    persistence = SqlitePersistence(str(tmp_path / "state.sqlite"))
+    persistence.update_conversation("config", (10, 1), 1)
+    persistence.update_user_data(1, {"timezone_new": 8})
+    persistence.flush()
+    dp = Dispatcher(mocker.MagicMock(), Queue(), persistence=SqlitePersistence(persistence.path))
+    handler = ConversationHandler(
+        entry_points=[CommandHandler("config", mocker.MagicMock())], states={},
+        fallbacks=[], name="config", persistent=True)
+    dp.add_handler(handler)
+    assert handler.conversations == {(10, 1): 1}
+    assert dp.user_data[1] == {"timezone_new": 8}
+
+
+def test_create_disabled():
+    assert create("") is None
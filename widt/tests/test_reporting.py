@@ -0,0 +1,237 @@
+from datetime import datetime
+
+from widt.meta import get_report_hour
+from widt.reporting import (
+    check_and_make_report, _archive_journals, _find_due, _make_reports, _send_report
+)
+from widt.meta_cache import MetaCache
+from widt.storage import ArchivedDay, MemoryStorage
+import widt.reporting
+
+
+def _mock_due_users(mocker, chat_ids):
+    hour = datetime.utcnow().hour
+    docs = [
+        (chat_id, {"timezone": 0, "end_of_day": hour, "report_hour": hour})
+        for chat_id in chat_ids
+    ]
+    widt.reporting.STORAGE.stream_meta.return_value = docs
+    return hour
+
+
+def test_get_report_hour():
+    assert get_report_hour(0, 21) == 21
+    assert get_report_hour(8, 2) == 18
+    assert get_report_hour(-5, 22) == 3
+    assert get_report_hour(-12, 23) == 11
+    # The next day end of New York is in EST (-05:00), then in EDT (-04:00)
+    assert get_report_hour("America/New_York", 21, datetime(2020, 3, 7, 12)) == 2
+    assert get_report_hour("America/New_York", 21, datetime(2020, 3, 8, 3)) == 1
+
+
+def test_check_and_make_report_queries_due_users(mocker):
+    mocker.patch('widt.reporting.STORAGE')
+    mocker.patch('widt.reporting._archive_journals')
+    mocker.patch('widt.reporting._send_report')
+    hour = _mock_due_users(mocker, ["123"])
+    widt.reporting._archive_journals.return_value = {"123": []}
+    check_and_make_report(mocker.MagicMock())
+    # The hour before is read too (for the day ends at fractional offsets)
+    assert [call[0] for call in widt.reporting.STORAGE.stream_meta.call_args_list] == [
+        (hour,), ((hour - 1) % 24,)]
+    widt.reporting._archive_journals.assert_called_once()
+    jobs = widt.reporting._archive_journals.call_args[0][0]
+    assert [chat_id for _, chat_id in jobs] == ["123"]
+    widt.reporting._send_report.assert_called_once()
+
+
+def test_find_due_half_hour(mocker):
+    mocker.patch('widt.reporting.META_CACHE', MetaCache())
+    storage = mocker.patch('widt.reporting.STORAGE')
+    # 22:00 in Kolkata (+05:30) is 16:30 UTC
+    metadata = {"timezone": "Asia/Kolkata", "end_of_day": 22}
+    assert get_report_hour("Asia/Kolkata", 22, datetime(2020, 1, 2)) == 16
+    storage.stream_meta.side_effect = lambda hour: [("1", dict(metadata))] if hour == 16 else []
+    assert _find_due(datetime(2020, 1, 2, 16, 10)) == []
+    due = _find_due(datetime(2020, 1, 2, 17, 10))
+    assert [(user_time, data["chat_id"]) for user_time, data in due] == [
+        (datetime(2020, 1, 2, 22), "1")]
+    assert _find_due(datetime(2020, 1, 2, 17, 40)) == []
+
+
+def test_check_and_make_report_isolates_errors(mocker):
+    mocker.patch('widt.reporting.STORAGE')
+    mocker.patch('widt.reporting._archive_journals')
+    mocker.patch('widt.reporting._send_report')
+    mocker.patch('widt.reporting.ARCHIVE_BATCH_SIZE', 2)
+    mocker.patch('widt.reporting.ARCHIVE_RETRY_DELAY', 0)
+    _mock_due_users(mocker, ["1", "2", "3", "4", "5"])
+    attempts = {}
+
+    def archive(jobs, archive, undelivered, previous):
+        chat_ids = [chat_id for _, chat_id in jobs]
+        attempts[chat_ids[0]] = attempts.get(chat_ids[0], 0) + 1
+        if "3" in chat_ids:
+            raise RuntimeError("Firestore is down")
+        if "5" in chat_ids and attempts["5"] == 1:
+            raise RuntimeError("Firestore is unavailable for a moment")
+        return {chat_id: [] for chat_id in chat_ids}
+    widt.reporting._archive_journals.side_effect = archive
+
+    def send(context, user_time, entries, metadata):
+        if metadata["chat_id"] == "1":
+            raise RuntimeError("Telegram is down")
+    widt.reporting._send_report.side_effect = send
+    check_and_make_report(mocker.MagicMock())
+    assert attempts == {"1": 1, "3": widt.reporting.ARCHIVE_ATTEMPTS, "5": 2}
+    reported = sorted(
+        call[0][3]["chat_id"] for call in widt.reporting._send_report.call_args_list)
+    # users 3 and 4 share the batch that kept failing; 5 made it the second time
+    assert reported == ["1", "2", "5"]
+
+
+def test_archive_journals(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.reporting.STORAGE', storage)
+    mocker.patch('widt.live.STORAGE', storage)
+    mocker.patch('widt.reporting.META_CACHE', MetaCache())
+    mocker.patch('widt.reporting.time.time', return_value=1500000050)
+    storage.live["1"] = {"1500000000-000001": "a", "1500000001": "b", "1500000100-000000": "c"}
+    mocker.spy(storage, "archive_days")
+    export_cache = mocker.patch('widt.reporting.EXPORT_CACHE')
+    user_time = datetime(2020, 1, 2, 21)
+    results = _archive_journals([(user_time, "1"), (user_time, "2")], True)
+    # Only chat 2 had nothing to archive
+    assert list(export_cache.bump.call_args[0][0]) == [("1", 202001)]
+    assert results == {
+        "1": [("1500000000-000001", "a"), ("1500000001", "b")], "2": None}
+    assert storage.archive_days.call_args[0][0] == [
+        ArchivedDay(
+            "1", "20200102", "20200102-21", {"1500000000-000001": "a", "1500000001": "b"}, 1500000050),
+        ArchivedDay("2", "20200102", "20200102-21", {}, 1500000050),
+    ]
+    # Entries made after the report started stay for the next day
+    assert storage.live["1"] == {"1500000100-000000": "c"}
+    assert storage.meta["2"]["last_archive_date"] == "20200102"
+
+
+def test_archive_journals_failed_commit(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.reporting.STORAGE', storage)
+    mocker.patch('widt.live.STORAGE', storage)
+    mocker.patch('widt.reporting.ARCHIVE_ATTEMPTS', 3)
+    mocker.patch('widt.reporting.ARCHIVE_RETRY_DELAY', 0)
+    calls = []
+
+    def archive_days(days):
+        # Chat 1 fails once, chat 2 every time
+        calls.append([day.chat_id for day in days])
+        return [day.chat_id for day in days if day.chat_id == "2" or len(calls) == 1]
+    mocker.patch.object(storage, "archive_days", side_effect=archive_days)
+    user_time = datetime(2020, 1, 2, 21)
+    results = _archive_journals([(user_time, "1"), (user_time, "2")], True)
+    assert results == {"1": None}
+    assert calls == [["1", "2"], ["1", "2"], ["2"]]
+
+
+def test_make_reports_checkpoints_delivered(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.reporting.STORAGE', storage)
+    mocker.patch('widt.live.STORAGE', storage)
+    mocker.patch('widt.reporting.META_CACHE', MetaCache())
+    mocker.patch('widt.reporting.EXPORT_CACHE')
+    mocker.patch('widt.reporting.time.time', return_value=1500000050)
+    send = mocker.patch('widt.reporting._send_report')
+    storage.live = {"1": {"1500000000-000001": "a"}, "2": {"1500000000-000002": "b"}}
+    user_time = datetime(2017, 7, 14, 21)
+    # One report at a time, in order
+    mocker.patch('widt.reporting.REPORT_WORKERS', 1)
+    due = [(user_time, {"chat_id": "1"}), (user_time, {"chat_id": "2"})]
+    checkpointed = []
+
+    def fail_2(context, user_time, entries, metadata):
+        if metadata["chat_id"] == "2":
+            checkpointed.append(storage.meta["1"].get("last_report_date"))
+            raise RuntimeError("Crashed")
+    send.side_effect = fail_2
+    _make_reports(mocker.MagicMock(), due, True)
+    # The delivered report was checkpointed before the next one was sent
+    assert checkpointed == ["20170714"]
+    # Both days are archived; only the delivered report is checkpointed
+    assert storage.meta["1"] == {
+        "last_archive_date": "20170714", "last_archive_until": 1500000050, "last_report_date": "20170714"}
+    assert storage.meta["2"] == {"last_archive_date": "20170714", "last_archive_until": 1500000050}
+    # Caught up, the report is made from the archived entries
+    send.reset_mock(side_effect=True)
+    storage.live["2"]["1500000010-000000"] = "c"
+    metadata = dict(storage.meta["2"], chat_id="2", timezone="Asia/Taipei", end_of_day=21)
+    _make_reports(mocker.MagicMock(), [(user_time, metadata)], True)
+    assert send.call_args[0][2] == [("1500000000-000002", "b"), ("1500000010-000000", "c")]
+    assert storage.meta["2"]["last_report_date"] == "20170714"
+    # Refreshed for the next report
+    assert storage.meta["2"]["report_hour"] == 13
+    assert storage.archive["2"]["201707"] == {
+        "20170714-21": {"1500000000-000002": "b", "1500000010-000000": "c"}}
+
+
+def test_archive_journals_leftovers(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.reporting.STORAGE', storage)
+    mocker.patch('widt.live.STORAGE', storage)
+    mocker.patch('widt.reporting.META_CACHE', MetaCache())
+    mocker.patch('widt.reporting.EXPORT_CACHE')
+    clock = mocker.patch('widt.reporting.time.time', return_value=1580479300)
+    # 2020-01-31 13:00 UTC, reported at 21:00 (+08:00)
+    storage.live["1"] = {"1580475600-000000": "a"}
+    _archive_journals([(datetime(2020, 1, 31, 21), "1")], True)
+    # The delete failed, so the next report collects the entry again
+    storage.live["1"] = {"1580475600-000000": "a", "1580500000-000000": "b"}
+    clock.return_value = 1580565700
+    previous = {"1": (storage.meta["1"]["last_archive_date"], storage.meta["1"]["last_archive_until"])}
+    results = _archive_journals([(datetime(2020, 2, 1, 21), "1")], True, (), previous)
+    assert results == {"1": [("1580500000-000000", "b")]}
+    assert storage.archive["1"] == {
+        "202001": {"20200131-21": {"1580475600-000000": "a"}},
+        "202002": {"20200201-21": {"1580500000-000000": "b"}}}
+    assert storage.live["1"] == {}
+
+
+def test_archive_journals_without_archiving(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.reporting.STORAGE', storage)
+    mocker.patch('widt.live.STORAGE', storage)
+    storage.live["1"] = {"1500000000-000001": "a"}
+    results = _archive_journals([(datetime(2020, 1, 2, 21), "1")], False)
+    assert results == {"1": [("1500000000-000001", "a")]}
+    assert storage.live["1"] == {"1500000000-000001": "a"}
+    assert storage.meta == {}
+
+
+def test_check_and_make_report_skips_reported(mocker):
+    mocker.patch('widt.reporting.STORAGE')
+    mocker.patch('widt.reporting._archive_journals')
+    mocker.patch('widt.reporting._send_report')
+    _mock_due_users(mocker, ["1", "2"])
+    docs = widt.reporting.STORAGE.stream_meta.return_value
+    docs[0][1]["last_report_date"] = datetime.utcnow().strftime("%Y%m%d")
+    widt.reporting._archive_journals.side_effect = lambda jobs, archive, undelivered, previous: {
+        chat_id: [] for _, chat_id in jobs}
+    check_and_make_report(mocker.MagicMock())
+    jobs = widt.reporting._archive_journals.call_args[0][0]
+    assert [chat_id for _, chat_id in jobs] == ["2"]
+
+
+def test_send_report(mocker):
+    mocker.patch('widt.reporting._send_email')
+    context = mocker.MagicMock()
+    metadata = {
+        "chat_id": "1", "timezone": 8, "email": "a@b.c", "email_verified": True}
+    widt.reporting.DIGESTS.set("1", "1577934000", "Wrote tests", 8)
+    _send_report(context, datetime(2020, 1, 2, 21), [("1577934000", "Wrote tests")], metadata)
+    message = context.bot.send_message.call_args[1]["text"]
+    assert "* 11:00:00 — Wrote tests" in message
+    kwargs = widt.reporting._send_email.call_args[1]
+    assert kwargs["message"] == message
+    assert "<li>11:00 — Wrote tests</li>" in kwargs["entries_html"]
+    # Dropped once reported
+    assert "1" not in widt.reporting.DIGESTS._digests
@@ -0,0 +1,73 @@
+import time
+from datetime import datetime
+
+from widt.scheduler import (
+    ReportScheduler, next_report_time, previous_report_time
+)
+from widt.meta_cache import MetaCache
+from widt.storage import MemoryStorage
+import widt.scheduler
+
+
+def test_next_report_time_offset():
+    metadata = {"timezone": -5, "end_of_day": 22}
+    assert next_report_time(metadata, datetime(2020, 1, 2, 1)) == datetime(2020, 1, 2, 3)
+    assert next_report_time(metadata, datetime(2020, 1, 2, 3)) == datetime(2020, 1, 3, 3)
+
+
+def test_next_report_time_dst():
+    metadata = {"timezone": "America/New_York", "end_of_day": 22}
+    # EST (UTC-5) in winter, EDT (UTC-4) in summer
+    assert next_report_time(metadata, datetime(2020, 1, 2, 12)) == datetime(2020, 1, 3, 3)
+    assert next_report_time(metadata, datetime(2020, 7, 2, 12)) == datetime(2020, 7, 3, 2)
+    # Across the switch to DST (2020-03-08)
+    assert next_report_time(metadata, datetime(2020, 3, 8, 4)) == datetime(2020, 3, 9, 2)
+
+
+def test_next_report_time_half_hour():
+    metadata = {"timezone": "Asia/Kolkata", "end_of_day": 22}
+    assert next_report_time(metadata, datetime(2020, 1, 2)) == datetime(2020, 1, 2, 16, 30)
+    assert previous_report_time(metadata, datetime(2020, 1, 2)) == datetime(2020, 1, 1, 16, 30)
+
+
+def test_scheduler(mocker):
+    storage = MemoryStorage()
+    mocker.patch('widt.scheduler.STORAGE', storage)
+    mocker.patch('widt.meta_cache.STORAGE', storage)
+    mocker.patch('widt.scheduler.META_CACHE', MetaCache())
+    mocker.patch('widt.scheduler._make_reports')
+    now = datetime.utcnow()
+    docs = {
+        # Missed its report an hour ago
+        "1": {"timezone": 0, "end_of_day": (now.hour - 1) % 24, "last_report_date": "20000101"},
+        # No checkpoint (configured before the checkpoints): missed it
+        "2": {"timezone": 0, "end_of_day": (now.hour - 1) % 24},
+        "3": {"timezone": 0, "end_of_day": (now.hour + 2) % 24},
+        "4": {"timezone": 0},
+        # Configured after its report time: nothing to catch up
+        "5": {"timezone": 0, "end_of_day": (now.hour - 1) % 24, "config_time": int(time.time())},
+        # Archived, but the report wasn't delivered
+        "6": {"timezone": 0, "end_of_day": (now.hour - 1) % 24, "config_time": int(time.time()),
+              "last_archive_date": "20000101"},
+    }
+    for chat_id, data in docs.items():
+        storage.put_meta(chat_id, data)
+    job_queue = mocker.MagicMock()
+    scheduler = ReportScheduler(job_queue)
+    scheduler.load()
+    assert sorted(scheduler._next) == ["1", "2", "3", "5", "6"]
+    job_queue.run_once.assert_called_once()
+    assert job_queue.run_once.call_args[1]["when"] == 0
+    # A config change pushing a user earlier reschedules the wakeup
+    docs["3"]["end_of_day"] = now.hour
+    scheduler.reschedule("3", docs["3"])
+    assert job_queue.run_once.call_count == 1
+
+    scheduler._wakeup(mocker.MagicMock())
+    reports = widt.scheduler._make_reports.call_args[0][1]
+    assert [metadata["chat_id"] for _, metadata in reports] == ["1", "2", "6"]
+    user_time = reports[0][0]
+    assert user_time.hour == docs["1"]["end_of_day"]
+    # Rescheduled for the next day
+    assert scheduler._next["1"] > now
+    assert job_queue.run_once.call_count == 2
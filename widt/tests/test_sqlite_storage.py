@@ -0,0 +1,98 @@
+import json
+import threading
+
+from widt.sqlite_storage import SqliteStorage, load_export
+from widt.storage import ArchivedDay
+
+
+def test_meta(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "widt.sqlite"))
+    storage.put_meta(1, {"timezone": 8, "end_of_day": 21, "report_hour": 13})
+    storage.put_meta(2, {"timezone": 0, "end_of_day": 21, "report_hour": 21})
+    storage.put_meta(1, {"email": "a@b.c"})
+    assert storage.get_meta("1") == {
+        "timezone": 8, "end_of_day": 21, "report_hour": 13, "email": "a@b.c"}
+    assert storage.get_meta(3) is None
+    assert storage.get_metas([2, 3]) == {
+        "2": {"timezone": 0, "end_of_day": 21, "report_hour": 21}, "3": None}
+    assert [chat_id for chat_id, _ in storage.stream_meta(13)] == ["1"]
+    assert sorted(chat_id for chat_id, _ in storage.stream_meta()) == ["1", "2"]
+    # The indexed column follows the config
+    storage.put_meta(1, {"report_hour": 21})
+    assert sorted(chat_id for chat_id, _ in storage.stream_meta(21)) == ["1", "2"]
+
+
+def test_live_and_archive(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "widt.sqlite"))
+    assert storage.write_live({"1": {
+        "1500000000": "legacy", "1500000001-000000": "a", "1500000100-000000": "b"}}) == []
+    storage.write_live({"1": {"1500000001-000000": "A"}, "2": {"1500000002-000000": "c"}})
+    storage.write_live({"2": {"1500000002-000000": None}})
+    assert storage.read_live(1) == {
+        "1500000000": "legacy", "1500000001-000000": "A", "1500000100-000000": "b"}
+    assert storage.read_live(2) == {}
+    live = storage.collect_live([1, 2], 1500000050)
+    assert live == {"1": {"1500000000": "legacy", "1500000001-000000": "A"}, "2": {}}
+    assert storage.archive_days([
+        ArchivedDay("1", "20170714", "20170714-21", live["1"]),
+        ArchivedDay("2", "20170714", "20170714-21", live["2"]),
+    ]) == []
+    assert storage.read_live(1) == {"1500000100-000000": "b"}
+    assert storage.get_meta(2) == {"last_archive_date": "20170714"}
+    storage.append_archive(1, {"20170801-21": {"1501500000-000000": "c"}})
+    storage.append_legacy_archive(1, {"20160101": {"1451600000": "old"}})
+    assert list(storage.query_archive(1, 201707, 201707)) == [
+        (None, "20160101", {"1451600000": "old"}),
+        (201707, "20170714-21", {"1500000000": "legacy", "1500000001-000000": "A"}),
+    ]
+    assert len(list(storage.query_archive(1, 201701, 201712))) == 3
+    assert storage.migrate_legacy_archive() == {"1": 1}
+    assert storage.migrate_legacy_archive() == {}
+    assert list(storage.query_archive(1, 201601, 201601)) == [
+        (201601, "20160101", {"1451600000": "old"})]
+    assert len(list(storage.query_archive(1, 201707, 201707))) == 1
+
+
+def test_connection_per_thread(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "widt.sqlite"))
+
+    def work(i):
+        for j in range(20):
+            storage.write_live({str(i): {f"15000000{j:02d}-000000": str(j)}})
+            storage.put_meta(i, {"count": j})
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(4):
+        assert len(storage.read_live(i)) == 20
+        assert storage.get_meta(i) == {"count": 19}
+
+
+def test_load_export(tmp_path):
+    export = tmp_path / "db_export"
+    files = {
+        "meta/1.json": {"timezone": 8, "end_of_day": 21, "report_hour": 13},
+        "live/1.json": {"1500000000": "legacy"},
+        "live/1/entries/1500000001-000000.json": {"text": "a", "ts": 1500000001},
+        "archive/1.json": {"20160101": {"1451600000": "old"}},
+        "1/201707.json": {"month": 201707, "20170714-21": {"1500000000-000001": "b"}},
+        "-100/201707.json": {"month": 201707, "20170714-21": {"1500000000-000002": "c"}},
+    }
+    for name, data in files.items():
+        path = export / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(data))
+    storage = SqliteStorage(str(tmp_path / "widt.sqlite"))
+    assert load_export(str(export), storage) == {"meta": 1, "live": 2, "archive": 3}
+    assert storage.get_meta(1)["report_hour"] == 13
+    assert storage.read_live(1) == {"1500000000": "legacy", "1500000001-000000": "a"}
+    assert list(storage.query_archive(1, 201707, 201707)) == [
+        (None, "20160101", {"1451600000": "old"}),
+        (201707, "20170714-21", {"1500000000-000001": "b"})]
+    assert list(storage.query_archive(-100, 201707, 201707)) == [
+        (201707, "20170714-21", {"1500000000-000002": "c"})]
+    # Loading again changes nothing
+    load_export(str(export), storage)
+    assert len(list(storage.query_archive(1, 201707, 201707))) == 2
@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+# Loaded on first use (see widt.db, widt.emails, widt.export and widt.mailgun)
+LAZY_MODULES = ("google.cloud.firestore", "jinja2", "markdown2", "requests")
+# Generous, so only a big regression (e.g., an eager import) fails
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", "5"))
+
+
+def test_startup_is_lazy():
+    code = (
+        "import sys, json, time\n"
+        "start = time.perf_counter()\n"
+        "import widt.bot\n"
+        "from queue import Queue\n"
+        "from telegram import Bot\n"
+        "from telegram.ext import Dispatcher\n"
+        "widt.bot.add_handlers(Dispatcher(Bot('123:abc'), Queue()))\n"
+        f"print(json.dumps([[name for name in {LAZY_MODULES!r} if name in sys.modules],"
+        " time.perf_counter() - start]))\n"
+    )
+    # Not in TEST_MODE: the Firestore backend is selected, but not connected
+    env = {key: value for key, value in os.environ.items() if key != "TEST_MODE"}
+    env["STATE_PATH"] = ""
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, cwd=str(Path(__file__).parents[2]),
+        check=True, capture_output=True, text=True)
+    loaded, elapsed = json.loads(result.stdout.strip().splitlines()[-1])
+    assert loaded == []
+    assert elapsed < STARTUP_BUDGET
@@ -0,0 +1,244 @@
+from google.cloud import firestore
+
+from widt.storage import (
+    ArchivedDay, FirestoreStorage, MemoryStorage, commit_writes, create, month_range
+)
+import widt.storage
+
+
+def _doc(mocker, doc_id, data):
+    doc = mocker.MagicMock()
+    doc.id, doc.exists = doc_id, data is not None
+    doc.to_dict.return_value = dict(data or {})
+    return doc
+
+
+def test_create():
+    assert isinstance(create("memory"), MemoryStorage)
+    assert isinstance(create("firestore"), FirestoreStorage)
+
+
+def test_firestore_write_live(mocker):
+    mocker.patch('widt.storage.DB')
+    chat = widt.storage.DB.collection.return_value.document
+    entries = chat.return_value.collection.return_value.document
+    entries.side_effect = lambda key: "entries/" + key
+    failed = FirestoreStorage().write_live({"1": {
+        "1500000000-000001": "a", "1500000000-000002": None,
+        "1500000000": "legacy", "1500000001": None}})
+    assert failed == []
+    chat.assert_called_with("1")
+    batch = widt.storage.DB.batch.return_value
+    assert batch.set.call_args_list == [
+        mocker.call("entries/1500000000-000001", {"text": "a", "ts": 1500000000}, merge=False),
+        mocker.call(chat.return_value, {
+            "1500000000": "legacy", "1500000001": firestore.DELETE_FIELD}, merge=True)
+    ]
+    batch.delete.assert_called_once_with("entries/1500000000-000002")
+    batch.commit.assert_called_once()
+
+
+def test_commit_writes(mocker):
+    mocker.patch('widt.storage.DB')
+    mocker.patch('widt.storage.BATCH_SIZE', 3)
+    batches = []
+
+    def new_batch():
+        batch = mocker.MagicMock()
+        batch.commit.side_effect = lambda: batches.append(
+            [call[0][0] for call in batch.set.call_args_list])
+        return batch
+    widt.storage.DB.batch.side_effect = new_batch
+    failed = commit_writes([
+        ("a", [("set", "a1", {}), ("set", "a2", {})]),
+        ("b", [("set", "b1", {}), ("set", "b2", {})]),
+        ("c", [("set", f"c{i}", {}) for i in range(4)]),
+        ("d", []),
+    ])
+    assert failed == []
+    # Groups are kept together unless they don't fit in a batch
+    assert batches == [["a1", "a2"], ["b1", "b2"], ["c0", "c1", "c2"], ["c3"]]
+
+
+def test_firestore_collect_live(mocker):
+    mocker.patch('widt.storage.DB')
+    widt.storage.DB.get_all.return_value = [
+        _doc(mocker, "2", None), _doc(mocker, "1", {"1500000001": "b"})]
+    chats = {"1": mocker.MagicMock(), "2": mocker.MagicMock()}
+    widt.storage.DB.collection.return_value.document.side_effect = chats.get
+    entry = _doc(mocker, "1500000000-000001", {"text": "a", "ts": 1500000000})
+    chats["1"].collection.return_value.where.return_value.stream.return_value = [entry]
+    chats["2"].collection.return_value.where.return_value.stream.return_value = []
+    results = FirestoreStorage().collect_live(["1", "2"], 1500000050)
+    assert results == {"1": {"1500000000-000001": "a", "1500000001": "b"}, "2": {}}
+    for chat in chats.values():
+        chat.collection.assert_called_once_with("entries")
+        assert chat.collection.return_value.where.call_args[0] == ("ts", "<=", 1500000050)
+
+
+def test_firestore_archive_days(mocker):
+    mocker.patch('widt.storage.DB')
+    FirestoreStorage().archive_days([
+        ArchivedDay("1", "20200102", "20200102-21", {"1500000000-000001": "a", "1500000001": "b"}),
+        ArchivedDay("2", "20200102", "20200102-21", {}),
+    ])
+    batch = widt.storage.DB.batch.return_value
+    # Two checkpoints and one archive write
+    assert batch.set.call_count == 3
+    checkpoints = [
+        call[0][1] for call in batch.set.call_args_list
+        if "last_archive_date" in call[0][1]]
+    assert checkpoints == [{"last_archive_date": "20200102"}] * 2
+    args, kwargs = [
+        call for call in batch.set.call_args_list
+        if "month" in call[0][1]][0]
+    assert args[1]["20200102-21"] == {"1500000000-000001": "a", "1500000001": "b"}
+    assert args[1]["month"] == 202001
+    assert kwargs["merge"] is True
+    # The legacy document and the entry
+    assert batch.delete.call_count == 2
+    batch.commit.assert_called_once()
+
+
+def test_firestore_archive_days_leftovers(mocker):
+    mocker.patch('widt.storage.DB')
+    FirestoreStorage().archive_days([
+        ArchivedDay("1", "20200102", "20200102-21", {"1500000100-000000": "b"}, 1500000200,
+                    ("1500000000-000001",)),
+    ])
+    batch = widt.storage.DB.batch.return_value
+    checkpoints = [
+        call[0][1] for call in batch.set.call_args_list
+        if "last_archive_date" in call[0][1]]
+    assert checkpoints == [{"last_archive_date": "20200102", "last_archive_until": 1500000200}]
+    # The leftover is removed but not archived again
+    archived = [call[0][1] for call in batch.set.call_args_list if "month" in call[0][1]]
+    assert archived[0]["20200102-21"] == {"1500000100-000000": "b"}
+    assert batch.delete.call_count == 2
+
+
+def test_firestore_archive_days_failed_commit(mocker):
+    mocker.patch('widt.storage.DB')
+    widt.storage.DB.batch.return_value.commit.side_effect = RuntimeError("unavailable")
+    failed = FirestoreStorage().archive_days([ArchivedDay("1", "20200102", "20200102-21", {})])
+    assert failed == ["1"]
+
+
+def test_firestore_archive_days_many_entries(mocker):
+    mocker.patch('widt.storage.DB')
+    mocker.patch('widt.storage.BATCH_SIZE', 4)
+    batches = []
+
+    def new_batch():
+        batch = mocker.MagicMock()
+        writes = []
+        batch.set.side_effect = lambda ref, data, merge: writes.append("set")
+        batch.delete.side_effect = lambda ref: writes.append("delete")
+
+        def commit():
+            # The first batch of leftover deletes fails once
+            if writes == ["delete"] * 3 and "failed" not in batches:
+                batches.append("failed")
+                raise RuntimeError("unavailable")
+            batches.append(writes)
+        batch.commit.side_effect = commit
+        return batch
+    widt.storage.DB.batch.side_effect = new_batch
+    entries = {f"150000000{i}-000000": str(i) for i in range(5)}
+    failed = FirestoreStorage().archive_days([ArchivedDay("1", "20200102", "20200102-21", entries)])
+    # The checkpoint and the archive go with the deletes that fit; the rest follow (and are retried)
+    assert failed == []
+    assert batches == [["set", "set", "delete", "delete"], "failed", ["delete"] * 3]
+
+
+def test_month_range():
+    assert month_range(201911, 202002) == [201911, 201912, 202001, 202002]
+    assert month_range(202002, 202001) == []
+
+
+def test_firestore_query_archive(mocker):
+    mocker.patch('widt.storage.DB')
+    mocker.patch('widt.storage.ARCHIVE_READ_MONTHS', 2)
+    widt.storage.DB.collection.return_value.document.side_effect = lambda doc_id: doc_id
+    widt.storage.DB.get_all.side_effect = [
+        [_doc(mocker, "202002", None),
+         _doc(mocker, "202001", {"month": 202001, "20200102-21": {"1577970000-000000": "a"}})],
+        [_doc(mocker, "202003", {"month": 202003, "20200302-21": {"1583150000-000000": "b"}})],
+    ]
+    mocker.patch.object(FirestoreStorage, "_legacy_ref").return_value.get.return_value = _doc(
+        mocker, "1", {"20190101": {"1546300000": "legacy"}})
+    days = list(FirestoreStorage().query_archive("1", 202001, 202003))
+    assert days == [
+        (None, "20190101", {"1546300000": "legacy"}),
+        (202001, "20200102-21", {"1577970000-000000": "a"}),
+        (202003, "20200302-21", {"1583150000-000000": "b"})]
+    # Exactly the months in range
+    assert widt.storage.DB.get_all.call_args_list == [
+        mocker.call(["202001", "202002"]), mocker.call(["202003"])]
+
+
+def test_firestore_query_archive_without_legacy(mocker):
+    mocker.patch('widt.storage.DB')
+    mocker.patch('widt.storage.LEGACY_ARCHIVE', False)
+    legacy_ref = mocker.patch.object(FirestoreStorage, "_legacy_ref")
+    widt.storage.DB.get_all.return_value = []
+    assert list(FirestoreStorage().query_archive("1", 202001, 202001)) == []
+    legacy_ref.assert_not_called()
+
+
+def test_firestore_migrate_legacy_archive(mocker):
+    mocker.patch('widt.storage.DB')
+    ref = mocker.MagicMock()
+    ref.id = "1"
+    ref.get.return_value = _doc(mocker, "1", {
+        "20191231": {"1577800000": "a"}, "20200101": {"1577850000": "b"},
+        "20200102": {"1577950000": "c"}, "notes": "not a day"})
+    missing = mocker.MagicMock()
+    missing.get.return_value = _doc(mocker, "2", None)
+    widt.storage.DB.collection.return_value.list_documents.return_value = [ref, missing]
+    widt.storage.DB.collection.return_value.document.side_effect = lambda doc_id: doc_id
+    assert FirestoreStorage().migrate_legacy_archive() == {"1": 3}
+    batch = widt.storage.DB.batch.return_value
+    assert batch.set.call_args_list == [
+        mocker.call("201912", {"month": 201912, "20191231": {"1577800000": "a"}}, merge=True),
+        mocker.call("202001", {
+            "month": 202001, "20200101": {"1577850000": "b"}, "20200102": {"1577950000": "c"}},
+            merge=True),
+    ]
+    ref.set.assert_called_once_with({"notes": "not a day"})
+    ref.delete.assert_not_called()
+
+
+def test_firestore_migrate_legacy_archive_failed(mocker):
+    mocker.patch('widt.storage.DB')
+    ref = mocker.MagicMock()
+    ref.id = "1"
+    ref.get.return_value = _doc(mocker, "1", {"20191231": {"1577800000": "a"}})
+    widt.storage.DB.collection.return_value.list_documents.return_value = [ref]
+    widt.storage.DB.batch.return_value.commit.side_effect = RuntimeError("unavailable")
+    assert FirestoreStorage().migrate_legacy_archive() == {}
+    # The legacy document stays until its days are moved
+    ref.delete.assert_not_called()
+    ref.set.assert_not_called()
+
+
+def test_memory_storage():
+    storage = MemoryStorage()
+    storage.put_meta(1, {"timezone": 8, "report_hour": 13})
+    storage.put_meta(2, {"timezone": 0, "report_hour": 21})
+    storage.put_meta(1, {"email": "a@b.c"})
+    assert storage.get_meta("1") == {"timezone": 8, "report_hour": 13, "email": "a@b.c"}
+    assert storage.get_metas([2, 3]) == {"2": {"timezone": 0, "report_hour": 21}, "3": None}
+    assert [chat_id for chat_id, _ in storage.stream_meta(13)] == ["1"]
+
+    storage.write_live({"1": {"1500000000-000000": "a", "1500000100-000000": "b"}})
+    storage.write_live({"1": {"1500000100-000000": None}})
+    assert storage.read_live(1) == {"1500000000-000000": "a"}
+    live = storage.collect_live([1], 1500000050)
+    assert storage.archive_days([ArchivedDay("1", "20170714", "20170714-21", live["1"])]) == []
+    assert storage.read_live(1) == {}
+    assert storage.get_meta(1)["last_archive_date"] == "20170714"
+    storage.append_archive(1, {"20170801-21": {"1501500000-000000": "c"}})
+    assert list(storage.query_archive(1, 201707, 201707)) == [
+        (201707, "20170714-21", {"1500000000-000000": "a"})]
+    assert len(list(storage.query_archive(1, 201701, 201712))) == 2